@@ -0,0 +1,74 @@
+import os
+import sys
+import time
+import argparse
+import numpy as np
+from utils.diff import (
+    DEFAULT_SPINDLE_DELAY,
+    DEFAULT_TOLERANCE,
+    diff_programs,
+    program_heights,
+    recut_lines,
+)
+from utils.transform import DEFAULT_SAFE_Z
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare two G-code programs by toolpath and write a re-cut of the changes"
+    )
+    parser.add_argument("old")
+    parser.add_argument("new")
+    parser.add_argument("-o", "--output", help="Write a program cutting only the changed moves")
+    parser.add_argument(
+        "--safe-z",
+        type=float,
+        help="Retract height in the new program's units; default its highest Z, at least "
+        f"{DEFAULT_SAFE_Z:g} mm",
+    )
+    parser.add_argument(
+        "--plunge-feed",
+        type=float,
+        help="mm/min, default the new program's own plunge feed before each run",
+    )
+    parser.add_argument(
+        "--spindle-delay",
+        type=float,
+        default=DEFAULT_SPINDLE_DELAY,
+        help="Seconds to dwell after starting the spindle",
+    )
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="mm")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    changed, removed = diff_programs(args.old, args.new, args.tolerance)
+    count = int(np.count_nonzero(changed))
+    runs = int(np.count_nonzero(np.diff(np.concatenate(([0], changed.astype(np.int8)))) == 1))
+    print(
+        f"{count} of {len(changed)} cutting moves changed in {runs} runs, "
+        f"{removed} removed ({time.perf_counter() - started:.2f}s)"
+    )
+    if not args.output:
+        return
+    if not count:
+        print("Nothing to re-cut.")
+        return
+    # The re-cut is written in mm
+    top, scale, offsets = program_heights(args.new)
+    if args.safe_z is not None:
+        safe_z = args.safe_z * scale
+    elif offsets:
+        print(f"{args.new} sets its own offsets (G10/G92), so give a --safe-z")
+        return 1
+    else:
+        safe_z = max(top, DEFAULT_SAFE_Z)
+    with open(args.output, "w") as file:
+        for line in recut_lines(
+            args.new, changed, safe_z, args.plunge_feed, args.spindle_delay
+        ):
+            file.write(line + "\n")
+    print(f"Wrote {args.output} ({os.path.getsize(args.output)} bytes)")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,71 +1,207 @@
 import os
 import sys
-import serial
-import serial.tools.list_ports
-from utils.machine import stream_gcode
+from utils.engine import StreamEngine, describe
+from utils.config import configured_port
+from utils.ports import port_watcher
+from utils.progress import PROGRESS_FILE, load_progress, save_progress
+from utils.toolpath import Toolpath, project
+from utils.status import StatusChannel, StatusWriter
+from utils.jobstore import default_store
+from utils.passes import passes_spec
 from dotenv import load_dotenv
 import tkinter as tk
-from tkinter import ttk, filedialog
+from tkinter import ttk, filedialog, messagebox
 import multiprocessing
 import queue
-import json
 import time
+import threading
+import numpy as np
 
 load_dotenv()
 
-PROGRESS_FILE = "gcode_progress.json"
+STATUS_INTERVAL = 25  # ms between live status samples, 40 Hz
 
 
 class GCodeProcessor(multiprocessing.Process):
+    # Long-lived worker: ports stay open between jobs, so looping or pressing
+    # Play again does not reset the controller or wait for it to wake up.
     def __init__(
         self,
-        port,
-        baud_rate,
-        file_queue,
+        job_queue,
         status_queue,
+        status_channel,
         stop_event,
     ):
-        super().__init__()
-        self.port = port
-        self.baud_rate = baud_rate
-        self.file_queue = file_queue
+        super().__init__(daemon=True)
+        self.job_queue = job_queue
         self.status_queue = status_queue
+        self.status_channel = status_channel
         self.stop_event = stop_event
 
     def run(self):
-        ser = None
+        engine = StreamEngine(on_status=StatusWriter(self.status_channel).publish)
+        engine.subscribe(self.forward)
         try:
-            ser = serial.Serial(self.port, self.baud_rate)
-            self.status_queue.put(("status", f"Connected to {self.port}"))
-
-            while not self.stop_event.is_set():
-                try:
-                    file = self.file_queue.get(timeout=1)
-                    self.status_queue.put(("status", f"Processing: {file}"))
-                    stream_gcode(ser, file)
-                    self.status_queue.put(("finished_file", None))
-                    self.file_queue.task_done()
-                except queue.Empty:
-                    if not self.file_queue.empty():
-                        continue
-                    elif self.file_queue.empty():
-                        break
-        except serial.SerialException as e:
-            self.status_queue.put(("status", f"Error: {str(e)}"))
+            while True:
+                job = self.job_queue.get()
+                if job is None:
+                    break
+                port, files = job
+                # files is None to take work from the job scheduler for this port
+                engine.submit(port, files)
+                while not engine.wait(0.1):
+                    if self.stop_event.is_set():
+                        engine.cancel()
+                self.status_queue.put(("finished", None))
         finally:
-            if ser:
-                ser.close()
-            self.status_queue.put(("finished", None))
+            engine.close()
+
+    def forward(self, message):
+        # Engine events become the messages the Tk side polls for
+        event = message["event"]
+        if event == "limits":
+            self.status_queue.put(("limits", message["problems"]))
+            return
+        if event == "file_started":
+            self.status_queue.put(("file_started", message["file"]))
+        elif event == "file_finished":
+            self.status_queue.put(("finished_file", None))
+            return
+        text = describe(message)
+        if text:
+            self.status_queue.put(("status", text))
+
+
+class ToolpathView(ttk.Frame):
+    POINT_BUDGET = 20000  # Points drawn per polyline, whatever the file size
+    FRAME_INTERVAL = 40  # ms, ~25 fps
+
+    def __init__(self, master):
+        super().__init__(master)
+        self.canvas = tk.Canvas(self, background="white", highlightthickness=0)
+        self.canvas.pack(fill=tk.BOTH, expand=True)
+        self.pending_item = self.canvas.create_line(0, 0, 0, 0, fill="#bbbbbb")
+        self.executed_item = self.canvas.create_line(0, 0, 0, 0, fill="#1f6fd1", width=2)
+        self.tool_item = self.canvas.create_oval(0, 0, 0, 0, outline="#d11f1f", width=2)
+
+        self.toolpaths = {}
+        self.loading = {}
+        self.path = None
+        self.toolpath = None
+        self.level = None
+        self.projected = None
+        self.bounds = None
+        self.executed_index = 0
+        self.tool_position = None
+        self.dirty = True
+
+        self.canvas.bind("<Configure>", self.on_resize)
+        self.tick()
+
+    def show(self, path):
+        if path == self.path:
+            return
+        self.path = path
+        self.toolpath = None
+        self.executed_index = 0
+        self.tool_position = None
+        if path in self.toolpaths:
+            self.set_toolpath(self.toolpaths[path])
+        elif path not in self.loading:
+            # Parsing a large file takes a while; keep Tk responsive meanwhile
+            result = {}
+            thread = threading.Thread(
+                target=self.load_toolpath, args=(path, result), daemon=True
+            )
+            self.loading[path] = (thread, result)
+            thread.start()
+
+    def load_toolpath(self, path, result):
+        try:
+            result["toolpath"] = Toolpath.from_file(path)
+        except (OSError, ValueError) as e:
+            result["error"] = e
+
+    def set_toolpath(self, toolpath):
+        self.toolpath = toolpath
+        self.level = toolpath.level_for(self.POINT_BUDGET)
+        self.projected = None
+        self.dirty = True
+
+    def set_progress(self, path, line_number, x, y):
+        self.show(path)
+        if self.toolpath is None or not len(self.toolpath):
+            return
+        hi = self.toolpath.index_for_line(line_number)
+        self.executed_index = self.toolpath.nearest_index(self.executed_index, hi, x, y)
+        self.tool_position = (x, y)
+        self.dirty = True
+
+    def on_resize(self, event):
+        self.projected = None
+        self.dirty = True
+
+    def tick(self):
+        for path, (thread, result) in list(self.loading.items()):
+            if not thread.is_alive():
+                del self.loading[path]
+                if "toolpath" in result:
+                    self.toolpaths[path] = result["toolpath"]
+                    if path == self.path:
+                        self.set_toolpath(result["toolpath"])
+        if self.dirty:
+            self.dirty = False
+            self.render()
+        self.after(self.FRAME_INTERVAL, self.tick)
+
+    def render(self):
+        toolpath = self.toolpath
+        if toolpath is None or len(toolpath) < 2:
+            for item in (self.pending_item, self.executed_item, self.tool_item):
+                self.canvas.itemconfigure(item, state="hidden")
+            return
+
+        width = self.canvas.winfo_width()
+        height = self.canvas.winfo_height()
+        if self.projected is None:
+            self.projected = project(
+                toolpath.points[self.level], width, height, toolpath.bounds
+            )
+            self.bounds = toolpath.bounds
+
+        cut = int(np.searchsorted(self.level, self.executed_index, side="right"))
+        self.set_polyline(self.executed_item, self.projected[:cut])
+        self.set_polyline(self.pending_item, self.projected[max(cut - 1, 0) :])
+
+        if self.tool_position is not None:
+            x, y = project(np.array([self.tool_position]), width, height, self.bounds)[0]
+            self.canvas.coords(self.tool_item, x - 4, y - 4, x + 4, y + 4)
+            self.canvas.itemconfigure(self.tool_item, state="normal")
+        else:
+            self.canvas.itemconfigure(self.tool_item, state="hidden")
+
+    def set_polyline(self, item, points):
+        if len(points) < 2:
+            self.canvas.itemconfigure(item, state="hidden")
+            return
+        self.canvas.coords(item, points.ravel().tolist())
+        self.canvas.itemconfigure(item, state="normal")
 
 
 class GCodeRunner:
     def __init__(self, master):
         self.master = master
         master.title("G-code Runner")
-        master.geometry("500x400")
+        master.geometry("900x600")
+        master.protocol("WM_DELETE_WINDOW", self.on_close)
 
-        self.file_queue = multiprocessing.JoinableQueue()
+        self.job_queue = multiprocessing.Queue()
         self.status_queue = multiprocessing.Queue()
+        self.status_channel = StatusChannel()
+        self.job_files = []
+        self.file_refs = []  # Job store refs, in the same order as file_list
+        self.store = default_store()
+        self.running_jobs = False
         self.stop_event = multiprocessing.Event()
         self.loop_flag = multiprocessing.Value("b", False)
         self.current_index = multiprocessing.Value("i", 0)
@@ -74,6 +210,8 @@ class GCodeRunner:
         # Port selection
         ttk.Label(master, text="Select Port:").pack(pady=5)
         self.port_combo = ttk.Combobox(master)
+        self.port_watcher = port_watcher().start()  # Refills the list on replugs
+        self.ports_version = None
         self.refresh_ports()
         self.port_combo.pack(pady=5)
 
@@ -107,6 +245,14 @@ class GCodeRunner:
         )
         self.move_down_button.pack(pady=2)
 
+        # Files added while these are set are cut in passes down to the depth
+        ttk.Label(list_buttons, text="Depth (mm):").pack(pady=(10, 0))
+        self.depth_entry = ttk.Entry(list_buttons, width=8)
+        self.depth_entry.pack(pady=2)
+        ttk.Label(list_buttons, text="Step-down (mm):").pack()
+        self.step_entry = ttk.Entry(list_buttons, width=8)
+        self.step_entry.pack(pady=2)
+
         # Control buttons and loop option
         control_frame = ttk.Frame(master)
         control_frame.pack(pady=5)
@@ -124,6 +270,11 @@ class GCodeRunner:
         self.continue_button.pack(side=tk.LEFT, padx=5)
         self.continue_button["state"] = "disabled"
 
+        self.jobs_button = ttk.Button(
+            control_frame, text="Run Jobs", command=self.on_run_jobs
+        )
+        self.jobs_button.pack(side=tk.LEFT, padx=5)
+
         self.loop_var = tk.BooleanVar()
         self.loop_checkbox = ttk.Checkbutton(
             control_frame,
@@ -137,87 +288,118 @@ class GCodeRunner:
         self.status_label = ttk.Label(master, text="Status: Idle")
         self.status_label.pack(pady=5)
 
+        # Live progress and toolpath
+        self.progress_label = ttk.Label(master, text="")
+        self.progress_label.pack(pady=2)
+        self.toolpath_view = ToolpathView(master)
+        self.toolpath_view.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        self.file_list.bind("<<ListboxSelect>>", self.on_select_file)
+
         # Start the queue processing
         self.process_queue()
+        self.poll_status()
 
         # Check for saved progress
         self.load_files()
         self.check_saved_progress()
 
     def refresh_ports(self):
-        ports = [
-            f"{port.device} - {port.description}"
-            for port in serial.tools.list_ports.comports()
-        ]
+        self.ports_version = self.port_watcher.version
+        comports = self.port_watcher.ports()
+        ports = [f"{port.device} - {port.description}" for port in comports]
         self.port_combo["values"] = ports
-        if ports:
-            self.port_combo.set(ports[int(os.getenv("PORT")) - 1])
+        if self.port_combo.get() in ports:
+            return  # Keep what the user picked while it is plugged in
+        port = configured_port(comports)
+        if port:
+            self.port_combo.set(
+                next((entry for entry in ports if entry.split(" - ")[0] == port), port)
+            )
 
     def add_file(self):
         file_paths = filedialog.askopenfilenames(
             filetypes=[("G-code files", "*.gcode *.nc *.ngc")]
         )
+        passes = None
+        if self.depth_entry.get().strip():
+            try:
+                passes = float(self.depth_entry.get()), float(self.step_entry.get())
+            except ValueError:
+                passes = (0, 0)
+            if min(passes) <= 0:
+                messagebox.showerror("Invalid passes", "Enter a positive depth and step-down.")
+                return
         for file_path in file_paths:
-            self.file_list.insert(tk.END, file_path)
+            ref = self.store.add(file_path)
+            self.insert_file(tk.END, passes_spec(ref, *passes) if passes else ref)
+
+    def insert_file(self, index, ref):
+        if index == tk.END:
+            self.file_refs.append(ref)
+        else:
+            self.file_refs.insert(index, ref)
+        self.file_list.insert(index, self.store.display_name(ref))
+
+    def pop_file(self, index):
+        self.file_list.delete(index)
+        return self.file_refs.pop(index)
+
+    def on_select_file(self, event):
+        selected_indices = self.file_list.curselection()
+        if selected_indices and not self.stop_button.instate(["!disabled"]):
+            self.toolpath_view.show(self.store.resolve(self.file_refs[selected_indices[-1]]))
 
     def remove_file(self):
         selected_indices = self.file_list.curselection()
         for index in reversed(selected_indices):
-            self.file_list.delete(index)
+            self.pop_file(index)
 
     def move_up(self):
         selected_indices = self.file_list.curselection()
         for index in selected_indices:
             if index > 0:
-                text = self.file_list.get(index)
-                self.file_list.delete(index)
-                self.file_list.insert(index - 1, text)
+                self.insert_file(index - 1, self.pop_file(index))
                 self.file_list.selection_set(index - 1)
 
     def move_down(self):
         selected_indices = self.file_list.curselection()
         for index in reversed(selected_indices):
             if index < self.file_list.size() - 1:
-                text = self.file_list.get(index)
-                self.file_list.delete(index)
-                self.file_list.insert(index + 1, text)
+                self.insert_file(index + 1, self.pop_file(index))
                 self.file_list.selection_set(index + 1)
 
     def on_play(self, cont=False):
         port = self.port_combo.get().split(" - ")[0]
-        files = self.file_list.get(0, tk.END)
+        files = [self.store.resolve(ref) for ref in self.file_refs]
         if not files:
             self.status_label["text"] = "Status: No files to process"
             return
 
-        # Clear the queue before adding new files
-        while not self.file_queue.empty():
-            try:
-                self.file_queue.get_nowait()
-            except queue.Empty:
-                break
-
         if cont:
-            cont_files = self.file_list.get(
-                self.current_index.value, tk.END
-            ) + self.file_list.get(0, self.current_index.value)
-            for file in cont_files:
-                self.file_queue.put(file)
-        else:
-            for file in files:
-                self.file_queue.put(file)
+            files = files[self.current_index.value :] + files[: self.current_index.value]
+
+        self.start_job(port, files)
 
+    def on_run_jobs(self):
+        port = self.port_combo.get().split(" - ")[0]
+        self.start_job(port, None)
+
+    def start_job(self, port, files):
         self.stop_event.clear()
-        self.processor = GCodeProcessor(
-            port,
-            int(os.getenv("BAUD_RATE")),
-            self.file_queue,
-            self.status_queue,
-            self.stop_event,
-        )
-        self.processor.start()
+        if self.processor is None or not self.processor.is_alive():
+            self.processor = GCodeProcessor(
+                self.job_queue,
+                self.status_queue,
+                self.status_channel,
+                self.stop_event,
+            )
+            self.processor.start()
+        self.job_files = []
+        self.running_jobs = files is None
+        self.job_queue.put((port, files))
 
         self.play_button["state"] = "disabled"
+        self.jobs_button["state"] = "disabled"
         self.stop_button["state"] = "normal"
         self.continue_button["state"] = "disabled"
 
@@ -239,17 +421,27 @@ class GCodeRunner:
         self.status_label["text"] = message
 
     def on_finished(self):
-        if self.loop_flag.value and not self.stop_event.is_set():
+        # Scheduled jobs carry their own repeat counts, so Loop only applies
+        # to the file list
+        if (
+            self.loop_flag.value
+            and not self.running_jobs
+            and not self.stop_event.is_set()
+        ):
             self.on_play()
         else:
             self.play_button["state"] = "normal"
+            self.jobs_button["state"] = "normal"
             self.stop_button["state"] = "disabled"
             self.continue_button["state"] = "normal"
             self.status_label["text"] = "Status: Idle"
 
-            if self.processor:
-                self.processor.join()
-                self.processor = None
+    def on_close(self):
+        if self.processor and self.processor.is_alive():
+            self.stop_event.set()
+            self.job_queue.put(None)
+            self.processor.join(timeout=5)
+        self.master.destroy()
 
     def process_queue(self):
         try:
@@ -258,6 +450,11 @@ class GCodeRunner:
                     message = self.status_queue.get_nowait()
                     if message[0] == "status":
                         self.update_status(message[1])
+                    elif message[0] == "limits":
+                        self.stop_event.set()  # Loop must not start it again
+                        messagebox.showerror("Files exceed the limits", message[1])
+                    elif message[0] == "file_started":
+                        self.job_files.append(message[1])
                     elif message[0] == "finished":
                         self.on_finished()
                     elif message[0] == "finished_file":
@@ -269,29 +466,39 @@ class GCodeRunner:
                         self.save_progress()
                 except queue.Empty:
                     break
+            if self.port_watcher.version != self.ports_version:
+                self.refresh_ports()
         finally:
             self.master.after(100, self.process_queue)
 
+    def poll_status(self):
+        record = self.status_channel.latest()
+        if record is not None and record.file_index < len(self.job_files):
+            file = self.job_files[record.file_index]
+            self.toolpath_view.set_progress(file, record.line, *record.wpos[:2])
+            eta = record.eta
+            eta_text = f"{int(eta // 60)}:{int(eta % 60):02d}" if eta is not None else "--:--"
+            self.progress_label["text"] = (
+                f"{record.state}  line {record.line}  {record.fraction:.0%}  "
+                f"ETA {eta_text}  X{record.wpos[0]:.2f} Y{record.wpos[1]:.2f} "
+                f"Z{record.wpos[2]:.2f}  F{record.feed:.0f}  "
+                f"Bf {record.planner_free}  RX {record.rx_free}"
+            )
+        self.master.after(STATUS_INTERVAL, self.poll_status)
+
     def save_progress(self):
-        progress = {
-            "files": list(self.file_list.get(0, tk.END)),
-            "current_index": self.current_index.value,
-        }
-        with open(PROGRESS_FILE, "w") as f:
-            json.dump(progress, f)
+        save_progress(self.file_refs, self.current_index.value)
 
     def load_progress(self):
-        with open(PROGRESS_FILE, "r") as f:
-            progress = json.load(f)
-
-        self.current_index.value = progress["current_index"]
+        progress = load_progress()
+        if progress is not None:
+            self.current_index.value = progress[1]
 
     def load_files(self):
-        with open(PROGRESS_FILE, "r") as f:
-            progress = json.load(f)
-
-        for file in progress["files"]:
-            self.file_list.insert(tk.END, file)
+        progress = load_progress()
+        if progress is not None:
+            for file in progress[0]:
+                self.insert_file(tk.END, file)
 
     def check_saved_progress(self):
         if os.path.exists(PROGRESS_FILE):
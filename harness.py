@@ -0,0 +1,387 @@
+import os
+import sys
+import json
+import time
+import signal
+import hashlib
+import argparse
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, ROOT)
+
+from utils.machine import clean_line  # noqa: E402
+from utils.emulator import EmulatorPty  # noqa: E402
+
+BASELINES_FILE = os.path.join(ROOT, "harness_baselines.json")
+DEVICE_SPEED = 1000.0  # Motion time hardly matters; the serial path does
+PROGRAM_LINES = 2000
+RUN_TIMEOUT = 120  # s per scenario
+DEFAULT_TOLERANCE = 0.25  # Allowed throughput drop against the baseline
+
+
+def write_program(path, lines, seed):
+    # A deterministic zigzag well inside the emulator's travel
+    with open(path, "w") as f:
+        f.write(f"; harness program {seed}\nG21 G90\nG0 Z1\nG0 X0 Y0\nG1 Z-0.5 F300\n")
+        for index in range(lines):
+            x = (index * 7 + seed) % 100
+            y = (index // 10) % 100 + 0.5 * (index % 2)
+            f.write(f"G1 X{x:.3f} Y{y:.3f} F3000 ; move {index}\n")
+        f.write("G0 Z1\n")
+
+
+def program_lines(path):
+    with open(path, "r") as f:
+        return [line for line in (clean_line(raw) for raw in f) if line]
+
+
+def run_env(device):
+    # Settings that change what is streamed are pinned, so runs compare
+    env = dict(os.environ)
+    env.update(
+        BAUD_RATE="115200",
+        PORT=device.path,
+        PYTHONPATH=ROOT,
+        PYTHONUNBUFFERED="1",
+        STREAM_COMPRESS="off",
+        LIMIT_CHECK="off",
+        WORK_TRANSFORM="",
+    )
+    for name in ("GRBL_CONFIG", "METRICS_FILE", "METRICS_PORT", "SERIAL_TRACE_DIR"):
+        env.pop(name, None)
+    return env
+
+
+def wait_for_lines(device, count, process=None, timeout=RUN_TIMEOUT):
+    deadline = time.monotonic() + timeout
+    while len(device.gcode_lines()) < count:
+        if process is not None and process.poll() is not None:
+            return
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Only {len(device.gcode_lines())} of {count} lines arrived")
+        time.sleep(0.05)
+
+
+def finish(process, log):
+    try:
+        process.wait(RUN_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        raise TimeoutError("Process did not exit")
+    finally:
+        log.close()
+
+
+def write_progress(workdir, files, current_index=0):
+    with open(os.path.join(workdir, "gcode_progress.json"), "w") as f:
+        json.dump({"files": files, "current_index": current_index}, f)
+
+
+def read_progress(workdir):
+    with open(os.path.join(workdir, "gcode_progress.json"), "r") as f:
+        return json.load(f)
+
+
+# Scenarios return (cycle, check): the lines of each queued file in the
+# order they are streamed, over and over when the runner loops, and an
+# optional check on the workdir once the run is over, given how many files
+# were streamed.
+
+
+def scenario_play(workdir, device):
+    path = os.path.join(workdir, "a.ngc")
+    write_program(path, PROGRAM_LINES, 1)
+    write_progress(workdir, [path])
+    cycle = [program_lines(path)]
+    log = open(os.path.join(workdir, "play.log"), "w")
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, "play.py")],
+        cwd=workdir,
+        env=run_env(device),
+        stdout=log,
+        stderr=subprocess.STDOUT,
+    )
+    wait_for_lines(device, len(cycle[0]), process)
+    process.send_signal(signal.SIGINT)  # Stops after the current file
+    finish(process, log)
+    return cycle, None
+
+
+def scenario_play_resume(workdir, device):
+    # gcode_progress.json points at the second file, so the run starts there
+    # and the index it saves counts the files that were finished
+    paths = [os.path.join(workdir, name) for name in ("a.ngc", "b.ngc")]
+    for seed, path in enumerate(paths, 1):
+        write_program(path, PROGRAM_LINES // 2, seed)
+    write_progress(workdir, paths, current_index=1)
+    cycle = [program_lines(paths[1]), program_lines(paths[0])]
+    log = open(os.path.join(workdir, "play.log"), "w")
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, "play.py")],
+        cwd=workdir,
+        env=run_env(device),
+        stdout=log,
+        stderr=subprocess.STDOUT,
+    )
+    wait_for_lines(device, len(cycle[0]), process)
+    process.send_signal(signal.SIGINT)
+    finish(process, log)
+
+    def check(streamed_files):
+        expected = (1 + streamed_files) % len(paths)
+        saved = read_progress(workdir)["current_index"]
+        if saved != expected:
+            return f"gcode_progress.json current_index is {saved}, expected {expected}"
+        return None
+
+    return cycle, check
+
+
+def scenario_play_transform(workdir, device):
+    # A work transform set only in the machine's section of the config file
+    # applies to the stream, as it does to the limit check
+    from utils.transform import LineTransformer, parse_transform
+
+    spec = "offset=10,5 rotate=90"
+    with open(os.path.join(workdir, "grbl_config.json"), "w") as f:
+        machine = {"match": {"port": device.path}, "work_transform": spec}
+        json.dump({"machines": {"harness": machine}}, f)
+    path = os.path.join(workdir, "a.ngc")
+    write_program(path, PROGRAM_LINES // 2, 7)
+    write_progress(workdir, [path])
+    transformer = LineTransformer(parse_transform(spec))
+    cycle = [[transformer.apply(line) for line in program_lines(path)]]
+    log = open(os.path.join(workdir, "play.log"), "w")
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, "play.py")],
+        cwd=workdir,
+        env=run_env(device),
+        stdout=log,
+        stderr=subprocess.STDOUT,
+    )
+    wait_for_lines(device, len(cycle[0]), process)
+    process.send_signal(signal.SIGINT)
+    finish(process, log)
+    return cycle, None
+
+
+def scenario_terminal(workdir, device):
+    path = os.path.join(workdir, "a.ngc")
+    write_program(path, PROGRAM_LINES, 3)
+    write_progress(workdir, [path])
+    cycle = [program_lines(path)]
+    log = open(os.path.join(workdir, "terminal.log"), "w")
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, "terminal.py")],
+        cwd=workdir,
+        env=run_env(device),
+        stdin=subprocess.PIPE,
+        stdout=log,
+        stderr=subprocess.STDOUT,
+    )
+    process.stdin.write(b"5\n")  # Start processing
+    process.stdin.flush()
+    wait_for_lines(device, len(cycle[0]), process)
+    process.stdin.write(b"6\n7\n")  # Stop after the current file, exit
+    process.stdin.close()
+    finish(process, log)
+    return cycle, None
+
+
+def scenario_gui(workdir, device):
+    # The GUI's long-lived GCodeProcessor, driven without Tk
+    paths = [os.path.join(workdir, name) for name in ("a.ngc", "b.ngc")]
+    for seed, path in enumerate(paths, 4):
+        write_program(path, PROGRAM_LINES // 2, seed)
+    cycle = [program_lines(path) for path in paths]
+    log = open(os.path.join(workdir, "gui.log"), "w")
+    process = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "--gui-worker", *paths],
+        cwd=workdir,
+        env=run_env(device),
+        stdout=log,
+        stderr=subprocess.STDOUT,
+    )
+    finish(process, log)
+    return cycle, None
+
+
+def gui_worker(paths):
+    import multiprocessing
+    from gui import GCodeProcessor
+    from utils.status import StatusChannel
+
+    job_queue = multiprocessing.Queue()
+    status_queue = multiprocessing.Queue()
+    channel = StatusChannel()
+    processor = GCodeProcessor(
+        job_queue,
+        status_queue,
+        channel,
+        multiprocessing.Event(),
+    )
+    processor.start()
+    job_queue.put((os.getenv("PORT"), paths))
+    try:
+        while True:
+            kind, value = status_queue.get(timeout=RUN_TIMEOUT)
+            if kind == "status":
+                print(value)
+            elif kind == "finished":
+                break
+    finally:
+        job_queue.put(None)
+        processor.join(10)
+
+
+SCENARIOS = {
+    "play": scenario_play,
+    "play_resume": scenario_play_resume,
+    "play_transform": scenario_play_transform,
+    "terminal": scenario_terminal,
+    "gui": scenario_gui,
+}
+
+
+def digest(cycle):
+    hash = hashlib.sha256()
+    for lines in cycle:
+        for line in lines:
+            hash.update(line.encode() + b"\n")
+    return hash.hexdigest()
+
+
+def match_files(lines, cycle):
+    # Number of whole files the stream is made of, or the index of the first
+    # line that does not belong
+    position = 0
+    files = 0
+    while position < len(lines):
+        expected = cycle[files % len(cycle)]
+        got = lines[position : position + len(expected)]
+        if got != expected:
+            mismatch = next(
+                (i for i, (a, b) in enumerate(zip(got, expected)) if a != b), len(got)
+            )
+            return None, position + mismatch
+        position += len(expected)
+        files += 1
+    return files, None
+
+
+def run_scenario(name):
+    device = EmulatorPty(DEVICE_SPEED)
+    try:
+        with tempfile.TemporaryDirectory(prefix=f"harness-{name}-") as workdir:
+            cycle, check = SCENARIOS[name](workdir, device)
+            received = device.gcode_lines()
+            lines = [line.decode() for _, line in received]
+            problems = []
+            files, mismatch = match_files(lines, cycle)
+            if mismatch is not None:
+                problems.append(f"stream differs at line {mismatch + 1} of {len(lines)}")
+            elif not files:
+                problems.append("nothing was streamed")
+            elif check is not None:
+                problem = check(files)
+                if problem:
+                    problems.append(problem)
+            elapsed = received[-1][0] - received[0][0] if len(received) > 1 else 0.0
+            return {
+                "name": name,
+                "lines": len(lines),
+                "digest": digest(cycle),
+                "lines_per_second": (len(lines) - 1) / elapsed if elapsed else 0.0,
+                "problems": problems,
+            }
+    except Exception as e:
+        return {"name": name, "problems": [f"{type(e).__name__}: {e}"]}
+    finally:
+        device.close()
+
+
+def load_baselines():
+    try:
+        with open(BASELINES_FILE, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def compare(result, baseline, tolerance):
+    problems = list(result["problems"])
+    if baseline and "digest" in result:
+        if result["digest"] != baseline["digest"]:
+            problems.append("streamed lines differ from the baseline")
+        floor = baseline["lines_per_second"] * (1.0 - tolerance)
+        if result["lines_per_second"] < floor:
+            problems.append(
+                f"throughput {result['lines_per_second']:.0f} lines/s is below "
+                f"{floor:.0f} (baseline {baseline['lines_per_second']:.0f})"
+            )
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run play.py, terminal.py and the GUI streamer against emulated GRBL ptys"
+    )
+    parser.add_argument("scenarios", nargs="*", help=f"Default: all of {', '.join(SCENARIOS)}")
+    parser.add_argument("--repeat", type=int, default=1, help="Devices per scenario")
+    parser.add_argument("--parallel", type=int, help="Scenarios at once, default all")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument(
+        "--update-baselines", action="store_true", help="Store this run's results"
+    )
+    parser.add_argument("--gui-worker", nargs="+", metavar="FILE", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.gui_worker:
+        gui_worker(args.gui_worker)
+        return 0
+
+    names = args.scenarios or list(SCENARIOS)
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(unknown)}")
+    runs = [name for name in names for _ in range(max(args.repeat, 1))]
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(args.parallel or len(runs)) as pool:
+        results = list(pool.map(run_scenario, runs))
+
+    baselines = load_baselines()
+    failed = 0
+    for result in results:
+        problems = compare(result, baselines.get(result["name"]), args.tolerance)
+        if "digest" in result:
+            summary = f"{result['lines']} lines, {result['lines_per_second']:.0f} lines/s"
+        else:
+            summary = "did not run"
+        print(f"{'FAIL' if problems else 'ok':4} {result['name']:12} {summary}")
+        for problem in problems:
+            print(f"     {problem}")
+        failed += bool(problems)
+    print(f"{len(results) - failed} of {len(results)} passed in {time.perf_counter() - started:.1f}s")
+
+    if args.update_baselines:
+        for name in names:
+            done = [r for r in results if r["name"] == name and not r["problems"]]
+            if done:
+                baselines[name] = {
+                    "digest": done[0]["digest"],
+                    # The slowest run, so parallel noise does not fail later runs
+                    "lines_per_second": round(min(r["lines_per_second"] for r in done), 1),
+                }
+        with open(BASELINES_FILE, "w") as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Baselines written to {BASELINES_FILE}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
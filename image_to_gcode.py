@@ -0,0 +1,266 @@
+import os
+import sys
+import argparse
+import numpy as np
+
+DEFAULT_STRIP_ROWS = 256  # Image rows dithered and converted per step
+
+
+def bayer_matrix(order=3):
+    # 2^order square threshold map with values in (0, 1)
+    matrix = np.zeros((1, 1), dtype=np.float32)
+    for _ in range(order):
+        matrix = np.block(
+            [[4 * matrix, 4 * matrix + 2], [4 * matrix + 3, 4 * matrix + 1]]
+        )
+    return (matrix + 0.5) / matrix.size
+
+
+BAYER_8 = bayer_matrix(3)
+
+
+def open_image(path):
+    # Returns (width, height, read_strip). Binary PGM and .npy files are
+    # memory-mapped, so only the strip being worked on is ever read; other
+    # formats go through Pillow, which decodes the image once.
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".npy":
+        data = np.load(path, mmap_mode="r")
+        scale = 255.0 if data.dtype == np.uint8 else 1.0
+        return data.shape[1], data.shape[0], lambda y0, y1: data[y0:y1] / scale
+    if extension in (".pgm", ".pnm"):
+        data, maxval = map_pgm(path)
+        if data is not None:
+            return data.shape[1], data.shape[0], lambda y0, y1: data[y0:y1] / float(maxval)
+
+    from PIL import Image
+
+    Image.MAX_IMAGE_PIXELS = None  # Large rasters are the point
+    image = Image.open(path)
+    width, height = image.size
+    has_alpha = "A" in image.getbands() or "transparency" in image.info
+
+    def read_strip(y0, y1):
+        strip = image.crop((0, y0, width, y1))
+        if has_alpha:
+            pixels = np.asarray(strip.convert("LA"), dtype=np.float32) / 255.0
+            # Transparent areas count as white, so they are not burned
+            return pixels[:, :, 0] * pixels[:, :, 1] + (1.0 - pixels[:, :, 1])
+        return np.asarray(strip.convert("L"), dtype=np.float32) / 255.0
+
+    return width, height, read_strip
+
+
+def map_pgm(path):
+    with open(path, "rb") as f:
+        header = f.read(512)
+    if not header.startswith(b"P5"):
+        return None, None
+    fields = []
+    position = 2
+    while len(fields) < 3:
+        while header[position : position + 1].isspace():
+            position += 1
+        if header[position : position + 1] == b"#":
+            position = header.index(b"\n", position) + 1
+            continue
+        end = position
+        while not header[end : end + 1].isspace():
+            end += 1
+        fields.append(int(header[position:end]))
+        position = end
+    width, height, maxval = fields
+    dtype = np.uint8 if maxval < 256 else np.dtype(">u2")
+    data = np.memmap(path, dtype, "r", offset=position + 1, shape=(height, width))
+    return data, maxval
+
+
+def floyd_steinberg(gray, carry):
+    # Error diffusion over a strip, vectorized along anti-diagonal wavefronts:
+    # every pixel with the same x + 2y depends only on earlier wavefronts, so
+    # each wavefront is one set of NumPy operations. carry holds the error
+    # pushed into the first row from the strip above and is returned for the
+    # next strip.
+    height, width = gray.shape
+    # One padding column each side and an extra row for the next strip's carry
+    buf = np.zeros((height + 1, width + 2), dtype=np.float32)
+    buf[:height, 1 : width + 1] = gray
+    buf[0, 1 : width + 1] += carry
+    out = np.zeros((height, width), dtype=bool)
+    rows = np.arange(height)
+    for t in range(width + 2 * (height - 1)):
+        y_lo = max(0, (t - width) // 2 + 1)
+        y_hi = min(height - 1, t // 2)
+        ys = rows[y_lo : y_hi + 1]
+        xs = t - 2 * ys + 1
+        old = buf[ys, xs]
+        white = old >= 0.5
+        out[ys, xs - 1] = white
+        error = old - white
+        buf[ys, xs + 1] += error * (7 / 16)
+        buf[ys + 1, xs - 1] += error * (3 / 16)
+        buf[ys + 1, xs] += error * (5 / 16)
+        buf[ys + 1, xs + 1] += error * (1 / 16)
+    return out, buf[height, 1 : width + 1].copy()
+
+
+def ordered_dither(gray, y0):
+    height, width = gray.shape
+    size = len(BAYER_8)
+    rows = BAYER_8[(np.arange(y0, y0 + height) % size)[:, None], np.arange(width) % size]
+    return gray >= rows
+
+
+def power_strips(read_strip, width, height, dither, levels, min_power, max_power, strip_rows):
+    # Yields (first row, power array) per strip, with S values as integers
+    carry = np.zeros(width, dtype=np.float32)
+    span = max_power - min_power
+    for y0 in range(0, height, strip_rows):
+        y1 = min(y0 + strip_rows, height)
+        gray = np.asarray(read_strip(y0, y1), dtype=np.float32)
+        if dither == "floyd":
+            white, carry = floyd_steinberg(gray, carry)
+            power = np.where(white, 0, max_power)
+        elif dither == "bayer":
+            power = np.where(ordered_dither(gray, y0), 0, max_power)
+        else:
+            # Darker is more power; quantized so runs of similar pixels merge
+            darkness = np.round((1.0 - gray) * (levels - 1)) / (levels - 1)
+            power = np.where(darkness > 0, min_power + darkness * span, 0)
+        yield y0, np.rint(power).astype(np.int32)
+
+
+def row_runs(power):
+    # Run-length encodes one row: starts, ends (exclusive) and values
+    change = np.flatnonzero(power[1:] != power[:-1]) + 1
+    starts = np.concatenate(([0], change))
+    ends = np.concatenate((change, [len(power)]))
+    return starts, ends, power[starts]
+
+
+class RasterWriter:
+    # Emits only the words that change between blocks
+    def __init__(self, file):
+        self.file = file
+        self.motion = None
+        self.x = None
+        self.y = None
+        self.power = None
+
+    def move(self, motion, x=None, y=None, power=None):
+        words = []
+        if x is not None and x != self.x:
+            words.append(f"X{x:.3f}")
+            self.x = x
+        if y is not None and y != self.y:
+            words.append(f"Y{y:.3f}")
+            self.y = y
+        if power is not None and power != self.power:
+            words.append(f"S{power}")
+            self.power = power
+        if not words:
+            return
+        if motion != self.motion:
+            words.insert(0, motion)
+            self.motion = motion
+        self.file.write(" ".join(words) + "\n")
+
+
+def write_raster(
+    file,
+    read_strip,
+    width,
+    height,
+    pixel_size,
+    feed,
+    dither="floyd",
+    levels=16,
+    min_power=0,
+    max_power=1000,
+    overscan=0.0,
+    origin=(0.0, 0.0),
+    strip_rows=DEFAULT_STRIP_ROWS,
+):
+    x0, y0 = origin
+    writer = RasterWriter(file)
+    file.write("G21 G90 ; mm, absolute\n")
+    file.write(f"M4 S0 ; Dynamic laser power\nF{feed:g}\n")
+    forward = True
+    for top, power in power_strips(
+        read_strip, width, height, dither, levels, min_power, max_power, strip_rows
+    ):
+        for offset, row in enumerate(power):
+            burning = np.flatnonzero(row)
+            if not len(burning):
+                continue  # Blank rows are skipped entirely
+            first, last = burning[0], burning[-1] + 1
+            starts, ends, values = row_runs(row[first:last])
+            y = y0 + (height - (top + offset) - 0.5) * pixel_size
+            edges = x0 + (np.concatenate((starts, ends[-1:])) + first) * pixel_size
+            if forward:
+                xs, powers, lead = edges[1:], values, -overscan
+                start = edges[0]
+            else:
+                xs, powers, lead = edges[-2::-1], values[::-1], overscan
+                start = edges[-1]
+            writer.move("G0", start + lead, y, 0)
+            if overscan:
+                writer.move("G1", start, power=0)
+            for x, value in zip(xs.tolist(), powers.tolist()):
+                writer.move("G1", x, power=value)
+            if overscan:
+                writer.move("G1", xs[-1] - lead, power=0)
+            forward = not forward
+    file.write("M5 ; Laser off\n")
+    file.write(f"G0 X{x0:.3f} Y{y0:.3f} ; Return to origin\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a raster image to laser G-code")
+    parser.add_argument("image")
+    parser.add_argument("output")
+    parser.add_argument(
+        "--dither",
+        choices=("floyd", "bayer", "none"),
+        default="floyd",
+        help="Floyd-Steinberg, 8x8 ordered, or grayscale power levels",
+    )
+    parser.add_argument("--levels", type=int, default=16, help="Power levels without dithering")
+    size = parser.add_mutually_exclusive_group()
+    size.add_argument("--pixel-size", type=float, default=0.1, help="mm per pixel")
+    size.add_argument("--width", type=float, help="Output width in mm")
+    parser.add_argument("--feed", type=float, default=3000, help="Engraving feed, mm/min")
+    parser.add_argument("--min-power", type=int, default=0, help="S for the lightest burn")
+    parser.add_argument("--max-power", type=int, default=1000, help="S for black ($30)")
+    parser.add_argument("--overscan", type=float, default=0.0, help="Lead-in/out in mm")
+    parser.add_argument("--origin", type=float, nargs=2, default=(0.0, 0.0), metavar=("X", "Y"))
+    parser.add_argument("--strip-rows", type=int, default=DEFAULT_STRIP_ROWS)
+    args = parser.parse_args()
+
+    width, height, read_strip = open_image(args.image)
+    pixel_size = args.width / width if args.width else args.pixel_size
+    print(
+        f"{width}x{height} px at {pixel_size:g} mm/px: "
+        f"{width * pixel_size:.1f} x {height * pixel_size:.1f} mm"
+    )
+    with open(args.output, "w") as file:
+        write_raster(
+            file,
+            read_strip,
+            width,
+            height,
+            pixel_size,
+            args.feed,
+            args.dither,
+            max(args.levels, 2),
+            args.min_power,
+            args.max_power,
+            args.overscan,
+            tuple(args.origin),
+            max(args.strip_rows, 1),
+        )
+    print(f"Wrote {args.output} ({os.path.getsize(args.output)} bytes)")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,120 @@
+import sys
+import argparse
+from utils.scheduler import JobScheduler, HOOKS
+from utils.jobstore import default_store, is_ref
+from utils.passes import passes_spec, tile_spec
+
+
+def list_jobs(scheduler):
+    store = default_store()
+    jobs = scheduler.pending()
+    if not jobs:
+        print("No jobs in the queue.")
+        return
+    print(f"{'ID':>5} {'Prio':>4} {'Runs':>7}  {'Port':12} File")
+    for job in jobs:
+        runs = f"{job.completed}/{job.repeat or 'inf'}"
+        extras = []
+        if job.pre:
+            extras.append("pre: " + ", ".join(job.pre))
+        if job.post:
+            extras.append("post: " + ", ".join(job.post))
+        if job.after:
+            extras.append("after: " + ", ".join(str(job_id) for job_id in job.after))
+        if job.failures:
+            extras.append(f"faults: {job.failures}")
+        suffix = f"  ({'; '.join(extras)})" if extras else ""
+        name = store.display_name(job.path)
+        print(f"{job.id:>5} {job.priority:>4} {runs:>7}  {job.port or '-':12} {name}{suffix}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the G-code job queue")
+    commands = parser.add_subparsers(dest="command")
+
+    add = commands.add_parser("add", help="Add a job")
+    add.add_argument("path")
+    add.add_argument(
+        "--no-store",
+        action="store_true",
+        help="Reference the file by path instead of copying it into the job store",
+    )
+    add.add_argument("--priority", type=int, default=0, help="Higher runs first")
+    add.add_argument("--depth", type=float, help="Cut down to this depth (mm) in passes")
+    add.add_argument("--step", type=float, help="Step-down per pass (mm), with --depth")
+    add.add_argument(
+        "--tile", type=int, nargs=2, metavar=("COLUMNS", "ROWS"), help="Cut copies on a grid"
+    )
+    add.add_argument(
+        "--pitch", type=float, nargs=2, metavar=("X", "Y"), help="mm between copies, with --tile"
+    )
+    add.add_argument(
+        "--safe-z",
+        type=float,
+        help="Retract height (mm) between copies, default the program's highest Z, at least 5",
+    )
+    add.add_argument(
+        "--repeat", type=int, default=1, help="Number of runs, 0 to repeat forever"
+    )
+    add.add_argument("--port", help="Only run on this serial port")
+    add.add_argument(
+        "--pre",
+        action="append",
+        default=[],
+        help=f"File or hook to run before each run ({', '.join(HOOKS)})",
+    )
+    add.add_argument(
+        "--post", action="append", default=[], help="File or hook to run after each run"
+    )
+    add.add_argument(
+        "--after", type=int, action="append", default=[], help="Wait for this job ID"
+    )
+
+    remove = commands.add_parser("remove", help="Remove a job")
+    remove.add_argument("job_id", type=int)
+
+    commands.add_parser("list", help="List queued jobs")
+    commands.add_parser("clear", help="Remove all jobs")
+
+    args = parser.parse_args()
+    scheduler = JobScheduler()
+    scheduler.load()
+
+    if args.command == "add":
+        if (args.depth is None) != (args.step is None):
+            parser.error("--depth and --step go together")
+        if (args.tile is None) != (args.pitch is None):
+            parser.error("--tile and --pitch go together")
+        if args.tile and min(args.tile) < 1:
+            parser.error("--tile needs at least one column and one row")
+        path = args.path
+        if not args.no_store and not is_ref(path):
+            path = default_store().add(path)
+        if args.depth is not None:
+            if args.depth <= 0 or args.step <= 0:
+                parser.error("--depth and --step must be positive")
+            path = passes_spec(path, args.depth, args.step)
+        if args.tile:
+            path = tile_spec(path, *args.tile, *args.pitch, args.safe_z)
+        job = scheduler.add(
+            path, args.priority, args.repeat, args.port, args.pre, args.post, args.after
+        )
+        scheduler.save()
+        print(f"Added job {job.id}: {args.path} ({job.path})")
+    elif args.command == "remove":
+        if scheduler.remove(args.job_id) is None:
+            print(f"No job with ID {args.job_id}.")
+            sys.exit(1)
+        scheduler.save()
+        print(f"Removed job {args.job_id}.")
+    elif args.command == "clear":
+        for job in scheduler.pending():
+            scheduler.remove(job.id)
+        scheduler.save()
+        print("Job queue cleared.")
+    else:
+        list_jobs(scheduler)
+
+
+if __name__ == "__main__":
+    main()
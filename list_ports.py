@@ -1,16 +1,47 @@
-import serial.tools.list_ports
+import argparse
+from utils.ports import port_watcher
+
+
+def describe_port(info):
+    text = f"{info.device} - {info.description}"
+    if info.vid is not None:
+        text += f" [vid {info.vid:04x} pid {info.pid:04x}"
+        text += f" serial {info.serial_number}]" if info.serial_number else "]"
+    return text
 
 
 def list_serial_ports():
-    ports = serial.tools.list_ports.comports()
+    ports = port_watcher().ports()
 
     if not ports:
         print("No serial ports found.")
     else:
         print("Available serial ports:")
         for index, port in enumerate(ports, start=1):
-            print(f"{index}. {port.device} - {port.description}")
+            print(f"{index}. {describe_port(port)}")
+
+
+def watch_serial_ports():
+    # Prints ports as they are plugged in and out, until Ctrl+C
+    def on_port(message):
+        sign = "+" if message["event"] == "attached" else "-"
+        print(f"{sign} {describe_port(message['info'])}", flush=True)
+
+    watcher = port_watcher()
+    watcher.subscribe(on_port)
+    watcher.start()
+    try:
+        watcher.thread.join()
+    except KeyboardInterrupt:
+        pass
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="List serial ports")
+    parser.add_argument(
+        "--watch", action="store_true", help="Keep running and show ports as they come and go"
+    )
+    args = parser.parse_args()
     list_serial_ports()
+    if args.watch:
+        watch_serial_ports()
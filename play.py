@@ -1,130 +1,102 @@
-import os
+import time
+
+STARTUP_T0 = time.perf_counter()
+
 import sys
-import serial
-import serial.tools.list_ports
-from utils.machine import stream_gcode
-from dotenv import load_dotenv
-import json
 import signal
-import time
-import multiprocessing
 
-load_dotenv()
+# serial, dotenv and the streaming engine are imported where they are used so
+# the process can start without paying for them up front.
 
-PROGRESS_FILE = "gcode_progress.json"
+
+class StartupTimer:
+    def __init__(self, enabled, start=STARTUP_T0):
+        self.enabled = enabled
+        self.start = start
+        self.last = start
+
+    def mark(self, label):
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        print(
+            f"[startup] {label}: +{(now - self.last) * 1000:.1f} ms "
+            f"(total {(now - self.start) * 1000:.1f} ms)"
+        )
+        self.last = now
 
 
 class GCodeRunner:
-    def __init__(self):
-        self.running = multiprocessing.Value("b", False)
-        self.stop_requested = multiprocessing.Value("b", False)
-        self.current_file_index = multiprocessing.Value("i", 0)
-        self.files = multiprocessing.Manager().list()
-        self.gcode_process = None
-        self.current_file = multiprocessing.Manager().Value(str, "")
+    def __init__(self, startup=None):
+        self.files = []
+        self.current_file_index = 0
         self.port = None
-        self.baud_rate = int(os.getenv("BAUD_RATE"))
+        self.startup = startup or StartupTimer(False)
+        self.use_jobs = False  # Take work from the job scheduler instead
+        self.engine = None
 
     def load_progress(self):
-        if os.path.exists(PROGRESS_FILE):
-            with open(PROGRESS_FILE, "r") as f:
-                progress = json.load(f)
-            self.files.extend(progress.get("files", []))
-            self.current_file_index.value = progress.get("current_index", 0)
-        else:
+        from utils.progress import load_progress
+
+        progress = load_progress()
+        if progress is None:
             print("No progress file found. Please create a gcode_progress.json file.")
             sys.exit(1)
+        files, self.current_file_index = progress
+        self.files.extend(files)
 
     def save_progress(self):
-        progress = {
-            "files": list(self.files),
-            "current_index": self.current_file_index.value,
-        }
-        with open(PROGRESS_FILE, "w") as f:
-            json.dump(progress, f)
+        from utils.progress import save_progress
+
+        if self.use_jobs:
+            return  # The scheduler keeps its own state in jobs.json
+        save_progress(self.files, self.current_file_index)
 
     def get_port(self):
-        ports = list(serial.tools.list_ports.comports())
-        if not ports:
-            print("No serial ports found.")
+        from utils.config import configured_port
+
+        port = configured_port()
+        if port is None:
+            print("No serial port found for PORT or the configured machines.")
             sys.exit(1)
-        return ports[int(os.getenv("PORT")) - 1].device
-
-    def gcode_processing(
-        self,
-        port,
-        baud_rate,
-        files,
-        current_file_index,
-        running,
-        stop_requested,
-        current_file,
-    ):
-        def handle_interrupt(signum, frame):
-            print("Interrupt received. Stopping...")
-
-        signal.signal(signal.SIGINT, handle_interrupt)
-        signal.signal(signal.SIGTERM, handle_interrupt)
-
-        ser = None
-        try:
-            ser = serial.Serial(port, baud_rate)
-            print(f"Connected to {port}")
-
-            while running.value and not stop_requested.value:
-                if current_file_index.value < len(files):
-                    file = files[current_file_index.value]
-                    current_file.value = file
-                    print(f"Processing: {file}")
-                    try:
-                        stream_gcode(ser, file)
-                        print(f"Finished processing: {file}")
-                        with current_file_index.get_lock():
-                            current_file_index.value = (
-                                current_file_index.value + 1
-                                if current_file_index.value + 1 < len(files)
-                                else 0
-                            )
-                        self.save_progress()
-                    except serial.SerialException as e:
-                        print(f"Serial communication error: {e}")
-                        break
-                else:
-                    with current_file_index.get_lock():
-                        current_file_index.value = 0  # Reset for next loop
-                time.sleep(0.1)  # Small delay to prevent busy-waiting
-
-        except serial.SerialException as e:
-            print(f"Error opening serial port: {e}")
-        finally:
-            running.value = False
-            if ser:
-                ser.close()
+        return port
+
+    def on_event(self, message):
+        from utils.engine import describe
+
+        text = describe(message)
+        if text:
+            print(text)
+        event = message["event"]
+        if event == "connected":
+            self.startup.mark("connection ready")
+        elif event == "file_started":
+            self.startup.mark("streaming first file")
+            self.startup.enabled = False
+        elif event == "file_finished":
+            self.current_file_index = self.engine.index
+            self.save_progress()
+        elif event == "stopped":
             print("G-code processing stopped.")
 
     def start_processing(self):
-        self.running.value = True
+        from utils.engine import StreamEngine
+
         self.port = self.get_port()
-        self.gcode_process = multiprocessing.Process(
-            target=self.gcode_processing,
-            args=(
-                self.port,
-                self.baud_rate,
-                self.files,
-                self.current_file_index,
-                self.running,
-                self.stop_requested,
-                self.current_file,
-            ),
+        self.startup.mark("port resolved")
+        self.engine = StreamEngine()
+        self.engine.subscribe(self.on_event)
+        self.startup.mark("engine ready")
+        self.engine.submit(
+            self.port,
+            None if self.use_jobs else self.files,
+            self.current_file_index,
+            loop=True,
         )
-        self.gcode_process.start()
 
     def stop_processing(self):
-        self.stop_requested.value = True
+        self.engine.cancel()
         print("Stop requested. Waiting for current file to finish...")
-        self.gcode_process.join()
-        self.save_progress()
-        print(f"Processing stopped. Last file processed: {self.current_file.value}")
 
     def signal_handler(self, signum, frame):
         print("Signal received. Stopping after current file completion...")
@@ -132,12 +104,32 @@ class GCodeRunner:
 
 
 def main():
-    runner = GCodeRunner()
-    runner.load_progress()
+    startup = StartupTimer("--profile-startup" in sys.argv[1:])
+    startup.mark("imports")
+
+    from dotenv import load_dotenv
 
-    if not runner.files:
-        print("No files to process.")
-        return
+    load_dotenv()
+    startup.mark("environment loaded")
+
+    runner = GCodeRunner(startup)
+    if "--jobs" in sys.argv[1:]:
+        from utils.scheduler import JobScheduler
+
+        scheduler = JobScheduler()
+        scheduler.load()
+        startup.mark("jobs loaded")
+        if not scheduler.pending():
+            print("No jobs in the queue. Add some with jobs.py.")
+            return
+        runner.use_jobs = True
+    else:
+        runner.load_progress()
+        startup.mark("progress loaded")
+
+        if not runner.files:
+            print("No files to process.")
+            return
 
     # Set up signal handler for graceful stopping
     signal.signal(signal.SIGINT, runner.signal_handler)
@@ -145,8 +137,12 @@ def main():
 
     try:
         runner.start_processing()
-        while runner.running.value and not runner.stop_requested.value:
-            time.sleep(1)
+        while not runner.engine.wait(1):
+            pass
+        runner.engine.connections.close_all()
+        runner.save_progress()
+        if runner.engine.cancelled:
+            print(f"Processing stopped. Last file processed: {runner.engine.current_file}")
     except Exception as e:
         print(f"An error occurred: {e}")
 
@@ -154,5 +150,9 @@ def main():
 
 
 if __name__ == "__main__":
-    multiprocessing.freeze_support()  # Necessary for Windows
+    import multiprocessing
+
+    # The limit check analyses files in a process pool, which a frozen
+    # Windows build can only start with this
+    multiprocessing.freeze_support()
     main()
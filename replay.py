@@ -0,0 +1,90 @@
+import sys
+import time
+import argparse
+from utils.machine import stream_files
+from utils.machine_profile import (
+    MachineProfile,
+    load_cache,
+    parse_build_info,
+    parse_settings,
+)
+from utils.recovery import GrblError
+from utils.trace import ReplaySerial, TraceExhausted, read_trace, KIND_NAMES
+
+
+def dump_trace(path):
+    for kind, t, data in read_trace(path):
+        print(f"{t:12.6f} {KIND_NAMES.get(kind, kind):5} {data!r}")
+
+
+def trace_profile(ser, port=None):
+    # The machine profile the recorded stream ran with: from the $I and $$
+    # answers in the trace, or else the cached profile of port
+    answers = {
+        command: [line.strip().decode("utf-8", errors="replace") for line in lines]
+        for command, lines in ser.profile_responses.items()
+    }
+    if b"$I" in answers:
+        profile = MachineProfile(port)
+        parse_build_info([line for line in answers[b"$I"] if line != "ok"], profile)
+        profile.settings = parse_settings(answers.get(b"$$", []))
+        return profile
+    if port:
+        for data in load_cache().values():
+            if data["port"] == port:
+                return MachineProfile.from_dict(data)
+    return MachineProfile(port)
+
+
+def replay(trace_path, gcode_path, realtime, speed, port=None):
+    # Streams through stream_files, with the same flow control, compression
+    # and transform settings as the engine, so a recorded run can be
+    # reproduced and timed
+    ser = ReplaySerial(trace_path, realtime=realtime, speed=speed)
+    profile = trace_profile(ser, port)
+    ser.planner_blocks = max(ser.planner_blocks, profile.planner_blocks)
+    started = time.perf_counter()
+    try:
+        stream_files(ser, [gcode_path], profile, wake_up=False)
+    except TraceExhausted as e:
+        print(f"Replay stopped early: {e}")
+    except GrblError as e:
+        print(f"Replay stopped: {e}")
+    elapsed = time.perf_counter() - started
+
+    print(f"Replayed {len(ser.sent_commands)} commands in {elapsed:.3f} s")
+    print(f"Bytes sent: {ser.bytes_written}")
+    print(f"Recorded commands: {len(ser.recorded_commands)}")
+    mismatches = ser.mismatches()
+    if mismatches:
+        print(f"Commands differing from the recording: {mismatches}")
+    return mismatches == 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a recorded serial trace")
+    parser.add_argument("trace", help="Trace file recorded with SERIAL_TRACE_DIR")
+    parser.add_argument("gcode", nargs="?", help="G-code file to stream against it")
+    parser.add_argument(
+        "--realtime",
+        action="store_true",
+        help="Delay each response by the time the machine took to send it",
+    )
+    parser.add_argument(
+        "--speed", type=float, default=1.0, help="Speed factor for --realtime"
+    )
+    parser.add_argument(
+        "--port", help="Port the trace was recorded on, for its settings and cached profile"
+    )
+    parser.add_argument("--dump", action="store_true", help="Print the trace events")
+    args = parser.parse_args()
+
+    if args.dump or not args.gcode:
+        dump_trace(args.trace)
+        return
+    if not replay(args.trace, args.gcode, args.realtime, args.speed, args.port):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,466 @@
+import os
+import json
+import base64
+import struct
+import hashlib
+import asyncio
+import argparse
+from urllib.parse import urlsplit, parse_qs
+from dotenv import load_dotenv
+from utils.config import config, configured_port
+from utils.engine import StreamEngine
+from utils.scheduler import JobScheduler
+from utils.status import StatusChannel, StatusWriter
+from utils.jobstore import default_store, is_ref
+
+load_dotenv()
+
+CHUNK_SIZE = 64 * 1024  # Upload bodies are written to disk in pieces this size
+STATUS_INTERVAL = 0.02  # Seconds between status frames, 50 Hz
+EVENT_BACKLOG = 256  # Events kept for a client that is not reading
+MAX_CLIENT_BUFFER = 256 * 1024  # Skip status frames for clients this far behind
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+REASONS = {
+    200: "OK",
+    201: "Created",
+    400: "Bad Request",
+    404: "Not Found",
+    409: "Conflict",
+    411: "Length Required",
+}
+
+
+class HttpError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+def job_dict(job):
+    return {
+        "id": job.id,
+        "path": job.path,
+        "name": default_store().display_name(job.path),
+        "priority": job.priority,
+        "repeat": job.repeat,
+        "completed": job.completed,
+        "claimed": job.claimed,
+        "port": job.port,
+        "pre": job.pre,
+        "post": job.post,
+        "after": job.after,
+        "failures": job.failures,
+    }
+
+
+def status_dict(record):
+    return {
+        "state": record.state,
+        "time": record.time,
+        "file_index": record.file_index,
+        "line": record.line,
+        "mpos": record.mpos,
+        "wpos": record.wpos,
+        "feed": record.feed,
+        "spindle": record.spindle,
+        "planner_free": record.planner_free,
+        "rx_free": record.rx_free,
+        "fraction": record.fraction,
+        "eta": record.eta,
+    }
+
+
+class StreamController:
+    # Runs the job scheduler for one machine on a StreamEngine. Status goes
+    # into a StatusChannel, so the streaming loop never waits on the network.
+    def __init__(self, device, scheduler, notify):
+        self.device = device
+        self.scheduler = scheduler
+        self.notify = notify  # Called from the streaming thread with event dicts
+        self.channel = StatusChannel()
+        self.engine = StreamEngine(None, StatusWriter(self.channel).publish, scheduler)
+        self.engine.subscribe(self.forward)
+
+    @property
+    def running(self):
+        return self.engine.running
+
+    @property
+    def held(self):
+        return self.engine.held
+
+    @property
+    def current_file(self):
+        return self.engine.current_file if self.engine.running else None
+
+    def forward(self, message):
+        if message["event"] == "started":
+            message = {"event": "started", "device": message["port"]}
+        elif message["event"] == "job_run_finished":
+            message = {**message, "job": job_dict(message["job"])}
+        self.notify(message)
+
+    def start(self):
+        return self.engine.submit(self.device)
+
+    def stop(self):
+        # Like the Stop button: finish the current file, then stop
+        return self.engine.cancel()
+
+    def hold(self):
+        return self.engine.pause()
+
+    def resume(self):
+        return self.engine.resume()
+
+    def close(self):
+        self.engine.close()
+
+
+class WebSocketClient:
+    def __init__(self, writer):
+        self.writer = writer
+        self.events = []  # Encoded event frames, all delivered in order
+        self.status = None  # Only the newest status frame is kept
+        self.wakeup = asyncio.Event()
+        self.closed = False
+
+    def push_event(self, frame):
+        if len(self.events) >= EVENT_BACKLOG:
+            del self.events[0]
+        self.events.append(frame)
+        self.wakeup.set()
+
+    def push_status(self, frame):
+        self.status = frame
+        self.wakeup.set()
+
+    async def send_loop(self):
+        while not self.closed:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            frames, self.events = self.events, []
+            status, self.status = self.status, None
+            if status is not None and (
+                self.writer.transport.get_write_buffer_size() < MAX_CLIENT_BUFFER
+            ):
+                frames.append(status)
+            if frames:
+                self.writer.write(b"".join(frames))
+                await self.writer.drain()
+
+
+def ws_accept(key):
+    digest = hashlib.sha1((key + WS_GUID).encode()).digest()
+    return base64.b64encode(digest).decode()
+
+
+def ws_frame(payload, opcode=0x1):
+    length = len(payload)
+    if length < 126:
+        header = struct.pack("!BB", 0x80 | opcode, length)
+    elif length < 65536:
+        header = struct.pack("!BBH", 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+    return header + payload
+
+
+async def ws_read_frame(reader):
+    first, second = await reader.readexactly(2)
+    opcode = first & 0x0F
+    length = second & 0x7F
+    if length == 126:
+        (length,) = struct.unpack("!H", await reader.readexactly(2))
+    elif length == 127:
+        (length,) = struct.unpack("!Q", await reader.readexactly(8))
+    mask = await reader.readexactly(4) if second & 0x80 else None
+    payload = await reader.readexactly(length)
+    if mask:
+        payload = bytes(byte ^ mask[index % 4] for index, byte in enumerate(payload))
+    return opcode, payload
+
+
+class ApiServer:
+    def __init__(self, controller, scheduler):
+        self.controller = controller
+        self.scheduler = scheduler
+        self.clients = set()
+        self.last_status = None
+        self.loop = None
+
+    # Fan-out
+
+    def broadcast(self, event):
+        frame = ws_frame(json.dumps(event).encode())
+        for client in self.clients:
+            client.push_event(frame)
+
+    def notify_threadsafe(self, event):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.broadcast, event)
+
+    async def status_loop(self):
+        # Samples the newest status record and encodes it once for everyone
+        while True:
+            await asyncio.sleep(STATUS_INTERVAL)
+            record = self.controller.channel.latest()
+            if record is None:
+                continue
+            self.last_status = status_dict(record)
+            if self.clients:
+                frame = ws_frame(json.dumps({"event": "status", **self.last_status}).encode())
+                for client in self.clients:
+                    client.push_status(frame)
+
+    # HTTP
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            if not request_line:
+                return
+            method, target, _ = request_line.decode("latin-1").split(" ", 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            url = urlsplit(target)
+            if url.path == "/ws" and headers.get("upgrade", "").lower() == "websocket":
+                await self.websocket(reader, writer, headers)
+                return
+            try:
+                status, body = await self.route(
+                    method, url.path, parse_qs(url.query), headers, reader
+                )
+            except HttpError as e:
+                status, body = e.status, {"error": e.message}
+            payload = json.dumps(body).encode()
+            writer.write(
+                (
+                    f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+                    "Content-Type: application/json\r\n"
+                    f"Content-Length: {len(payload)}\r\n"
+                    "Connection: close\r\n\r\n"
+                ).encode()
+                + payload
+            )
+            await writer.drain()
+        except (ValueError, ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def read_json(self, headers, reader):
+        length = int(headers.get("content-length", 0))
+        if not length:
+            return {}
+        try:
+            return json.loads(await reader.readexactly(length))
+        except json.JSONDecodeError:
+            raise HttpError(400, "Body is not valid JSON")
+
+    async def route(self, method, path, query, headers, reader):
+        parts = [part for part in path.split("/") if part]
+        if parts[:1] != ["api"]:
+            raise HttpError(404, "Not found")
+        parts = parts[1:]
+
+        if parts == ["status"] and method == "GET":
+            return 200, self.status()
+        if parts == ["jobs"]:
+            if method == "GET":
+                return 200, [job_dict(job) for job in self.scheduler.pending()]
+            if method == "POST":
+                return 201, self.add_job(await self.read_json(headers, reader))
+        if len(parts) == 2 and parts[0] == "jobs" and method == "DELETE":
+            try:
+                job = self.scheduler.remove(int(parts[1]))
+            except ValueError:
+                job = None
+            if job is None:
+                raise HttpError(404, f"No job with ID {parts[1]}")
+            self.scheduler.save()
+            return 200, job_dict(job)
+        if parts == ["upload"] and method == "POST":
+            return 201, await self.upload(query, headers, reader)
+        if len(parts) == 1 and method == "POST":
+            command = parts[0]
+            if command == "start":
+                if not self.controller.start():
+                    raise HttpError(409, "Already running")
+                return 200, self.status()
+            if command == "stop":
+                self.controller.stop()
+                return 200, self.status()
+            if command in ("hold", "resume"):
+                if not getattr(self.controller, command)():
+                    raise HttpError(409, "Not connected")
+                return 200, self.status()
+        raise HttpError(404, "Not found")
+
+    def status(self):
+        return {
+            "device": self.controller.device,
+            "running": self.controller.running,
+            "held": self.controller.held,
+            "current_file": self.controller.current_file,
+            "status": self.last_status,
+        }
+
+    def add_job(self, data):
+        path = data.get("path")
+        if is_ref(path):
+            if default_store().meta(path) is None:
+                raise HttpError(400, f"Not in the job store: {path}")
+        elif not path or not os.path.exists(path):
+            raise HttpError(400, f"File not found: {path}")
+        try:
+            job = self.scheduler.add(
+                path,
+                int(data.get("priority", 0)),
+                int(data.get("repeat", 1)),
+                data.get("port"),
+                data.get("pre", ()),
+                data.get("post", ()),
+                [int(job_id) for job_id in data.get("after", ())],
+            )
+        except (TypeError, ValueError):
+            raise HttpError(400, "Invalid job fields")
+        self.scheduler.save()
+        self.broadcast({"event": "job_added", "job": job_dict(job)})
+        return job_dict(job)
+
+    async def upload(self, query, headers, reader):
+        # The body goes into the job store chunk by chunk, hashed on the way,
+        # and is never held in memory whole
+        name = os.path.basename(query.get("name", [""])[0])
+        if not name.lower().endswith((".gcode", ".ngc", ".nc")):
+            raise HttpError(400, "Upload needs a .gcode, .ngc or .nc name")
+        if "content-length" not in headers:
+            raise HttpError(411, "Content-Length required")
+        remaining = int(headers["content-length"])
+        store = default_store()
+        ingest = store.open_ingest(name)
+        try:
+            while remaining:
+                chunk = await reader.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise HttpError(400, "Upload truncated")
+                ingest.write(chunk)
+                remaining -= len(chunk)
+        except BaseException:
+            ingest.abort()
+            raise
+        # Hashing is done; parsing a new file for its metadata can take a while
+        ref = await asyncio.get_running_loop().run_in_executor(None, ingest.finish)
+        result = {"ref": ref, **store.meta(ref)}
+        if query.get("queue", ["0"])[0] not in ("0", ""):
+            result["job"] = self.add_job(
+                {"path": ref, "priority": query.get("priority", ["0"])[0]}
+            )
+        return result
+
+    # WebSocket
+
+    async def websocket(self, reader, writer, headers):
+        key = headers.get("sec-websocket-key")
+        if not key:
+            writer.close()
+            return
+        writer.write(
+            (
+                "HTTP/1.1 101 Switching Protocols\r\n"
+                "Upgrade: websocket\r\n"
+                "Connection: Upgrade\r\n"
+                f"Sec-WebSocket-Accept: {ws_accept(key)}\r\n\r\n"
+            ).encode()
+        )
+        await writer.drain()
+        client = WebSocketClient(writer)
+        client.push_event(ws_frame(json.dumps({"event": "hello", **self.status()}).encode()))
+        self.clients.add(client)
+        sender = asyncio.ensure_future(client.send_loop())
+        try:
+            while True:
+                opcode, payload = await ws_read_frame(reader)
+                if opcode == 0x8:  # Close
+                    writer.write(ws_frame(b"", 0x8))
+                    break
+                if opcode == 0x9:  # Ping
+                    writer.write(ws_frame(payload, 0xA))
+                elif opcode == 0x1:
+                    self.ws_command(client, payload)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            client.closed = True
+            client.wakeup.set()
+            self.clients.discard(client)
+            sender.cancel()
+            writer.close()
+
+    def ws_command(self, client, payload):
+        # {"command": "start" | "stop" | "hold" | "resume"}
+        try:
+            command = json.loads(payload).get("command")
+        except (json.JSONDecodeError, AttributeError):
+            command = None
+        if command not in ("start", "stop", "hold", "resume"):
+            reply = {"event": "error", "message": f"Unknown command: {command}"}
+        else:
+            ok = bool(getattr(self.controller, command)())
+            reply = {"event": "command", "command": command, "ok": ok}
+        client.push_event(ws_frame(json.dumps(reply).encode()))
+
+    async def serve(self, host, port):
+        self.loop = asyncio.get_running_loop()
+        server = await asyncio.start_server(self.handle, host, port)
+        status_task = asyncio.ensure_future(self.status_loop())
+        print(f"API listening on http://{host}:{port} for {self.controller.device}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            status_task.cancel()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HTTP and WebSocket API for the G-code runner")
+    parser.add_argument(
+        "--device",
+        help="Serial port, machine name from the config file, or emulator[:speed] for the "
+        "emulated GRBL. Default: PORT, or the first configured machine plugged in",
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    args = parser.parse_args()
+
+    current = config()
+    if args.device is None:
+        args.device = configured_port()
+    elif args.device in current.machines:
+        args.device = current.find_port(args.device)
+    if not args.device:
+        parser.error("No device given and none configured or plugged in")
+
+    scheduler = JobScheduler()
+    scheduler.load()
+    api = ApiServer(None, scheduler)
+    controller = StreamController(args.device, scheduler, api.notify_threadsafe)
+    api.controller = controller
+    try:
+        asyncio.run(api.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        print("\nStopping API server...")
+    finally:
+        controller.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,49 +1,52 @@
 import os
 import sys
 import serial
-import serial.tools.list_ports
-from utils.machine import stream_gcode
+from utils.config import configured_port, get_setting
+from utils.engine import StreamEngine, describe
+from utils.ports import port_watcher
+from utils.progress import load_progress, save_progress
+from utils.jobstore import default_store
+from utils.analysis import analyze_files, format_report
+from utils.limits import precheck
+from utils.passes import passes_spec
 from dotenv import load_dotenv
-import json
 import signal
 import time
-import threading
 import queue
 
 load_dotenv()
 
-PROGRESS_FILE = "gcode_progress.json"
-
 
 class GCodeTerminal:
     def __init__(self):
         self.ser = None
-        self.running = False
-        self.stop_requested = False
+        self.connection = None
+        self.profile = None
+        self.metrics = None
         self.current_file_index = 0
         self.files = []
-        self.gcode_thread = None
-        self.current_file = None
+        self.store = default_store()
         self.command_queue = queue.Queue()
         self.port = None
-        self.baud_rate = int(os.getenv("BAUD_RATE"))
+        self.engine = StreamEngine()
+        self.engine.subscribe(self.on_event)
+
+    @property
+    def running(self):
+        return self.engine.running
 
     def load_progress(self):
-        if os.path.exists(PROGRESS_FILE):
-            with open(PROGRESS_FILE, "r") as f:
-                progress = json.load(f)
-            self.files = progress.get("files", [])
-            self.current_file_index = progress.get("current_index", 0)
-        else:
+        progress = load_progress()
+        if progress is None:
             print("No progress file found. Starting fresh.")
+            return
+        self.files, self.current_file_index = progress
 
     def save_progress(self):
-        progress = {"files": self.files, "current_index": self.current_file_index}
-        with open(PROGRESS_FILE, "w") as f:
-            json.dump(progress, f)
+        save_progress(self.files, self.current_file_index)
 
     def list_serial_ports(self):
-        ports = list(serial.tools.list_ports.comports())
+        ports = port_watcher().ports()
         if not ports:
             print("No serial ports found.")
             sys.exit(1)
@@ -65,53 +68,37 @@ class GCodeTerminal:
 
     def connect(self):
         try:
-            self.ser = serial.Serial(self.port, self.baud_rate)
+            self.connection = self.engine.connect(self.port)
+            self.ser = self.connection.ser
             print(f"Connected to {self.port}")
+            self.profile = self.connection.profile
+            self.metrics = self.connection.metrics
         except serial.SerialException as e:
             print(f"Error opening serial port: {e}")
             return False
         return True
 
-    def reconnect(self):
-        print("Attempting to reconnect...")
-        for _ in range(5):  # Try to reconnect 5 times
-            if self.connect():
-                return True
-            time.sleep(2)
-        return False
-
-    def gcode_processing_thread(self):
-        while self.running and not self.stop_requested:
-            if self.current_file_index < len(self.files):
-                file = self.files[self.current_file_index]
-                self.current_file = file
-                print(f"Processing: {file}")
-                try:
-                    stream_gcode(self.ser, file, int(os.getenv("MAX_COMMANDS")))
-                    print(f"Finished processing: {file}")
-                    self.current_file_index += 1
-                    self.save_progress()
-                except serial.SerialException as e:
-                    print(f"Serial communication error: {e}")
-                    if not self.reconnect():
-                        print("Failed to reconnect. Stopping processing.")
-                        break
-            else:
-                self.current_file_index = 0  # Reset for next loop
-            time.sleep(0.1)  # Small delay to prevent busy-waiting
-
-        self.running = False
-        print("G-code processing stopped.")
+    def on_event(self, message):
+        text = describe(message)
+        if text:
+            print(text)
+        if message["event"] == "file_finished":
+            self.current_file_index = self.engine.index
+            self.save_progress()
+        elif message["event"] == "stopped":
+            print("G-code processing stopped.")
 
     def start_processing(self):
-        self.running = True
-        self.gcode_thread = threading.Thread(target=self.gcode_processing_thread)
-        self.gcode_thread.start()
+        if not self.files:
+            print("No files in the list.")
+            return
+        # The engine reads self.files as it goes, so files added meanwhile
+        # join the loop
+        self.engine.submit(self.port, self.files, self.current_file_index, loop=True)
 
     def stop_processing(self):
-        self.stop_requested = True
-        if self.gcode_thread:
-            self.gcode_thread.join()
+        self.engine.cancel()
+        self.engine.wait()
         self.save_progress()
 
     def add_file(self):
@@ -119,8 +106,20 @@ class GCodeTerminal:
         if os.path.exists(file_path) and file_path.lower().endswith(
             (".gcode", ".ngc", ".nc")
         ):
-            self.files.append(file_path)
-            print(f"Added file: {file_path}")
+            ref = self.store.add(file_path)
+            passes = input("Depth and step-down for multiple passes (mm, blank for one): ")
+            if passes.strip():
+                try:
+                    depth, step = (float(value) for value in passes.replace(",", " ").split())
+                except ValueError:
+                    print("Enter the depth and the step-down, for example: 3 0.5")
+                    return
+                if depth <= 0 or step <= 0:
+                    print("Depth and step-down must be positive.")
+                    return
+                ref = passes_spec(ref, depth, step)
+            self.files.append(ref)
+            print(f"Added file: {self.store.display_name(ref)}")
         else:
             print("Invalid file path or unsupported file type.")
 
@@ -130,12 +129,12 @@ class GCodeTerminal:
             return
         print("Current files:")
         for i, file in enumerate(self.files):
-            print(f"{i + 1}: {file}")
+            print(f"{i + 1}: {self.store.display_name(file)}")
         try:
             index = int(input("Enter the number of the file to remove: ")) - 1
             if 0 <= index < len(self.files):
                 removed_file = self.files.pop(index)
-                print(f"Removed file: {removed_file}")
+                print(f"Removed file: {self.store.display_name(removed_file)}")
             else:
                 print("Invalid file number.")
         except ValueError:
@@ -147,7 +146,21 @@ class GCodeTerminal:
         else:
             print("Current files:")
             for i, file in enumerate(self.files):
-                print(f"{i + 1}: {file}")
+                print(f"{i + 1}: {self.store.display_name(file)}")
+
+    def analyze(self):
+        if not self.files:
+            print("No files in the list.")
+            return
+        started = time.perf_counter()
+        results = analyze_files(self.files, profile=self.profile)
+        names = {file: self.store.display_name(file) for file in self.files}
+        baud_rate = get_setting("baud_rate", self.port)
+        print(format_report(self.files, results, baud_rate, names))
+        problems = precheck(self.files, self.profile)
+        if problems:
+            print(f"Files exceeding the limits:\n{problems}")
+        print(f"Analyzed {len(self.files)} files in {time.perf_counter() - started:.2f}s")
 
     def main_loop(self):
         while True:
@@ -155,11 +168,12 @@ class GCodeTerminal:
             print("1. Add G-code file")
             print("2. Remove G-code file")
             print("3. List G-code files")
-            print("4. Start processing")
-            print("5. Stop processing")
-            print("6. Exit")
+            print("4. Analyze G-code files")
+            print("5. Start processing")
+            print("6. Stop processing")
+            print("7. Exit")
 
-            choice = input("Enter your choice (1-6): ")
+            choice = input("Enter your choice (1-7): ")
 
             if choice == "1":
                 self.add_file()
@@ -167,21 +181,22 @@ class GCodeTerminal:
                 self.remove_file()
             elif choice == "3":
                 self.list_files()
-            elif choice == "4":
+            elif choice == "4" or choice.lower() == "analyze":
+                self.analyze()
+            elif choice == "5":
                 if not self.running:
                     self.start_processing()
                 else:
                     print("Processing is already running.")
-            elif choice == "5":
+            elif choice == "6":
                 if self.running:
                     self.stop_processing()
                 else:
                     print("Processing is not running.")
-            elif choice == "6":
+            elif choice == "7":
                 if self.running:
                     self.stop_processing()
-                if self.ser:
-                    self.ser.close()
+                self.engine.connections.close_all()
                 print("Exiting G-code Terminal.")
                 break
             else:
@@ -192,8 +207,13 @@ def main():
     terminal = GCodeTerminal()
     terminal.load_progress()
 
-    ports = terminal.list_serial_ports()
-    terminal.port = terminal.select_serial_port(ports)
+    # A device path, machine name or the emulator needs no asking; a port
+    # number still does, since the list may have changed
+    port = get_setting("port")
+    terminal.port = None if port and port.isdigit() else configured_port()
+    if terminal.port is None:
+        ports = terminal.list_serial_ports()
+        terminal.port = terminal.select_serial_port(ports)
 
     if not terminal.connect():
         print("Failed to connect to the serial port. Exiting.")
@@ -206,8 +226,7 @@ def main():
         if terminal.running:
             terminal.stop_processing()
     finally:
-        if terminal.ser:
-            terminal.ser.close()
+        terminal.engine.connections.close_all()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The modules are imported as utils.*, from the repository root, as the
+# front-ends and harness.py do
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
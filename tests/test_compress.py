@@ -0,0 +1,30 @@
+from utils.compress import StreamCompressor
+
+
+def compress(lines, tolerance=0.0005):
+    compressor = StreamCompressor(tolerance)
+    out = []
+    for line_number, line in enumerate(lines, 1):
+        out += [command for _, _, command in compressor.process(line_number, 0, line)]
+    out += [command for _, _, command in compressor.flush()]
+    return out
+
+
+def test_collinear_moves_within_tolerance_merge():
+    lines = ["G90", "G0 X0 Y0", "G1 X1 Y0 F100", "G1 X2 Y0.0004", "G1 X3 Y0"]
+    assert compress(lines) == ["G90", "G0 X0 Y0", "G1 X3 F100"]
+
+
+def test_corner_beyond_tolerance_is_kept():
+    lines = ["G90", "G0 X0 Y0", "G1 X1 Y0 F100", "G1 X2 Y0.01", "G1 X3 Y0"]
+    assert compress(lines) == ["G90", "G0 X0 Y0", "G1 X1 F100", "X2 Y0.01", "X3 Y0"]
+
+
+def test_feed_change_breaks_a_run():
+    lines = ["G90", "G0 X0 Y0", "G1 X1 Y0 F100", "G1 X2 Y0 F200"]
+    assert compress(lines) == ["G90", "G0 X0 Y0", "G1 X1 F100", "X2 F200"]
+
+
+def test_relative_moves_pass_through():
+    lines = ["G91", "G1 X1 F100", "G1 X1"]
+    assert compress(lines) == lines
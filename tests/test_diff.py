@@ -0,0 +1,47 @@
+from utils.diff import diff_programs, program_heights, recut_lines
+
+HEADER = "G21 G90\nG0 Z1\nG0 X0 Y0\nG1 Z-1 F100\n"
+
+
+def write(tmp_path, name, moves):
+    path = tmp_path / name
+    path.write_text(HEADER + "".join(f"{move}\n" for move in moves))
+    return str(path)
+
+
+def test_unchanged_program_has_no_changes(tmp_path):
+    moves = ["G1 X10", "G1 Y10", "G2 X0 Y0 I-5 J-5"]
+    old = write(tmp_path, "old.ngc", moves)
+    new = write(tmp_path, "new.ngc", [move.replace("G1 ", "G01 ") for move in moves])
+    changed, removed = diff_programs(old, new)
+    assert not changed.any() and removed == 0
+
+
+def test_repeated_segment_is_counted(tmp_path):
+    # The new program cuts X0-X10 twice, the old one once
+    old = write(tmp_path, "old.ngc", ["G1 X10", "G0 Z1", "G0 X0", "G1 Z-1", "G1 Y10"])
+    new = write(tmp_path, "new.ngc", ["G1 X10", "G0 Z1", "G0 X0", "G1 Z-1", "G1 X10"])
+    changed, removed = diff_programs(old, new)
+    assert changed.tolist() == [False, False, False, True]
+    assert removed == 1
+
+
+def test_recut_plunges_at_the_program_plunge_feed(tmp_path):
+    new = write(tmp_path, "new.ngc", ["G1 X10 F500", "G1 Y10"])
+    changed, _ = diff_programs(write(tmp_path, "old.ngc", ["G1 X10 F500"]), new)
+    lines = list(recut_lines(new, changed, 5))
+    assert lines == [
+        "G21 G90 G17",
+        "G0 Z5",
+        "G0 X10 Y0",
+        "G1 Z-1 F100",
+        "G1 X10 Y10 Z-1 F500",
+        "G0 Z5",
+        "M5",
+    ]
+
+
+def test_heights_are_in_mm(tmp_path):
+    path = tmp_path / "inch.ngc"
+    path.write_text("G20 G90\nG0 Z0.2\nG1 Z-0.01 F10\nG1 X1\n")
+    assert program_heights(str(path)) == (5.08, 25.4, False)
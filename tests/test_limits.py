@@ -0,0 +1,28 @@
+from utils.limits import check_bounds
+
+BOUNDS = ((0.0, 0.0, -2.0), (100.0, 50.0, 5.0))
+
+
+def test_fits_the_travel():
+    assert check_bounds(BOUNDS, travel=(200.0, 200.0, 50.0)) == []
+
+
+def test_span_over_the_travel():
+    problems = check_bounds(BOUNDS, travel=(80.0, 200.0, 50.0))
+    assert problems == ["X spans 100.000 mm, machine travel is 80 mm"]
+
+
+def test_unknown_travel_is_not_checked():
+    assert check_bounds(BOUNDS, travel=(None, 0.0, None)) == []
+
+
+def test_stock_edges_and_depth():
+    problems = check_bounds(BOUNDS, stock=(100.0, 40.0, 1.5))
+    assert problems == [
+        "Y 0.000..50.000 mm leaves the 40 mm stock",
+        "Z goes down to -2.000 mm, the stock is 1.5 mm thick",
+    ]
+
+
+def test_rounding_at_the_edge_is_allowed():
+    assert check_bounds(((-0.0005, 0.0, 0.0), (100.0005, 50.0, 0.0)), stock=(100.0, 50.0)) == []
@@ -0,0 +1,63 @@
+import pytest
+from utils.passes import DepthPasses, join_spec, split_spec
+
+
+def write(tmp_path, text):
+    path = tmp_path / "part.ngc"
+    path.write_text(text)
+    return str(path)
+
+
+def expand(path, depth, step):
+    passes = DepthPasses(path, depth, step)
+    return passes, list(passes.lines())
+
+
+def test_relative_z_is_rescaled(tmp_path):
+    # Cuts to -1.5: -1 absolute, then 0.5 deeper in G91
+    path = write(tmp_path, "G21 G90\nG0 Z1\nG1 Z-1 F100\nG91 G1 Z-0.5\nG1 X5\nG90 G0 Z1\n")
+    _, lines = expand(path, 3, 1.5)
+    assert lines[2:4] == ["G1 Z-1 F100", "G91 G1 Z-0.5"]
+    second = lines[lines.index("G0 Z1", 6) + 1 :]
+    assert second[2:4] == ["G1 Z-2 F100", "G91 G1 Z-1"]
+
+
+def test_relative_z_before_absolute_is_rejected(tmp_path):
+    path = write(tmp_path, "G91 G1 Z-1 F100\n")
+    with pytest.raises(ValueError):
+        DepthPasses(path, 2, 1)
+
+
+def test_end_codes_only_in_last_pass(tmp_path):
+    path = write(tmp_path, "M3 S1000\nG0 Z2\nG1 Z-1 F100\nG1 X5\nG0 Z2 M5\nM30\n")
+    _, lines = expand(path, 3, 1)
+    assert [line for line in lines if "M5" in line] == ["G0 Z2 M5"]
+    assert lines[-1] == "M30"
+    assert lines.count("M30") == 1
+    # Earlier passes keep the rest of the line and retract to the top Z
+    assert lines[4:8] == ["G0 Z2 ", "", "G0 Z2", "M3 S1000"]
+
+
+def test_inch_program_keeps_its_units(tmp_path):
+    path = write(tmp_path, "G20 G90\nG0 Z0.1\nG1 Z-0.02 F10 (plunge)\nG91\n")
+    passes, lines = expand(path, 1.016, 0.508)
+    assert lines[2] == "G1 Z-0.02 F10 (plunge)"
+    # The program ends in G91, so the retract switches to G90 and back
+    retract = lines.index("G90 G0 Z0.1")
+    assert lines[retract + 1] == "G91"
+    assert lines[retract + 4] == "G1 Z-0.04 F10 (plunge)"
+    assert passes.size == sum(len(line) + 1 for line in lines)
+
+
+def test_size_matches_expansion(tmp_path):
+    path = write(tmp_path, "G0 Z5\nG1 Z-0.3 F90 ; first\nG1 X10.5\nG0 Z5\nM2\n")
+    passes, lines = expand(path, 1, 0.25)
+    assert passes.size == sum(len(line) + 1 for line in lines)
+
+
+def test_spec_round_trip():
+    spec = "dir#1/part.ngc#passes=3,0.5#tile=3,2,60,40"
+    path, options = split_spec(spec)
+    assert path == "dir#1/part.ngc"
+    assert options == {"passes": (3.0, 0.5), "tile": (3.0, 2.0, 60.0, 40.0)}
+    assert join_spec(path, options) == spec
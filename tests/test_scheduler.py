@@ -0,0 +1,60 @@
+from utils.scheduler import JobScheduler, ScheduledStream
+
+
+def scheduler(tmp_path):
+    return JobScheduler(str(tmp_path / "jobs.json"))
+
+
+def test_priority_then_first_in_first_out(tmp_path):
+    jobs = scheduler(tmp_path)
+    low = jobs.add("low.ngc")
+    high = jobs.add("high.ngc", priority=5)
+    later = jobs.add("later.ngc")
+    assert [jobs.claim().id for _ in range(3)] == [high.id, low.id, later.id]
+    assert jobs.claim() is None
+
+
+def test_port_affinity(tmp_path):
+    jobs = scheduler(tmp_path)
+    pinned = jobs.add("pinned.ngc", priority=1, port="/dev/ttyUSB1")
+    anywhere = jobs.add("anywhere.ngc")
+    assert jobs.claim("/dev/ttyUSB0").id == anywhere.id
+    assert jobs.claim("/dev/ttyUSB0") is None
+    assert jobs.claim("/dev/ttyUSB1").id == pinned.id
+
+
+def test_dependency_waits_for_every_run(tmp_path):
+    jobs = scheduler(tmp_path)
+    first = jobs.add("first.ngc", repeat=2)
+    second = jobs.add("second.ngc", priority=9, after=[first.id])
+    assert jobs.claim().id == first.id
+    jobs.complete(first)
+    assert jobs.claim().id == first.id
+    assert jobs.claim() is None  # first's last run is still going
+    jobs.complete(first)
+    assert jobs.claim().id == second.id
+
+
+def test_repeats_are_claimed_once_each(tmp_path):
+    jobs = scheduler(tmp_path)
+    job = jobs.add("part.ngc", repeat=2)
+    assert jobs.claim() is job and jobs.claim() is job
+    assert jobs.claim() is None
+    jobs.release(job)
+    assert jobs.claim() is job
+
+
+def test_removed_job_is_not_run_again(tmp_path):
+    # Another process edits jobs.json while a run is streaming
+    jobs = scheduler(tmp_path)
+    job = jobs.add("part.ngc", repeat=3)
+    jobs.save()
+    stream = ScheduledStream(jobs)
+    files = stream.files()
+    assert next(files).endswith("part.ngc")
+    other = scheduler(tmp_path)
+    other.load()
+    other.remove(job.id)
+    other.save()
+    stream.file_done("part.ngc")
+    assert next(files, None) is None
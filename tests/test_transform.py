@@ -0,0 +1,38 @@
+import pytest
+from utils.transform import LineTransformer, parse_transform, tiled_lines
+
+
+def apply(spec, lines):
+    transformer = LineTransformer(parse_transform(spec))
+    return [transformer.apply(line) for line in lines]
+
+
+def test_mirror_reverses_arcs():
+    lines = apply("mirror=x", ["G0 X0 Y0", "G2 X10 Y0 I5 J0", "G3 X0 Y0 R5"])
+    assert lines == ["G0 X0 Y0", "G3 X-10 Y0 I-5 J0", "G2 X0 Y0 R5"]
+
+
+def test_rotation_fills_in_the_other_axis():
+    lines = apply("rotate=90", ["G0 X0 Y0", "G1 X10", "G1 Y5"])
+    assert lines == ["G0 X0 Y0", "G1 X0 Y10", "G1 X-5 Y10"]
+
+
+def test_offset_is_in_mm_for_inch_programs():
+    assert apply("offset=25.4,0", ["G20 G0 X1 Y0"]) == ["G20 G0 X2 Y0"]
+
+
+def test_relative_moves_are_rotated_not_offset():
+    lines = apply("offset=10,0 rotate=90", ["G0 X0 Y0", "G91 G1 X5"])
+    assert lines == ["G0 X10 Y0", "G91 G1 X0 Y5"]
+
+
+def test_relative_move_before_any_position_is_rejected():
+    with pytest.raises(ValueError):
+        apply("offset=10,0", ["G91 G1 X5"])
+
+
+def test_tiles_retract_in_the_program_units(tmp_path):
+    path = tmp_path / "part.ngc"
+    path.write_text("G20 G90\nG0 X0 Y0\nG1 Z-0.1 F10\n")
+    lines = list(tiled_lines(str(path), parse_transform(""), 2, 1, 25.4, 0, 5.08))
+    assert lines[3:6] == ["G0 Z0.2", "G20 G90", "G0 X1 Y0"]
@@ -0,0 +1,68 @@
+import os
+import sys
+import argparse
+from utils.gcode import file_summary
+from utils.transform import DEFAULT_SAFE_Z, LineTransformer, build_transform, tiled_lines
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Move, rotate, scale, mirror or tile a G-code program"
+    )
+    parser.add_argument("input")
+    parser.add_argument("output")
+    parser.add_argument("--offset", type=float, nargs=2, default=(0.0, 0.0), metavar=("X", "Y"))
+    parser.add_argument("--rotate", type=float, default=0.0, help="Degrees counterclockwise")
+    parser.add_argument("--scale", type=float, default=1.0)
+    parser.add_argument("--mirror", choices=("x", "y"), help="Flip X or Y")
+    parser.add_argument("--tile", type=int, nargs=2, metavar=("COLUMNS", "ROWS"))
+    spacing = parser.add_mutually_exclusive_group()
+    spacing.add_argument("--gap", type=float, default=5.0, help="mm between tiled copies")
+    spacing.add_argument("--pitch", type=float, nargs=2, metavar=("X", "Y"))
+    parser.add_argument(
+        "--safe-z",
+        type=float,
+        help=f"Retract to this Z (mm) between copies; default the program's highest Z,"
+        f" at least {DEFAULT_SAFE_Z:g}",
+    )
+    args = parser.parse_args()
+
+    transform = build_transform(tuple(args.offset), args.rotate, args.scale, args.mirror)
+    if args.tile:
+        columns, rows = args.tile
+        bounds = file_summary(args.input)["bounds"]
+        if bounds is None:
+            print("No moves to tile.")
+            return 1
+        low, high = transform.bounds(bounds)
+        if args.pitch:
+            pitch_x, pitch_y = args.pitch
+        else:
+            pitch_x = high[0] - low[0] + args.gap
+            pitch_y = high[1] - low[1] + args.gap
+        # Copies are never joined by a move at cutting depth
+        safe_z = args.safe_z if args.safe_z is not None else max(high[2], DEFAULT_SAFE_Z)
+        lines = tiled_lines(args.input, transform, columns, rows, pitch_x, pitch_y, safe_z)
+        print(f"{columns}x{rows} copies at {pitch_x:g} x {pitch_y:g} mm")
+    else:
+
+        def transformed():
+            transformer = LineTransformer(transform)
+            with open(args.input, "r") as file:
+                for line in file:
+                    yield transformer.apply(line.rstrip("\n"))
+
+        lines = transformed()
+
+    try:
+        with open(args.output, "w") as file:
+            for line in lines:
+                file.write(line + "\n")
+    except ValueError as e:
+        print(f"Cannot transform {args.input}: {e}")
+        return 1
+    print(f"Wrote {args.output} ({os.path.getsize(args.output)} bytes)")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,145 @@
+import os
+import json
+from concurrent.futures import ProcessPoolExecutor
+from utils.gcode import SUMMARY_VERSION, file_summary
+from utils.jobstore import default_store, is_ref
+from utils.passes import split_spec
+
+ANALYSIS_CACHE_FILE = "analysis_cache.json"
+BITS_PER_BYTE = 10  # 8N1: start bit, 8 data bits, stop bit
+
+
+def transfer_time(size, baud_rate):
+    return size * BITS_PER_BYTE / baud_rate if baud_rate else 0.0
+
+
+def file_key(path, rapid_rates=None):
+    stat = os.stat(split_spec(path)[0])
+    key = [stat.st_size, stat.st_mtime_ns, SUMMARY_VERSION]
+    if rapid_rates:
+        key.append(list(rapid_rates))
+    return key
+
+
+def summarize(path, rapid_rates=None):
+    # Runs in the worker processes; a file that cannot be parsed reports why
+    try:
+        return file_summary(path, rapid_rates)
+    except (OSError, ValueError) as e:
+        return str(e)
+
+
+def load_cache(path=ANALYSIS_CACHE_FILE):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+
+def save_cache(cache, path=ANALYSIS_CACHE_FILE):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(cache, f)
+    os.replace(tmp_path, path)
+
+
+def analyze_files(files, max_workers=None, cache_path=ANALYSIS_CACHE_FILE, profile=None):
+    # Returns {file: summary or error string}. Job store refs carry their
+    # metadata already; plain paths are cached by size and mtime, and only
+    # files not seen before are parsed, in parallel across processes. With
+    # a machine profile rapids are timed at its max rates, and the summaries
+    # are cached for those rates.
+    rapid_rates = profile.rapid_rates if profile else None
+    store = default_store()
+    cache = load_cache(cache_path)
+    results = {}
+    todo = {}
+    for file in files:
+        if is_ref(file) and rapid_rates is None:
+            meta = store.meta(file)
+            if meta is not None:
+                results[file] = meta
+                continue
+        path = store.resolve(file)
+        try:
+            key = file_key(path, rapid_rates)
+        except OSError as e:
+            results[file] = str(e)
+            continue
+        entry = cache.get(path)
+        if entry is not None and entry["key"] == key:
+            results[file] = entry["summary"]
+        else:
+            todo[file] = (path, key)
+
+    if todo:
+        paths = [path for path, _ in todo.values()]
+        if len(todo) == 1:
+            summaries = [summarize(paths[0], rapid_rates)]
+        else:
+            with ProcessPoolExecutor(max_workers or min(len(todo), os.cpu_count() or 1)) as pool:
+                summaries = list(pool.map(summarize, paths, [rapid_rates] * len(paths)))
+        for (file, (path, key)), summary in zip(todo.items(), summaries):
+            if isinstance(summary, dict):
+                cache[path] = {"key": key, "summary": summary}
+            results[file] = summary
+        save_cache(cache, cache_path)
+    return results
+
+
+def format_duration(seconds):
+    if seconds < 60:
+        return f"{seconds:.1f}s"
+    seconds = int(round(seconds))
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{seconds:02d}"
+    return f"{minutes}:{seconds:02d}"
+
+
+def format_report(files, results, baud_rate, names=None):
+    names = names or {}
+    rows = [
+        f"{'File':24} {'Lines':>7} {'Bytes':>9} {'Xfer':>7} {'Est.':>8} "
+        f"{'Size X x Y x Z (mm)':>24} {'Rapid mm':>9} {'Cut mm':>9} {'Arcs':>6}"
+    ]
+    totals = [0, 0, 0.0, 0.0, 0.0, 0.0, 0]
+    for file in files:
+        name = names.get(file, os.path.basename(file))[:24]
+        summary = results.get(file)
+        if not isinstance(summary, dict):
+            rows.append(f"{name:24} error: {summary}")
+            continue
+        xfer = transfer_time(summary["bytes"], baud_rate)
+        if summary["bounds"]:
+            low, high = summary["bounds"]
+            size = " x ".join(f"{hi - lo:.1f}" for lo, hi in zip(low, high))
+        else:
+            size = "-"
+        rows.append(
+            f"{name:24} {summary['lines']:>7} {summary['bytes']:>9} "
+            f"{format_duration(xfer):>7} {format_duration(summary['estimated_time']):>8} "
+            f"{size:>24} {summary['rapid_distance']:>9.1f} {summary['cut_distance']:>9.1f} "
+            f"{summary['arcs']:>6}"
+        )
+        for index, value in enumerate(
+            (
+                summary["lines"],
+                summary["bytes"],
+                xfer,
+                summary["estimated_time"],
+                summary["rapid_distance"],
+                summary["cut_distance"],
+                summary["arcs"],
+            )
+        ):
+            totals[index] += value
+    if len(files) > 1:
+        rows.append(
+            f"{'Total':24} {totals[0]:>7} {totals[1]:>9} {format_duration(totals[2]):>7} "
+            f"{format_duration(totals[3]):>8} {'':>24} {totals[4]:>9.1f} {totals[5]:>9.1f} "
+            f"{totals[6]:>6}"
+        )
+    return "\n".join(rows)
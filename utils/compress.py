@@ -0,0 +1,223 @@
+import math
+from utils.config import get_setting
+from utils.gcode import WORD_RE
+
+# Largest sideways deviation (in file units) of a dropped point from the
+# merged segment's direction
+DEFAULT_TOLERANCE = 0.0005
+
+SIMPLE_LETTERS = "GXYZFS"
+AXES = "XYZ"
+
+
+def compress_from_env(profile=None):
+    # STREAM_COMPRESS=on/off; by default it follows the controller's laser
+    # mode ($32=1), where long runs of tiny G1 moves are the norm
+    setting = get_setting("stream_compress", profile.port if profile else None)
+    if setting is not None:
+        return setting
+    return bool(profile and profile.laser_mode)
+
+
+def comparable(start, end):
+    # Axes never set on either side stay where they are and compare as 0;
+    # None when an axis only has a known value on one side
+    if any((s is None) != (e is None) for s, e in zip(start, end)):
+        return None
+    return (
+        [0.0 if s is None else s for s in start],
+        [0.0 if e is None else e for e in end],
+    )
+
+
+class Segment:
+    __slots__ = ("start", "direction", "end", "length", "tokens", "feed", "power", "item")
+
+    def __init__(self, start, end, tokens, feed, power, item):
+        self.start = start
+        delta = [e - s for s, e in zip(start, end)]
+        self.length = math.sqrt(sum(d * d for d in delta))
+        self.direction = [d / self.length for d in delta]
+        self.end = end  # Latest end point, None for axes never set
+        self.tokens = tokens  # Raw axis values of the latest end point
+        self.feed = feed
+        self.power = power
+        self.item = item  # (line_number, offset) of the last line merged in
+
+    def extend(self, end, tolerance):
+        # True when end lies further along the same straight line
+        delta = [e - s for s, e in zip(self.start, end)]
+        along = sum(d * u for d, u in zip(delta, self.direction))
+        if along <= self.length:
+            return False
+        off = sum((d - along * u) ** 2 for d, u in zip(delta, self.direction))
+        if off > tolerance * tolerance:
+            return False
+        self.length = along
+        return True
+
+
+class StreamCompressor:
+    # Rewrites cleaned lines on their way to the controller: words that repeat
+    # the modal state are dropped, and consecutive collinear G1 moves with the
+    # same feed and power are merged into one. Only plain G0/G1 lines in G90
+    # are touched; anything else passes through unchanged and makes the
+    # compressor forget what it cannot follow.
+    def __init__(self, tolerance=DEFAULT_TOLERANCE):
+        self.tolerance = tolerance
+        self.lines_in = 0
+        self.lines_out = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.reset()
+
+    def reset(self):
+        self.absolute = None
+        self.motion = None
+        self.feed = None
+        self.power = None
+        self.position = [None, None, None]
+        self.pending = None
+
+    def process(self, line_number, offset, command):
+        # Returns the (line_number, offset, command) items to send now
+        self.lines_in += 1
+        self.bytes_in += len(command) + 1
+        words = self.simple_words(command)
+        if words is None or not self.absolute:
+            out = self.take_pending()
+            self.follow(command)
+            return self.emit(out, (line_number, offset, command))
+
+        motion = words.get("G", self.pending_motion())
+        feed = float(words["F"]) if "F" in words else self.pending_feed()
+        power = float(words["S"]) if "S" in words else self.pending_power()
+        end = list(self.pending.end) if self.pending else list(self.position)
+        tokens = dict(self.pending.tokens) if self.pending else {}
+        for index, axis in enumerate(AXES):
+            if axis in words:
+                end[index] = float(words[axis])
+                tokens[axis] = words[axis]
+
+        pending = self.pending
+        if (
+            pending is not None
+            and motion == "1"
+            and feed == pending.feed
+            and power == pending.power
+            and comparable(pending.end, end) is not None
+            and pending.extend(comparable(pending.end, end)[1], self.tolerance)
+        ):
+            pending.end = end
+            pending.tokens = tokens
+            pending.item = (line_number, offset)
+            return []
+
+        out = self.take_pending()
+        points = comparable(self.position, end)
+        if motion == "1" and points is not None and points[0] != points[1]:
+            self.pending = Segment(*points, tokens, feed, power, (line_number, offset))
+            self.pending.end = end
+            return self.emit(out, None)
+        return self.emit(out, self.build(line_number, offset, motion, end, tokens, feed, power))
+
+    def flush(self):
+        # Sends the merged move still held back, at the end of a file
+        return self.emit(self.take_pending(), None)
+
+    def take_pending(self):
+        pending = self.pending
+        if pending is None:
+            return []
+        self.pending = None
+        line_number, offset = pending.item
+        item = self.build(
+            line_number, offset, "1", pending.end, pending.tokens, pending.feed, pending.power
+        )
+        return [item] if item else []
+
+    def emit(self, out, item):
+        if item:
+            out.append(item)
+        for _, _, command in out:
+            self.lines_out += 1
+            self.bytes_out += len(command) + 1
+        return out
+
+    # Modal state
+
+    def pending_motion(self):
+        return "1" if self.pending else self.motion
+
+    def pending_feed(self):
+        return self.pending.feed if self.pending else self.feed
+
+    def pending_power(self):
+        return self.pending.power if self.pending else self.power
+
+    def build(self, line_number, offset, motion, end, tokens, feed, power):
+        # Emits only the words that differ from what the controller has
+        words = []
+        if motion is not None and motion != self.motion:
+            words.append(f"G{motion}")
+        for index, axis in enumerate(AXES):
+            if axis in tokens and end[index] != self.position[index]:
+                words.append(f"{axis}{tokens[axis]}")
+        if feed is not None and feed != self.feed:
+            words.append(f"F{feed:g}")
+        if power is not None and power != self.power:
+            words.append(f"S{power:g}")
+        if motion is not None:
+            self.motion = motion
+        self.position = list(end)
+        self.feed = feed
+        self.power = power
+        if not words:
+            return None  # Nothing the controller does not already have
+        return (line_number, offset, " ".join(words))
+
+    def simple_words(self, command):
+        # {letter: raw value} for lines made only of G0/G1, XYZ, F and S
+        # words, each at most once; None for anything else
+        tokens = WORD_RE.findall(command.upper())
+        if "".join(letter + value for letter, value in tokens) != "".join(
+            command.upper().split()
+        ):
+            return None
+        words = {}
+        for letter, value in tokens:
+            if letter not in SIMPLE_LETTERS or letter in words:
+                return None
+            if letter == "G":
+                if float(value) not in (0, 1):
+                    return None
+                value = str(int(float(value)))
+            words[letter] = value
+        return words
+
+    def follow(self, command):
+        # Tracks what an unsimplified line does to the modal state
+        for letter, value in WORD_RE.findall(command.upper()):
+            number = float(value)
+            if letter == "G":
+                if number == 90:
+                    self.absolute = True
+                elif number == 91:
+                    self.absolute = False
+                elif number in (0, 1):
+                    self.motion = str(int(number))
+                elif number not in (17, 94):
+                    # Arcs, unit changes, offsets, homing and the like move
+                    # or re-map the position in ways not followed here
+                    self.motion = None
+                    self.position = [None, None, None]
+            elif letter in AXES:
+                self.position = [None, None, None]
+            elif letter == "F":
+                self.feed = number
+            elif letter == "S":
+                self.power = number
+
+    @property
+    def ratio(self):
+        return self.bytes_out / self.bytes_in if self.bytes_in else 1.0
@@ -0,0 +1,318 @@
+import os
+import json
+import time
+import fnmatch
+import threading
+
+# Settings come from, in order: the section of the machine on the port in
+# the config file, the top level of the config file, the environment (and
+# .env), then the defaults below. The file is re-read when it changes, and
+# settings marked live are picked up by a stream that is already running.
+CONFIG_FILE = "grbl_config.json"
+RELOAD_INTERVAL = 1.0  # Seconds between checks of the file while streaming
+
+TRUE_WORDS = ("1", "on", "true", "yes")
+FALSE_WORDS = ("0", "off", "false", "no")
+
+
+def parse_bool(value):
+    if isinstance(value, bool):
+        return value
+    text = str(value).strip().lower()
+    if text in TRUE_WORDS:
+        return True
+    if text in FALSE_WORDS:
+        return False
+    raise ValueError("expected on or off")
+
+
+def parse_switch(value):
+    # on, off or auto, as True, False or None
+    if str(value).strip().lower() == "auto":
+        return None
+    return parse_bool(value)
+
+
+def parse_choice(*choices):
+    def parse(value):
+        text = str(value).strip().lower()
+        if text not in choices:
+            raise ValueError(f"expected one of {', '.join(choices)}")
+        return text
+
+    return parse
+
+
+def parse_size(value):
+    # "width,height[,depth]" in mm, or a JSON list of the same
+    if isinstance(value, str):
+        value = value.split(",")
+    size = tuple(float(part) for part in value)
+    if len(size) not in (2, 3):
+        raise ValueError("expected width,height[,depth]")
+    return size
+
+
+def parse_positive(kind):
+    def parse(value):
+        number = kind(value)
+        if number <= 0:
+            raise ValueError("expected a positive number")
+        return number
+
+    return parse
+
+
+def parse_text(value):
+    return str(value).strip()
+
+
+class Setting:
+    def __init__(self, name, parse, default=None, live=False):
+        self.name = name
+        self.parse = parse
+        self.default = default
+        self.live = live  # A running stream picks up changes
+
+    @property
+    def env(self):
+        return self.name.upper()
+
+
+SETTINGS = {
+    setting.name: setting
+    for setting in (
+        Setting("port", parse_text),
+        Setting("baud_rate", parse_positive(int), 115200),
+        Setting("max_buffer_size", parse_positive(int)),
+        Setting("planner_reserve", parse_positive(int), live=True),
+        Setting("flow_control", parse_choice("adaptive", "fixed"), "adaptive", live=True),
+        Setting("min_poll_interval", parse_positive(float), 0.002, live=True),
+        Setting("status_refresh", parse_positive(float), 0.025, live=True),
+        Setting("estimate_refresh", parse_positive(float), 0.25, live=True),
+        Setting("stream_compress", parse_switch),
+        Setting("limit_check", parse_bool, True),
+        Setting("stock_size", parse_size),
+        Setting("work_transform", parse_text, ""),
+        Setting("metrics_file", parse_text),
+        Setting("metrics_port", parse_positive(int)),
+        Setting("metrics_interval", parse_positive(float), 5.0),
+        Setting("serial_trace_dir", parse_text),
+        Setting("reattach_timeout", parse_positive(float), 30.0),
+    )
+}
+
+
+def port_infos(refresh=False):
+    # {device: ListPortInfo} from the shared port watcher, which keeps it
+    # current while it runs and looks up each device only once
+    from utils.ports import port_watcher
+
+    watcher = port_watcher()
+    if refresh:
+        watcher.poll()
+    return watcher.infos
+
+
+def parse_usb_id(value):
+    # USB IDs are written in hex, "1a86" or "0x1a86"; JSON numbers are taken as is
+    return value if isinstance(value, int) else int(str(value), 16)
+
+
+def port_matches(match, port, info=None):
+    # match: {"vid", "pid", "serial", "port"}; every key given must fit
+    for key, wanted in match.items():
+        if key == "port":
+            if not fnmatch.fnmatch(port, str(wanted)):
+                return False
+        elif key in ("vid", "pid"):
+            if info is None or getattr(info, key) != parse_usb_id(wanted):
+                return False
+        elif key == "serial":
+            if info is None or info.serial_number != str(wanted):
+                return False
+        else:
+            raise ValueError(f"Unknown match key: {key}")
+    return True
+
+
+class Config:
+    def __init__(self, path=CONFIG_FILE):
+        self.path = path
+        self.data = {}
+        self.mtime = None
+        self.checked = time.monotonic()
+        self.version = 0  # Goes up with every load, for readers that cache
+        self.lock = threading.Lock()
+        self.warned = set()
+        self.load()
+
+    def load(self):
+        try:
+            self.mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            self.mtime = None
+            self.data = {}
+        else:
+            try:
+                with open(self.path, "r") as f:
+                    data = json.load(f)
+                if not isinstance(data, dict):
+                    raise ValueError("expected a JSON object")
+                self.data = data
+            except (OSError, ValueError) as e:
+                # Half-saved edits keep the last good settings
+                print(f"Ignoring {self.path}: {e}")
+        self.version += 1
+        self.warned.clear()
+
+    def reload(self):
+        # Re-reads the file if it changed, at most every RELOAD_INTERVAL.
+        # Cheap enough to call for every streamed line.
+        now = time.monotonic()
+        with self.lock:
+            if now - self.checked < RELOAD_INTERVAL:
+                return False
+            self.checked = now
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+            except OSError:
+                mtime = None
+            if mtime == self.mtime:
+                return False
+            self.load()
+        print(f"Reloaded {self.path}")
+        return True
+
+    @property
+    def machines(self):
+        machines = self.data.get("machines")
+        return machines if isinstance(machines, dict) else {}
+
+    def machine_for(self, port):
+        # (name, section) of the machine on port: named by PORT, or the first
+        # whose match fits the port's device name and USB identity
+        if not port:
+            return None, {}
+        if port in self.machines:
+            return port, self.machines[port]
+        for name, section in self.machines.items():
+            match = section.get("match")
+            if not match:
+                continue
+            try:
+                info = None
+                if set(match) - {"port"}:
+                    info = port_infos().get(port)
+                if port_matches(match, port, info):
+                    return name, section
+            except ValueError as e:
+                self.warn(f"machines.{name}.match", e)
+        return None, {}
+
+    def find_port(self, name):
+        # The attached device of a named machine, or None
+        match = self.machines.get(name, {}).get("match")
+        if not match:
+            return None
+        for port, info in port_infos().items():
+            try:
+                if port_matches(match, port, info):
+                    return port
+            except ValueError as e:
+                self.warn(f"machines.{name}.match", e)
+                return None
+        if set(match) == {"port"} and not any(c in str(match["port"]) for c in "*?["):
+            return match["port"]  # A fixed path, such as a pty or the emulator
+        return None
+
+    def get(self, name, port=None):
+        setting = SETTINGS[name]
+        machine_name, machine = self.machine_for(port)
+        sources = (
+            (machine, name, f"machines.{machine_name}.{name}"),
+            (self.data, name, f"{self.path}: {name}"),
+            (os.environ, setting.env, setting.env),
+        )
+        for source, key, label in sources:
+            value = source.get(key)
+            if value is None or value == "":
+                continue
+            try:
+                return setting.parse(value)
+            except (TypeError, ValueError) as e:
+                self.warn(label, f"{value!r}, {e}")
+        return setting.default
+
+    def warn(self, label, problem):
+        # Once per load, not for every line streamed
+        if label not in self.warned:
+            self.warned.add(label)
+            print(f"Ignoring invalid {label}: {problem}")
+
+
+class PortSettings:
+    # The settings of one port for a running stream. Settings marked live
+    # follow reloads of the file; the others keep the value first read, so
+    # they change with the next stream rather than halfway through this one.
+    def __init__(self, config, port=None):
+        self.config = config
+        self.port = port
+        self.version = config.version
+        self.fixed = {}
+
+    def get(self, name):
+        if SETTINGS[name].live:
+            return self.config.get(name, self.port)
+        if name not in self.fixed:
+            self.fixed[name] = self.config.get(name, self.port)
+        return self.fixed[name]
+
+    def changed(self):
+        # True once after the file changed
+        self.config.reload()
+        if self.version == self.config.version:
+            return False
+        self.version = self.config.version
+        return True
+
+
+_config = None
+
+
+def config():
+    global _config
+    if _config is None:
+        _config = Config(os.getenv("GRBL_CONFIG") or CONFIG_FILE)
+    return _config
+
+
+def get_setting(name, port=None):
+    return config().get(name, port)
+
+
+def settings_for(port=None):
+    return PortSettings(config(), port)
+
+
+def configured_port(ports=None):
+    # PORT (or "port" in the config file) is a 1-based index into the port
+    # list, a machine name from the config file, or a device path or
+    # "emulator" used as is. Without one, the first configured machine that
+    # is plugged in. None when nothing fits.
+    current = config()
+    value = current.get("port")
+    if value is None:
+        for name in current.machines:
+            port = current.find_port(name)
+            if port:
+                return port
+        return None
+    if value in current.machines:
+        return current.find_port(value)
+    if not value.isdigit():
+        return value
+    if ports is None:
+        ports = list(port_infos().values())
+    index = int(value) - 1
+    return ports[index].device if 0 <= index < len(ports) else None
@@ -0,0 +1,127 @@
+import os
+import time
+import serial
+from utils.config import get_setting
+from utils.machine_profile import load_profile
+from utils.metrics import metrics_from_env
+from utils.trace import trace_from_env
+from utils.emulator import EmulatedGrbl, is_emulator_port, emulator_speed
+
+
+class Connection:
+    def __init__(self, port, ser):
+        self.port = port
+        self.ser = ser
+        self.profile = None
+        self.metrics = None
+        self.awake = False  # GRBL is booted and its startup text flushed
+        self.was_reset = False  # The open rebooted GRBL, so its position is lost
+        self.in_use = False
+
+
+def clear_hupcl(ser):
+    # Without HUPCL the driver leaves DTR asserted when the port is closed, so
+    # the next open does not pulse DTR and reset the Arduino.
+    if os.name != "posix":
+        return
+    import termios
+
+    try:
+        fd = ser.fileno()
+        attrs = termios.tcgetattr(fd)
+        attrs[2] &= ~termios.HUPCL
+        termios.tcsetattr(fd, termios.TCSANOW, attrs)
+    except (AttributeError, OSError, termios.error):
+        pass
+
+
+def open_serial(port, baud_rate):
+    if is_emulator_port(port):
+        return EmulatedGrbl(port, emulator_speed(port))
+    ser = serial.Serial()
+    ser.port = port
+    ser.baudrate = baud_rate
+    # Keep DTR/RTS low so opening the port does not reset the controller
+    ser.dtr = False
+    ser.rts = False
+    ser.open()
+    clear_hupcl(ser)
+    return ser
+
+
+def ping(ser, timeout=0.5, attempts=3):
+    old_timeout = ser.timeout
+    ser.timeout = timeout
+    try:
+        ser.reset_input_buffer()
+        ser.write(b"?")
+        for _ in range(attempts):
+            grbl_out = ser.readline().strip()
+            if grbl_out.startswith(b"<"):
+                return True
+            if not grbl_out:
+                return False
+        return False
+    except serial.SerialException:
+        return False
+    finally:
+        try:
+            ser.timeout = old_timeout
+        except serial.SerialException:
+            pass
+
+
+class ConnectionManager:
+    def __init__(self, baud_rate=None):
+        self.baud_rate = baud_rate  # None for each port's configured rate
+        self.connections = {}
+        self.metrics = {}  # Kept per port so exporters survive a reopen
+
+    def open(self, port):
+        baud_rate = self.baud_rate or get_setting("baud_rate", port)
+        ser = trace_from_env(open_serial(port, baud_rate), port)
+        connection = Connection(port, ser)
+        # A controller that answers straight away was not reset by the open
+        connection.awake = ping(ser)
+        connection.was_reset = not connection.awake
+        connection.profile = load_profile(ser, port, awake=connection.awake)
+        if not connection.awake:
+            connection.awake = ping(ser)
+        if port not in self.metrics:
+            self.metrics[port] = metrics_from_env(port)
+        connection.metrics = self.metrics[port]
+        return connection
+
+    def acquire(self, port):
+        connection = self.connections.get(port)
+        if connection is not None and not ping(connection.ser):
+            print(f"Connection to {port} is not responding, reopening")
+            self.discard(connection)
+            connection = None
+        if connection is None:
+            connection = self.open(port)
+            self.connections[port] = connection
+        connection.in_use = True
+        return connection
+
+    def start_stream(self, connection):
+        # Returns whether the stream has to wake GRBL first
+        wake_up = not connection.awake
+        connection.awake = True
+        return wake_up
+
+    def release(self, connection):
+        connection.in_use = False
+
+    def discard(self, connection):
+        self.connections.pop(connection.port, None)
+        try:
+            connection.ser.close()
+        except serial.SerialException:
+            pass
+
+    def close_all(self):
+        for connection in list(self.connections.values()):
+            self.discard(connection)
+        # Give the driver a moment to release the ports before exiting
+        time.sleep(0.1)
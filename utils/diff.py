@@ -0,0 +1,173 @@
+from array import array
+import numpy as np
+from utils.gcode import ARC_CW, ARC_CCW, RAPID, GCodeState, iter_moves, parse_words
+from utils.transform import format_number
+
+# Moves closer than this (mm, and mm/min for feeds) count as the same
+DEFAULT_TOLERANCE = 0.001
+DEFAULT_SPINDLE_DELAY = 2.0  # s to dwell after starting the spindle
+# Plunge feed as a part of the cutting feed, when the program has no plunge
+PLUNGE_FEED_RATIO = 0.5
+
+
+# G-codes that move the program's coordinate system under it
+OFFSET_CODES = {10, 92}
+
+
+def program_heights(path):
+    # (highest Z in mm, mm per unit at the first cut, whether the program
+    # sets its own offsets with G10/G92), for picking a retract height
+    state = GCodeState()
+    offsets = False
+    top = None
+    scale = None
+
+    def scanned(file):
+        nonlocal offsets
+        for line in file:
+            if not offsets and any(
+                letter == "G" and round(value, 1) in OFFSET_CODES
+                for letter, value in parse_words(line)
+            ):
+                offsets = True
+            yield line
+
+    with open(path, "r") as file:
+        for move in iter_moves(scanned(file), state):
+            top = max(move.start[2], move.end[2], top if top is not None else -np.inf)
+            if scale is None and move.motion != RAPID:
+                scale = state.scale
+    return top, scale or state.scale, offsets
+
+
+def cut_moves(path):
+    # Yields (move, state) for every move that cuts; rapids only travel
+    state = GCodeState()
+    with open(path, "r") as file:
+        for move in iter_moves(file, state):
+            if move.motion != RAPID:
+                yield move, state
+
+
+def move_hash(move, state, tolerance):
+    # Quantized moves hash equal whatever the text looked like: word order,
+    # number formatting, modal words left out, G91 or inches
+    def q(value):
+        return int(round(value / tolerance))
+
+    center = move.center or (0.0, 0.0)
+    return hash(
+        (
+            move.motion,
+            q(move.start[0]),
+            q(move.start[1]),
+            q(move.start[2]),
+            q(move.end[0]),
+            q(move.end[1]),
+            q(move.end[2]),
+            q(center[0]),
+            q(center[1]),
+            q(move.feed),
+            q(state.power),
+        )
+    )
+
+
+def program_hashes(path, tolerance=DEFAULT_TOLERANCE):
+    # One int64 per cutting move, in file order
+    hashes = array("q")
+    for move, state in cut_moves(path):
+        hashes.append(move_hash(move, state, tolerance))
+    return np.frombuffer(hashes, dtype=np.int64)
+
+
+def counts_in(hashes, other):
+    # How many times each of hashes occurs in other
+    values, counts = np.unique(other, return_counts=True)
+    if not len(values):
+        return np.zeros(len(hashes), dtype=np.int64)
+    index = np.minimum(np.searchsorted(values, hashes), len(values) - 1)
+    return np.where(values[index] == hashes, counts[index], 0)
+
+
+def occurrences(hashes):
+    # 0 where a hash is seen the first time, 1 the second time, ...
+    order = np.argsort(hashes, kind="stable")
+    ordered = hashes[order]
+    positions = np.arange(len(hashes))
+    starts = np.ones(len(hashes), dtype=bool)
+    starts[1:] = ordered[1:] != ordered[:-1]
+    first = np.maximum.accumulate(np.where(starts, positions, 0))
+    ranks = np.empty(len(hashes), dtype=np.int64)
+    ranks[order] = positions - first
+    return ranks
+
+
+def diff_programs(old_path, new_path, tolerance=DEFAULT_TOLERANCE):
+    # Returns (changed, removed): a flag per cutting move of the new program
+    # that the old one does not have, and the number of old moves that are
+    # gone. Moves are counted, not just looked up: a segment the new program
+    # cuts twice and the old one once is changed the second time. Comparing
+    # is a few vectorized passes over the hashes, so the programs themselves
+    # are never held in memory.
+    old = program_hashes(old_path, tolerance)
+    new = program_hashes(new_path, tolerance)
+    changed = occurrences(new) >= counts_in(new, old)
+    old_values, old_counts = np.unique(old, return_counts=True)
+    removed = int(np.maximum(old_counts - counts_in(old_values, new), 0).sum())
+    return changed, removed
+
+
+def is_plunge(move):
+    return move.start[:2] == move.end[:2] and move.end[2] < move.start[2]
+
+
+def recut_lines(
+    new_path, changed, safe_z, plunge_feed=None, spindle_delay=DEFAULT_SPINDLE_DELAY
+):
+    # Yields a program, in mm, that cuts only the flagged moves. Each run of
+    # connected moves starts with a retract to safe_z (mm), a rapid to its start
+    # and a plunge, at plunge_feed or else at the feed of the program's last
+    # plunge before the run. A spindle started on the way gets spindle_delay
+    # seconds to come up to speed first.
+    yield "G21 G90 G17"
+    position = None
+    spindle = power = feed = None
+    program_plunge = None
+    for index, (move, state) in enumerate(cut_moves(new_path)):
+        if is_plunge(move) and move.feed:
+            program_plunge = move.feed
+        if not changed[index]:
+            continue
+        if position != move.start:
+            yield f"G0 Z{format_number(safe_z)}"
+            if state.spindle in (3, 4) and (state.spindle, state.power) != (spindle, power):
+                spindle, power = state.spindle, state.power
+                # S0 would stop a spindle the program runs at its last speed
+                yield f"M{spindle}" + (f" S{format_number(power)}" if power else "")
+                if spindle_delay:
+                    yield f"G4 P{format_number(spindle_delay)}"
+            yield f"G0 X{format_number(move.start[0])} Y{format_number(move.start[1])}"
+            plunge = f"G1 Z{format_number(move.start[2])}"
+            rate = plunge_feed or program_plunge or (move.feed or feed or 0) * PLUNGE_FEED_RATIO
+            if rate and rate != feed:
+                feed = rate
+                plunge += f" F{format_number(feed)}"
+            yield plunge
+        words = [f"G{move.motion}"]
+        for axis, value in zip("XYZ", move.end):
+            words.append(axis + format_number(value))
+        if move.motion in (ARC_CW, ARC_CCW):
+            words.append("I" + format_number(move.center[0] - move.start[0]))
+            words.append("J" + format_number(move.center[1] - move.start[1]))
+        if move.feed and move.feed != feed:
+            feed = move.feed
+            words.append("F" + format_number(feed))
+        if state.spindle in (3, 4) and state.power != power:
+            power = state.power
+            words.append("S" + format_number(power))
+        yield " ".join(words)
+        position = move.end
+    if position is not None:
+        yield f"G0 Z{format_number(safe_z)}"
+    yield "M5"
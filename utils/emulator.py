@@ -0,0 +1,324 @@
+import os
+import time
+import select
+import threading
+from collections import deque
+from utils.gcode import GCodeState, iter_moves, move_length
+
+EMULATOR_PORT = "emulator"
+VERSION = "1.1h.20190825"
+BANNER = b"\r\nGrbl 1.1h ['$' for help]\r\n"
+
+# Stock GRBL 1.1 settings for a small hobby machine
+DEFAULT_SETTINGS = {
+    0: 10,
+    1: 25,
+    2: 0,
+    3: 0,
+    4: 0,
+    5: 0,
+    6: 0,
+    10: 1,
+    11: 0.010,
+    12: 0.002,
+    13: 0,
+    20: 0,
+    21: 0,
+    22: 0,
+    23: 0,
+    24: 25.0,
+    25: 500.0,
+    26: 250,
+    27: 1.0,
+    30: 1000,
+    31: 0,
+    32: 0,
+    100: 250.0,
+    101: 250.0,
+    102: 250.0,
+    110: 500.0,
+    111: 500.0,
+    112: 500.0,
+    120: 10.0,
+    121: 10.0,
+    122: 10.0,
+    130: 200.0,
+    131: 200.0,
+    132: 200.0,
+}
+
+
+REALTIME_BYTES = b"?!~\x18"
+
+
+def is_emulator_port(port):
+    return port == EMULATOR_PORT or port.startswith(EMULATOR_PORT + ":")
+
+
+def emulator_speed(port):
+    # "emulator:20" runs motion twenty times faster than real time
+    _, _, speed = port.partition(":")
+    try:
+        return max(float(speed), 1e-3) if speed else 1.0
+    except ValueError:
+        return 1.0
+
+
+class EmulatedGrbl:
+    # Serial-like GRBL 1.1 stand-in: answers lines with ok/error, keeps a
+    # planner of timed moves, reports status and honours feed hold, resume and
+    # reset. Good enough to run the streamers and the API without a machine.
+    def __init__(
+        self,
+        port=EMULATOR_PORT,
+        speed=1.0,
+        planner_blocks=15,
+        rx_buffer_size=128,
+        settings=None,
+    ):
+        self.port = port
+        self.speed = speed
+        self.planner_blocks = planner_blocks
+        self.rx_buffer_size = rx_buffer_size
+        self.settings = dict(DEFAULT_SETTINGS if settings is None else settings)
+        self.timeout = 1
+        self.baudrate = 115200
+        self.dtr = False
+        self.rts = False
+        self.is_open = True
+        self.lock = threading.Lock()
+        self.output = deque()
+        self.partial = b""
+        self.reset()
+
+    def reset(self):
+        self.state = GCodeState()
+        self.position = [0.0, 0.0, 0.0]
+        self.planner = deque()  # [end position, seconds left, start position, duration]
+        self.pending = deque()  # Lines waiting for a free planner block
+        self.held = False
+        self.clock = time.monotonic()
+        self.output.append(BANNER)
+
+    # Motion
+
+    def advance(self):
+        now = time.monotonic()
+        elapsed = (now - self.clock) * self.speed
+        self.clock = now
+        if self.held:
+            return
+        while self.planner and elapsed > 0:
+            block = self.planner[0]
+            step = min(elapsed, block[1])
+            block[1] -= step
+            elapsed -= step
+            if block[1] <= 0:
+                self.planner.popleft()
+                self.position = list(block[0])
+        if self.planner:
+            end, left, start, duration = self.planner[0]
+            t = 1.0 - left / duration if duration else 1.0
+            self.position = [s + (e - s) * t for s, e in zip(start, end)]
+        while self.pending and len(self.planner) < self.planner_blocks:
+            self.execute(self.pending.popleft())
+
+    def queue_move(self, move):
+        if move.motion == 0:
+            feed = min(self.settings.get(110 + axis, 500.0) for axis in range(3))
+        else:
+            feed = move.feed
+        if not feed:
+            return False
+        duration = move_length(move) / feed * 60.0
+        start = self.planner[-1][0] if self.planner else tuple(self.position)
+        self.planner.append([move.end, duration, start, duration])
+        return True
+
+    def execute(self, line):
+        moves = list(iter_moves([line], self.state))
+        for move in moves:
+            if move.motion != 0 and not move.feed:
+                self.output.append(b"error:22\r\n")
+                return
+            self.queue_move(move)
+        self.output.append(b"ok\r\n")
+
+    # System commands
+
+    def system_command(self, line):
+        command = line[1:].upper()
+        if command == "I":
+            self.output.append(f"[VER:{VERSION}:]\r\n".encode())
+            self.output.append(
+                f"[OPT:V,{self.planner_blocks},{self.rx_buffer_size}]\r\n".encode()
+            )
+        elif command == "$":
+            for number, value in sorted(self.settings.items()):
+                self.output.append(f"${number}={value:g}\r\n".encode())
+        elif command == "H":
+            self.planner.clear()
+            self.position = [0.0, 0.0, 0.0]
+            self.state.position = [0.0, 0.0, 0.0]
+        elif "=" in command:
+            number, _, value = command.partition("=")
+            try:
+                self.settings[int(number)] = float(value)
+            except ValueError:
+                self.output.append(b"error:3\r\n")
+                return
+        self.output.append(b"ok\r\n")
+
+    def status_report(self):
+        if self.held:
+            state = "Hold:0"
+        elif self.planner:
+            state = "Run"
+        else:
+            state = "Idle"
+        mpos = ",".join(f"{value:.3f}" for value in self.position)
+        planner_free = self.planner_blocks - len(self.planner)
+        feed = self.state.feed if self.planner else 0
+        spindle = self.state.power if self.state.spindle in (3, 4) else 0
+        return (
+            f"<{state}|MPos:{mpos}|Bf:{planner_free},{self.rx_buffer_size}"
+            f"|FS:{feed:g},{spindle:g}|WCO:0.000,0.000,0.000>\r\n"
+        ).encode()
+
+    # Serial interface
+
+    def write(self, data):
+        with self.lock:
+            self.advance()
+            for byte in bytes(data):
+                char = bytes((byte,))
+                if char == b"?":
+                    self.output.append(self.status_report())
+                elif char == b"!":
+                    self.held = True
+                elif char == b"~":
+                    self.held = False
+                elif char == b"\x18":
+                    self.reset()
+                elif char == b"\n":
+                    line = self.partial.decode("utf-8", errors="replace").strip()
+                    self.partial = b""
+                    if not line:
+                        continue
+                    if line.startswith("$"):
+                        self.system_command(line)
+                    elif len(self.planner) < self.planner_blocks and not self.pending:
+                        self.execute(line)
+                    else:
+                        self.pending.append(line)
+                elif char != b"\r":
+                    self.partial += char
+            return len(data)
+
+    def readline(self):
+        deadline = time.monotonic() + (self.timeout if self.timeout is not None else 1e9)
+        while True:
+            with self.lock:
+                self.advance()
+                if self.output:
+                    return self.output.popleft()
+            if time.monotonic() >= deadline:
+                return b""
+            time.sleep(0.001)
+
+    def read(self, size=1):
+        return self.readline()[:size]
+
+    @property
+    def in_waiting(self):
+        with self.lock:
+            return sum(len(chunk) for chunk in self.output)
+
+    def reset_input_buffer(self):
+        with self.lock:
+            self.output.clear()
+
+    def reset_output_buffer(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def open(self):
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+
+class EmulatorPty:
+    # Serves an EmulatedGrbl on a pseudo terminal (POSIX only), so programs
+    # open it by path like a real port. Received lines are kept with their
+    # arrival time; real-time bytes are counted but not part of any line.
+    def __init__(self, speed=1.0, **options):
+        import pty
+        import tty
+
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)  # No echo or line editing
+        self.path = os.ttyname(self.slave)
+        self.device = EmulatedGrbl(EMULATOR_PORT, speed, **options)
+        self.device.timeout = 0.01
+        self.lines = []  # (monotonic time, line bytes)
+        self.realtime = 0
+        self.partial = b""
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.threads = [
+            threading.Thread(target=self.read_loop, daemon=True),
+            threading.Thread(target=self.write_loop, daemon=True),
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def read_loop(self):
+        while not self.stopped.is_set():
+            ready, _, _ = select.select([self.master], [], [], 0.05)
+            if not ready:
+                continue
+            try:
+                data = os.read(self.master, 4096)
+            except OSError:
+                return
+            now = time.monotonic()
+            with self.lock:
+                for byte in data:
+                    char = bytes((byte,))
+                    if char in REALTIME_BYTES:
+                        self.realtime += 1
+                    elif char == b"\n":
+                        self.lines.append((now, self.partial.rstrip(b"\r")))
+                        self.partial = b""
+                    else:
+                        self.partial += char
+            self.device.write(data)
+
+    def write_loop(self):
+        while not self.stopped.is_set():
+            data = self.device.readline()
+            if data:
+                try:
+                    os.write(self.master, data)
+                except OSError:
+                    return
+
+    def gcode_lines(self):
+        # What was streamed: lines other than blanks and $ system commands
+        with self.lock:
+            return [
+                (at, line)
+                for at, line in self.lines
+                if line.strip() and not line.startswith(b"$")
+            ]
+
+    def close(self):
+        self.stopped.set()
+        for thread in self.threads:
+            thread.join()
+        os.close(self.master)
+        os.close(self.slave)
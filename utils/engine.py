@@ -0,0 +1,263 @@
+import threading
+import serial
+from utils.config import get_setting, port_infos
+from utils.connection import ConnectionManager
+from utils.jobstore import default_store
+from utils.limits import precheck, pending_files
+from utils.machine import StreamProgress
+from utils.ports import port_identity, port_watcher
+from utils.recovery import GrblError, stream_resumable
+
+
+def describe(message):
+    # The line a front-end prints or shows for an event, None for no line
+    event = message["event"]
+    if event == "connected":
+        return f"Connected to {message['port']}"
+    if event == "limits":
+        return f"Not starting, files exceed the limits:\n{message['problems']}"
+    if event == "file_started":
+        return f"Processing: {default_store().display_name(message['file'])}"
+    if event == "file_finished":
+        return f"Finished processing: {default_store().display_name(message['file'])}"
+    if event == "job_run_finished":
+        job = message["job"]
+        return f"Job {job.id} finished run {job.completed} of {job.repeat or 'unlimited'}"
+    if event == "detached":
+        return f"Machine on {message['port']} unplugged, waiting for it to come back"
+    if event == "attached":
+        return f"Machine is back on {message['port']}"
+    if event == "error":
+        return message["message"]
+    if event == "stopped" and message["faults"]:
+        return f"Stream faults: {message['faults']}"
+    return None
+
+
+class StreamEngine:
+    # Streams one job at a time on its own thread; play.py, terminal.py, the
+    # GUI's worker process and server.py all drive one of these. Commands
+    # may come from any thread. Subscribers are called on the streaming
+    # thread with event dicts and must return quickly:
+    #
+    #   started, connected         {"port"}
+    #   limits                     {"problems"}, the job did not start
+    #   file_started, file_finished {"file", "index"}, index into the list
+    #   job_run_finished           {"job"}, a scheduler job ended a run
+    #   detached, attached         {"port"}, the job's USB machine was
+    #                              unplugged and came back, maybe on a new port
+    #   error                      {"message"}
+    #   stopped                    {"faults"}, always the last event of a job
+    def __init__(self, baud_rate=None, on_status=None, scheduler=None):
+        self.connections = ConnectionManager(baud_rate)
+        self.on_status = on_status  # Called with each status report, e.g. StatusWriter.publish
+        self.scheduler = scheduler  # Shared JobScheduler, or loaded from jobs.json per job
+        self.subscribers = []
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.port = None
+        self.files = None  # None while the job scheduler supplies the work
+        self.start_index = 0
+        self.finished = 0  # Files of the list streamed to the end in this job
+        self.loop = False
+        self.current_file = None
+        self.progress = StreamProgress()
+        self.held = False
+
+    def subscribe(self, callback):
+        with self.lock:
+            self.subscribers.append(callback)
+        return callback
+
+    def unsubscribe(self, callback):
+        with self.lock:
+            if callback in self.subscribers:
+                self.subscribers.remove(callback)
+
+    def emit(self, event, **fields):
+        with self.lock:
+            subscribers = list(self.subscribers)
+        message = {"event": event, **fields}
+        for callback in subscribers:
+            callback(message)
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    @property
+    def index(self):
+        # The list entry to start from next time, saved as current_index
+        if not self.files:
+            return 0
+        return (self.start_index + self.finished) % len(self.files)
+
+    def connect(self, port):
+        # Opens the port ahead of a job, for its machine profile
+        connection = self.connections.acquire(port)
+        self.connections.release(connection)
+        return connection
+
+    def submit(self, port, files=None, start_index=0, loop=False):
+        # Streams files (paths or job store refs) from start_index, over and
+        # over with loop. The list is read as the job goes, so files added to
+        # it meanwhile are streamed too. files None takes work from the job
+        # scheduler.
+        if self.running:
+            return False
+        self.port = port
+        self.files = files
+        self.start_index = start_index if self.files and start_index < len(self.files) else 0
+        self.finished = 0
+        self.loop = loop
+        self.held = False
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return True
+
+    def cancel(self):
+        # Stops once the current file is finished, so no part is left half cut
+        self.stop_event.set()
+        return True
+
+    @property
+    def cancelled(self):
+        return self.stop_event.is_set()
+
+    def realtime(self, command):
+        connection = self.connections.connections.get(self.port)
+        if connection is None:
+            return False
+        connection.ser.write(command)
+        return True
+
+    def pause(self):
+        # Feed hold; the planner keeps its moves and resume carries on
+        self.held = self.realtime(b"!") or self.held
+        return self.held
+
+    def resume(self):
+        if self.realtime(b"~"):
+            self.held = False
+            return True
+        return False
+
+    def wait(self, timeout=None):
+        # True once the job has ended
+        if self.thread is not None:
+            self.thread.join(timeout)
+        return not self.running
+
+    def close(self):
+        self.cancel()
+        self.wait()
+        self.connections.close_all()
+
+    def queued_files(self):
+        # Restarts at the first file not finished yet, which is where a
+        # resume after a dropped link has to pick up
+        store = default_store()
+        count = self.finished
+        while (
+            not self.stop_event.is_set()
+            and self.files
+            and (self.loop or count < len(self.files))
+        ):
+            yield store.resolve(self.files[(self.start_index + count) % len(self.files)])
+            count += 1
+
+    def run(self):
+        port = self.port
+        progress = self.progress = StreamProgress()
+        scheduled = None
+        # A USB machine is followed by its identity, so a replug finds it
+        # again from the watcher's cache, whatever device it comes back as
+        identity = port_identity(port_infos().get(port))
+        watcher = port_watcher().start() if identity is not None else None
+
+        def on_port(message):
+            if port_identity(message["info"]) == identity:
+                self.emit(message["event"], port=message["port"])
+
+        def reattach(old_port):
+            moved = watcher.wait_for(identity, get_setting("reattach_timeout", old_port))
+            if moved is not None:
+                self.port = moved
+            return moved
+
+        if watcher is not None:
+            watcher.subscribe(on_port)
+        self.emit("started", port=port)
+        try:
+            connection = self.connections.acquire(port)
+            self.emit("connected", port=port)
+            if self.files is None:
+                from utils.scheduler import JobScheduler, ScheduledStream
+
+                scheduler = self.scheduler
+                if scheduler is None:
+                    scheduler = JobScheduler()
+                    scheduler.load()
+                problems = precheck(pending_files(scheduler, port), connection.profile)
+            else:
+                problems = precheck(self.files, connection.profile)
+            if problems:
+                self.emit("limits", problems=problems)
+                return
+
+            if self.files is None:
+                scheduled = ScheduledStream(scheduler, port)
+
+                def make_paths():
+                    return scheduled.files(self.stop_event.is_set)
+
+            else:
+                make_paths = self.queued_files
+
+            def on_file_start(file):
+                self.current_file = file
+                self.emit("file_started", file=file, index=self.index)
+
+            def on_file_done(file):
+                index = self.index
+                self.finished += 1
+                self.emit("file_finished", file=file, index=index)
+                if scheduled is not None:
+                    job = scheduled.file_done(file, progress.file_stats.failures)
+                    if job is not None:
+                        self.emit("job_run_finished", job=job)
+
+            # Reconnects on its own and resumes after the last acknowledged line
+            stream_resumable(
+                self.connections,
+                port,
+                make_paths,
+                on_file_start,
+                on_file_done,
+                self.stop_event.is_set,
+                self.on_status,
+                progress,
+                reattach=reattach if watcher is not None else None,
+            )
+        except serial.SerialException as e:
+            self.emit("error", message=f"Serial communication error: {e}")
+            connection = self.connections.connections.get(self.port)
+            if connection:
+                self.connections.discard(connection)
+        except GrblError as e:
+            self.emit("error", message=f"Job stopped: {e}")
+        except (OSError, ValueError) as e:
+            # A file that is missing, unreadable or cannot be transformed
+            self.emit("error", message=f"Job stopped: {e}")
+        finally:
+            if watcher is not None:
+                watcher.unsubscribe(on_port)
+            if scheduled is not None:
+                scheduled.cancel()
+            connection = self.connections.connections.get(self.port)
+            if connection:
+                self.connections.release(connection)
+            self.held = False
+            self.emit("stopped", faults=progress.stats.summary() if progress.stats.failures else None)
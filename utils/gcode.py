@@ -0,0 +1,278 @@
+import os
+import re
+import math
+import contextlib
+from collections import namedtuple
+
+MM_PER_INCH = 25.4
+
+RAPID = 0
+LINEAR = 1
+ARC_CW = 2
+ARC_CCW = 3
+
+# start/end are absolute (x, y, z) work coordinates in mm; center is the
+# absolute (x, y) arc center for G2/G3 in the XY plane, otherwise None.
+Move = namedtuple("Move", "line motion start end center feed")
+
+WORD_RE = re.compile(r"([A-Z])\s*([-+]?(?:\d+\.?\d*|\.\d+))")
+COMMENT_RE = re.compile(r"\([^)]*\)")
+
+# G-codes whose axis words are not a move in the current motion mode
+NON_MOTION_AXIS_CODES = {4, 10, 28, 30, 53, 92}
+
+
+def strip_comments(line):
+    if ";" in line:
+        line = line[: line.index(";")]
+    if "(" in line:
+        line = COMMENT_RE.sub("", line)
+    return line
+
+
+def parse_words(line):
+    return [
+        (letter, float(value))
+        for letter, value in WORD_RE.findall(strip_comments(line).upper())
+    ]
+
+
+class GCodeState:
+    def __init__(self):
+        self.position = [0.0, 0.0, 0.0]
+        self.motion = RAPID
+        self.absolute = True
+        self.scale = 1.0  # G21 mm; 25.4 under G20
+        self.feed = 0.0
+        self.plane = 17
+        self.spindle = None  # M3/M4/M5
+        self.power = 0.0  # S word
+
+
+def arc_center(start, end, words, state, motion):
+    if "I" in words or "J" in words:
+        # IJ are always incremental from the arc start (G91.1)
+        return (
+            start[0] + words.get("I", 0.0) * state.scale,
+            start[1] + words.get("J", 0.0) * state.scale,
+        )
+    if "R" not in words:
+        return None
+    radius = words["R"] * state.scale
+    dx = end[0] - start[0]
+    dy = end[1] - start[1]
+    chord = math.hypot(dx, dy)
+    if chord == 0 or abs(radius) < chord / 2:
+        return None
+    offset = math.sqrt(radius * radius - chord * chord / 4) / chord
+    # Negative R selects the long way round; CW arcs put the center on the right
+    if (motion == ARC_CW) != (radius < 0):
+        offset = -offset
+    return (
+        start[0] + dx / 2 - offset * dy,
+        start[1] + dy / 2 + offset * dx,
+    )
+
+
+def iter_moves(lines, state=None):
+    if state is None:
+        state = GCodeState()
+
+    for line_number, line in enumerate(lines, 1):
+        words = parse_words(line)
+        if not words:
+            continue
+
+        axes = {}
+        skip_axes = False
+        for letter, value in words:
+            if letter == "G":
+                code = round(value, 1)
+                if code in (0, 1, 2, 3):
+                    state.motion = int(code)
+                elif code in (17, 18, 19):
+                    state.plane = int(code)
+                elif code == 20:
+                    state.scale = MM_PER_INCH
+                elif code == 21:
+                    state.scale = 1.0
+                elif code == 90:
+                    state.absolute = True
+                elif code == 91:
+                    state.absolute = False
+                elif code in NON_MOTION_AXIS_CODES:
+                    skip_axes = True
+            elif letter == "M":
+                if value in (3, 4, 5):
+                    state.spindle = int(value)
+            elif letter == "F":
+                state.feed = value * state.scale
+            elif letter == "S":
+                state.power = value
+            else:
+                axes[letter] = value
+
+        if skip_axes or not ("X" in axes or "Y" in axes or "Z" in axes):
+            continue
+
+        start = tuple(state.position)
+        end = list(start)
+        for index, letter in enumerate("XYZ"):
+            if letter in axes:
+                value = axes[letter] * state.scale
+                end[index] = value if state.absolute else end[index] + value
+        end = tuple(end)
+
+        center = None
+        motion = state.motion
+        if motion in (ARC_CW, ARC_CCW):
+            if state.plane == 17:
+                center = arc_center(start, end, axes, state, motion)
+            if center is None:
+                motion = LINEAR  # Unsupported plane or malformed arc
+
+        state.position = list(end)
+        yield Move(line_number, motion, start, end, center, state.feed)
+
+
+def open_program(path):
+    # Lines of a file, or of the expanded program for a multi-pass or tiled
+    # spec ("part.ngc#passes=3,0.5", "part.ngc#tile=3,2,60,40", see utils.passes)
+    from utils.passes import is_spec, open_spec
+
+    if is_spec(path):
+        return contextlib.nullcontext(open_spec(path).lines())
+    return open(path, "r")
+
+
+def program_size(path):
+    from utils.passes import is_spec, open_spec
+
+    return open_spec(path).size if is_spec(path) else os.path.getsize(path)
+
+
+def iter_file_moves(path, state=None):
+    with open_program(path) as file:
+        yield from iter_moves(file, state)
+
+
+def arc_angles(move):
+    cx, cy = move.center
+    start_angle = math.atan2(move.start[1] - cy, move.start[0] - cx)
+    end_angle = math.atan2(move.end[1] - cy, move.end[0] - cx)
+    if move.motion == ARC_CW:
+        if end_angle >= start_angle:
+            end_angle -= 2 * math.pi
+    elif end_angle <= start_angle:
+        end_angle += 2 * math.pi
+    return start_angle, end_angle
+
+
+def arc_points(move, max_angle=math.radians(5)):
+    cx, cy = move.center
+    radius = math.hypot(move.start[0] - cx, move.start[1] - cy)
+    start_angle, end_angle = arc_angles(move)
+    sweep = end_angle - start_angle
+    segments = max(1, int(math.ceil(abs(sweep) / max_angle)))
+    z0 = move.start[2]
+    dz = move.end[2] - z0
+    points = []
+    for step in range(1, segments):
+        t = step / segments
+        angle = start_angle + sweep * t
+        points.append(
+            (cx + radius * math.cos(angle), cy + radius * math.sin(angle), z0 + dz * t)
+        )
+    points.append(move.end)
+    return points
+
+
+def arc_extents(move):
+    # Exact (low, high) of an XY arc: its end points plus every quadrant
+    # point the sweep passes through
+    cx, cy = move.center
+    radius = math.hypot(move.start[0] - cx, move.start[1] - cy)
+    low = [min(a, b) for a, b in zip(move.start, move.end)]
+    high = [max(a, b) for a, b in zip(move.start, move.end)]
+    first, last = sorted(arc_angles(move))
+    quadrant = math.ceil(first / (math.pi / 2))
+    while quadrant * (math.pi / 2) <= last:
+        dx, dy = ((1, 0), (0, 1), (-1, 0), (0, -1))[quadrant % 4]
+        x, y = cx + radius * dx, cy + radius * dy
+        low[0], high[0] = min(low[0], x), max(high[0], x)
+        low[1], high[1] = min(low[1], y), max(high[1], y)
+        quadrant += 1
+    return low, high
+
+
+def move_length(move):
+    if move.center is None:
+        return math.dist(move.start, move.end)
+    cx, cy = move.center
+    radius = math.hypot(move.start[0] - cx, move.start[1] - cy)
+    start_angle, end_angle = arc_angles(move)
+    planar = radius * abs(end_angle - start_angle)
+    return math.hypot(planar, move.end[2] - move.start[2])
+
+
+# Stock GRBL $110-$112, used to time rapids when the machine is unknown
+DEFAULT_RAPID_RATE = 500.0
+DEFAULT_RAPID_RATES = (DEFAULT_RAPID_RATE,) * 3
+SUMMARY_VERSION = 3  # Bumped when file_summary changes, so cached summaries are redone
+
+
+def rapid_time(move, rapid_rates):
+    # Minutes for a G0: GRBL slows the move until no axis is over its max rate
+    return max(abs(b - a) / rate for a, b, rate in zip(move.start, move.end, rapid_rates))
+
+
+def file_summary(path, rapid_rates=None):
+    # One streaming pass over a file: size, line count, XYZ bounds, rapid and
+    # cutting distance, arc count and a feed-rate-only time estimate, with
+    # rapids at the machine's $110-$112 when they are given.
+    rapid_rates = rapid_rates or DEFAULT_RAPID_RATES
+    lines = 0
+
+    def counted(file):
+        nonlocal lines
+        for line in file:
+            lines += 1
+            yield line
+
+    low = [math.inf] * 3
+    high = [-math.inf] * 3
+    rapid = cut = seconds = 0.0
+    arcs = 0
+    with open_program(path) as file:
+        for move in iter_moves(counted(file)):
+            if move.center is not None:
+                arcs += 1
+                move_low, move_high = arc_extents(move)
+            else:
+                move_low = move_high = None
+            for axis in range(3):
+                if move_low is None:
+                    a, b = move.start[axis], move.end[axis]
+                    lo, hi = (a, b) if a < b else (b, a)
+                else:
+                    lo, hi = move_low[axis], move_high[axis]
+                low[axis] = min(low[axis], lo)
+                high[axis] = max(high[axis], hi)
+            length = move_length(move)
+            if move.motion == RAPID:
+                rapid += length
+                seconds += rapid_time(move, rapid_rates) * 60.0
+            else:
+                cut += length
+                if move.feed:
+                    seconds += length / move.feed * 60.0
+    bounds = None if low[0] == math.inf else (tuple(low), tuple(high))
+    return {
+        "lines": lines,
+        "bytes": program_size(path),
+        "bounds": bounds,
+        "rapid_distance": rapid,
+        "cut_distance": cut,
+        "arcs": arcs,
+        "estimated_time": seconds,
+    }
@@ -0,0 +1,192 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from utils.gcode import SUMMARY_VERSION, file_summary
+from utils.passes import describe_spec, join_spec, split_spec
+
+STORE_DIR = "job_store"
+INDEX_FILE = "index.json"
+REF_PREFIX = "sha256:"
+CHUNK_SIZE = 64 * 1024
+
+
+def is_ref(value):
+    return isinstance(value, str) and value.startswith(REF_PREFIX)
+
+
+class Ingest:
+    # Writes a file into the store chunk by chunk, hashing as it goes, so an
+    # upload of any size only ever holds one chunk in memory.
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+        self.hash = hashlib.sha256()
+        self.size = 0
+        os.makedirs(store.tmp_dir, exist_ok=True)
+        self.tmp_path = os.path.join(
+            store.tmp_dir, f"{os.getpid()}-{threading.get_ident()}-{time.monotonic_ns()}"
+        )
+        self.file = open(self.tmp_path, "wb")
+
+    def write(self, chunk):
+        self.hash.update(chunk)
+        self.file.write(chunk)
+        self.size += len(chunk)
+
+    def finish(self):
+        self.file.close()
+        return self.store.commit(self.tmp_path, self.hash.hexdigest(), self.name)
+
+    def abort(self):
+        self.file.close()
+        try:
+            os.remove(self.tmp_path)
+        except OSError:
+            pass
+
+
+class JobStore:
+    # Files are stored once under their SHA-256 and referenced as
+    # "sha256:<hex>". The index keeps the parsed metadata, so a file is only
+    # analysed the first time its content is seen.
+    def __init__(self, root=STORE_DIR):
+        self.root = root
+        self.objects_dir = os.path.join(root, "objects")
+        self.tmp_dir = os.path.join(root, "tmp")
+        self.index_path = os.path.join(root, INDEX_FILE)
+        self.lock = threading.RLock()
+        self.index = None
+
+    def load(self):
+        with self.lock:
+            if self.index is None:
+                try:
+                    with open(self.index_path, "r") as f:
+                        self.index = json.load(f)
+                except (OSError, json.JSONDecodeError):
+                    self.index = {}
+            return self.index
+
+    def save(self):
+        with self.lock:
+            os.makedirs(self.root, exist_ok=True)
+            tmp_path = self.index_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self.index, f, indent=1)
+            os.replace(tmp_path, self.index_path)
+
+    def object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest + ".gcode")
+
+    def open_ingest(self, name):
+        return Ingest(self, os.path.basename(name))
+
+    def add(self, path):
+        ingest = self.open_ingest(path)
+        try:
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                    ingest.write(chunk)
+        except BaseException:
+            ingest.abort()
+            raise
+        return ingest.finish()
+
+    def commit(self, tmp_path, digest, name):
+        ref = REF_PREFIX + digest
+        path = self.object_path(digest)
+        with self.lock:
+            index = self.load()
+            if os.path.exists(path):
+                os.remove(tmp_path)  # Same content is already stored
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmp_path, path)
+            if index.get(digest) is None:
+                entry = file_summary(path)
+                entry["name"] = name
+                entry["added"] = time.time()
+                entry["version"] = SUMMARY_VERSION
+                index[digest] = entry
+                self.save()
+            else:
+                self.summarize(digest)
+        return ref
+
+    def summarize(self, digest):
+        # Entries from an older file_summary are parsed again, once
+        with self.lock:
+            entry = self.load()[digest]
+            if entry.get("version") != SUMMARY_VERSION:
+                entry.update(file_summary(self.object_path(digest)))
+                entry["version"] = SUMMARY_VERSION
+                self.save()
+            return entry
+
+    def digest(self, ref):
+        return ref[len(REF_PREFIX) :]
+
+    def path(self, ref):
+        return self.object_path(self.digest(ref))
+
+    def meta(self, ref):
+        digest = self.digest(ref)
+        if digest not in self.load():
+            return None
+        try:
+            return self.summarize(digest)
+        except OSError:
+            return None  # The stored copy is gone
+
+    def name(self, ref):
+        entry = self.load().get(self.digest(ref))
+        return entry["name"] if entry else ref[: len(REF_PREFIX) + 12]
+
+    def resolve(self, value):
+        # Queue entries are refs, or plain paths from before the store existed;
+        # either may carry multi-pass and tiling options (see utils.passes)
+        value, options = split_spec(value)
+        path = self.path(value) if is_ref(value) else value
+        return join_spec(path, options)
+
+    def display_name(self, value):
+        # Original file name for refs and for paths of stored copies
+        value, options = split_spec(value)
+        if is_ref(value):
+            name = self.name(value)
+        elif os.path.dirname(os.path.dirname(value)) == self.objects_dir:
+            digest = os.path.splitext(os.path.basename(value))[0]
+            name = self.name(REF_PREFIX + digest)
+        else:
+            name = value
+        return name + describe_spec(options)
+
+    def remove(self, ref):
+        with self.lock:
+            digest = self.digest(ref)
+            if self.load().pop(digest, None) is None:
+                return False
+            try:
+                os.remove(self.object_path(digest))
+            except OSError:
+                pass
+            self.save()
+            return True
+
+
+_default_store = None
+
+
+def default_store():
+    global _default_store
+    if _default_store is None:
+        _default_store = JobStore()
+    return _default_store
+
+
+def resolve(value):
+    if not is_ref(value):
+        return value
+    return default_store().resolve(value)
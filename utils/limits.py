@@ -0,0 +1,88 @@
+from utils.analysis import analyze_files
+from utils.config import get_setting
+from utils.jobstore import default_store
+from utils.transform import transform_from_env
+
+AXES = "XYZ"
+# Rounding in generated files should not block a job that touches the edge
+LIMIT_TOLERANCE = 0.001  # mm
+
+
+def limit_check_enabled(port=None):
+    return get_setting("limit_check", port)
+
+
+def stock_from_env(port=None):
+    # STOCK_SIZE="width,height[,depth]" in mm, with the work origin at the
+    # front left corner of the stock's top surface
+    return get_setting("stock_size", port)
+
+
+def check_bounds(bounds, travel=(), stock=None):
+    # Returns what is wrong with a file's (low, high) extents, in mm
+    problems = []
+    if bounds is None:
+        return problems
+    low, high = bounds
+    for axis, limit in enumerate(travel):
+        span = high[axis] - low[axis]
+        if limit and span > limit + LIMIT_TOLERANCE:
+            problems.append(f"{AXES[axis]} spans {span:.3f} mm, machine travel is {limit:g} mm")
+    if stock:
+        for axis, size in enumerate(stock[:2]):
+            if low[axis] < -LIMIT_TOLERANCE or high[axis] > size + LIMIT_TOLERANCE:
+                problems.append(
+                    f"{AXES[axis]} {low[axis]:.3f}..{high[axis]:.3f} mm leaves the "
+                    f"{size:g} mm stock"
+                )
+        if len(stock) > 2 and low[2] < -stock[2] - LIMIT_TOLERANCE:
+            problems.append(f"Z goes down to {low[2]:.3f} mm, the stock is {stock[2]:g} mm thick")
+    return problems
+
+
+def check_files(files, profile=None, stock=None):
+    # Returns {file: [problems]} for the files that do not fit. Extents come
+    # from the cached analysis, so files already seen are not read again.
+    travel = profile.max_travel if profile else ()
+    port = profile.port if profile else None
+    if stock is None:
+        stock = stock_from_env(port)
+    if not any(travel) and not stock:
+        return {}
+    files = list(dict.fromkeys(files))
+    transform = transform_from_env(port)  # Files are checked where they will run
+    results = analyze_files(files, profile=profile)  # Shares the report's cache entries
+    failed = {}
+    for file in files:
+        summary = results.get(file)
+        if not isinstance(summary, dict):
+            failed[file] = [f"Could not read: {summary}"]
+            continue
+        bounds = summary["bounds"]
+        if transform is not None and bounds is not None:
+            bounds = transform.bounds(bounds)
+        problems = check_bounds(bounds, travel, stock)
+        if problems:
+            failed[file] = problems
+    return failed
+
+
+def format_problems(failed):
+    store = default_store()
+    lines = []
+    for file, problems in failed.items():
+        lines.append(f"{store.display_name(file)}:")
+        lines.extend(f"  {problem}" for problem in problems)
+    return "\n".join(lines)
+
+
+def precheck(files, profile=None):
+    # None when the files may run, otherwise the report of what does not fit
+    if not limit_check_enabled(profile.port if profile else None):
+        return None
+    failed = check_files(files, profile)
+    return format_problems(failed) if failed else None
+
+
+def pending_files(scheduler, port=None):
+    return [file for job in scheduler.pending(port) for file in job.files()]
@@ -1,57 +1,372 @@
+import re
 import time
-from threading import Event
+from utils.config import settings_for
+from utils.gcode import program_size
+from utils.recovery import (
+    GrblAlarm,
+    GrblError,
+    RecoveryStats,
+    classify_error,
+    error_code,
+    FATAL,
+    RETRY,
+    MAX_LINE_RETRIES,
+    moves_axes,
+)
 
 
-def stream_gcode(ser, gcode_path):
-    def remove_comment(string):
-        if ";" in string:
-            return string[: string.index(";")]
-        return string
+def remove_comment(string):
+    if ";" in string:
+        return string[: string.index(";")]
+    return string
 
-    def remove_eol_chars(string):
-        return string.strip().replace("%", "")
 
-    def send_wake_up(ser):
-        ser.write(b"\r\n\r\n")
-        time.sleep(2)  # Wait for GRBL to initialize
-        ser.reset_input_buffer()  # Flush startup text in serial input
+def remove_eol_chars(string):
+    return string.strip().replace("%", "")
 
-    def get_buffer_status(ser):
+
+def clean_line(line):
+    return remove_eol_chars(remove_comment(line))
+
+
+def send_wake_up(ser):
+    ser.write(b"\r\n\r\n")
+    time.sleep(2)  # Wait for GRBL to initialize
+    ser.reset_input_buffer()  # Flush startup text in serial input
+
+
+def parse_status(report):
+    # <Run|MPos:1.000,2.000,0.000|Bf:15,128|FS:500,0|WCO:0.000,0.000,0.000>
+    parts = report.strip().strip("<>").split("|")
+    status = {"state": parts[0]}
+    for part in parts[1:]:
+        key, _, value = part.partition(":")
+        try:
+            status[key] = tuple(float(field) for field in value.split(","))
+        except ValueError:
+            status[key] = value
+    return status
+
+
+# Fixed flow control waits this long, in seconds, whenever the planner is full
+FIXED_POLL_INTERVAL = 0.1
+# An arc is split into many planner blocks, so after one the count is unknown
+ARC_WORDS_RE = re.compile(r"[IJR]", re.IGNORECASE)
+
+
+class FlowControl:
+    # Paces sending against the planner. GRBL acks a line once it is in the
+    # planner, so after an ok the planner holds at most one block more than
+    # at the last Bf: report. The estimate is counted down per line and a
+    # `?` round trip is only made when the reserve may be used up or status
+    # is due. While the planner is full the wait is about one block's run
+    # time, learned from how fast Bf: recovered between reports, instead of
+    # a fixed 100 ms that leaves short moves starved. Send-and-wait keeps at
+    # most one line in the RX buffer, so Bf: planner blocks are what limit.
+    # The tunables come from the port's settings (see utils.config) and are
+    # picked up again while streaming when the config file changes.
+    def __init__(
+        self, min_free_blocks=3, metrics=None, on_status=None, settings=None, planner_blocks=None
+    ):
+        self.profile_free_blocks = min_free_blocks
+        self.planner_blocks = planner_blocks
+        self.metrics = metrics
+        self.on_status = on_status
+        self.settings = settings or settings_for()
+        self.configure()
+        self.planner_free = None  # Estimate, None when a poll is needed
+        self.rx_free = None
+        self.block_time = self.min_poll_interval * 4  # Seconds per finished block
+        self.report = None  # (time, planner free, lines since) at the last poll
+        self.lines = 0
+        self.polls = 0
+        self.waited = 0.0
+        self.started = time.perf_counter()
+
+    def configure(self):
+        settings = self.settings
+        self.min_free_blocks = settings.get("planner_reserve") or self.profile_free_blocks
+        if self.planner_blocks and self.min_free_blocks >= self.planner_blocks:
+            # The planner would never report more free blocks than that, and
+            # the stream would poll forever
+            reserve = self.planner_blocks - 1
+            settings.config.warn(
+                "planner_reserve",
+                f"{self.min_free_blocks}, the planner has {self.planner_blocks} blocks; "
+                f"using {reserve}",
+            )
+            self.min_free_blocks = reserve
+        self.adaptive = settings.get("flow_control") == "adaptive"
+        self.min_poll_interval = settings.get("min_poll_interval")
+        # Status often enough for live progress when someone shows it,
+        # otherwise only to keep the estimate honest
+        self.refresh = settings.get("status_refresh" if self.on_status else "estimate_refresh")
+
+    def poll(self, ser):
+        # One status round trip; the planner's free blocks, or None
         ser.reset_input_buffer()
         ser.write(b"?")
         grbl_out = ser.readline().strip().decode("utf-8")
-        if grbl_out.startswith("<"):
-            parts = grbl_out.split("|")
-            for part in parts:
-                if part.startswith("Bf:"):
-                    buffer_info = part.split(":")[1].split(",")
-                    available_buffer_slots = int(buffer_info[0])
-                    # print("Available buffer slots:", available_buffer_slots)
-                    return available_buffer_slots > 3
-        return False
-
-    def wait_for_buffer(ser):
-        while not get_buffer_status(ser):
-            Event().wait(0.1)  # Wait a bit before checking again
-
-    def send_command(ser, command):
-        ser.write(command.encode() + b"\n")
-        while True:
-            grbl_out = ser.readline().strip().decode("utf-8")
-            if grbl_out == "ok":
+        self.polls += 1
+        if self.metrics:
+            self.metrics.observe_poll()
+        if not grbl_out.startswith("<"):
+            return None
+        if self.on_status:
+            self.on_status(grbl_out)
+        for part in grbl_out.split("|"):
+            if part.startswith("Bf:"):
+                buffer_info = part.split(":")[1].strip(">").split(",")
+                planner_free = int(buffer_info[0])
+                self.rx_free = int(buffer_info[1]) if len(buffer_info) > 1 else None
+                if self.metrics:
+                    self.metrics.observe_buffer(planner_free, self.rx_free)
+                self.learn(planner_free)
+                return planner_free
+        return None
+
+    def learn(self, planner_free):
+        # Block time is measured from the last report at which blocks had
+        # finished, so polling faster than blocks run does not shorten it
+        now = time.perf_counter()
+        self.planner_free = planner_free
+        if self.report is not None:
+            then, free_then, lines = self.report
+            # Lines acked since add at most a block each
+            finished = planner_free - free_then + lines
+            if finished <= 0:
+                self.report = (then, planner_free, 0)
                 return
-            if grbl_out.startswith("error"):
-                print(f"Error: {grbl_out}")
+            if planner_free <= self.min_free_blocks + 1:
+                # Only a busy planner says how long blocks take
+                sample = (now - then) / finished
+                self.block_time += 0.3 * (sample - self.block_time)
+        self.report = (now, planner_free, 0)
+
+    def line_acked(self, command):
+        self.lines += 1
+        if self.report is not None:
+            then, free_then, lines = self.report
+            self.report = (then, free_then, lines + 1)
+        if self.planner_free is not None:
+            self.planner_free -= 1
+            if ARC_WORDS_RE.search(command):
+                self.planner_free = None
+
+    def wait(self, ser, command):
+        # Call after each acknowledged line; returns once it is time to send
+        if self.settings.changed():
+            self.configure()
+            print(self.describe())
+        self.line_acked(command)
+        if (
+            self.adaptive
+            and self.planner_free is not None
+            and self.planner_free > self.min_free_blocks
+            and time.perf_counter() - self.report[0] < self.refresh
+        ):
+            return
+        while True:
+            planner_free = self.poll(ser)
+            if planner_free is not None and planner_free > self.min_free_blocks:
                 return
+            delay = self.delay(planner_free)
+            time.sleep(delay)
+            self.waited += delay
+
+    def delay(self, planner_free):
+        if not self.adaptive or planner_free is None:
+            return FIXED_POLL_INTERVAL
+        # Until enough blocks have run to get back above the reserve
+        blocks = self.min_free_blocks + 1 - planner_free
+        return min(max(self.block_time * blocks, self.min_poll_interval), self.refresh)
+
+    def describe(self):
+        if not self.adaptive:
+            return f"Flow control: fixed, {self.min_free_blocks} blocks in reserve"
+        return (
+            f"Flow control: adaptive, {self.min_free_blocks} blocks in reserve, polls "
+            f"{self.min_poll_interval * 1000:g} to {self.refresh * 1000:g} ms apart"
+        )
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.started
+        mode = "adaptive" if self.adaptive else "fixed"
+        return (
+            f"Flow control ({mode}): {self.lines} lines in {elapsed:.1f}s, "
+            f"{self.polls} status polls, {self.waited:.1f}s waiting for the planner"
+        )
+
+
+def send_command(ser, command, metrics=None):
+    data = command.encode() + b"\n"
+    if metrics:
+        sent_at = time.perf_counter()
+    ser.write(data)
+    while True:
+        grbl_out = ser.readline().strip().decode("utf-8")
+        if grbl_out == "ok":
+            if metrics:
+                metrics.observe_line(len(data), time.perf_counter() - sent_at)
+            return grbl_out
+        if grbl_out.startswith("error"):
+            print(f"Error: {grbl_out}")
+            if metrics:
+                metrics.observe_error(grbl_out.partition(":")[2])
+            return grbl_out
+        if grbl_out.startswith("ALARM"):
+            raise GrblAlarm(error_code(grbl_out))
+
+
+class StreamProgress:
+    def __init__(self):
+        self.file = None
+        self.file_index = -1
+        self.file_size = 0
+        self.file_started = 0.0
+        self.line_number = 0
+        self.acked_line = 0  # Last line GRBL answered, where a resume picks up
+        self.bytes_acked = 0  # Source bytes up to the last acknowledged line
+        self.completed = False  # The current file streamed to its end
+        self.stats = RecoveryStats()  # Faults over the whole run
+        self.file_stats = RecoveryStats()  # Faults in the current file
+
+    def start_file(self, path):
+        self.file = path
+        self.file_index += 1
+        try:
+            self.file_size = program_size(path)
+        except (OSError, ValueError):
+            self.file_size = 0
+        self.file_started = time.time()
+        self.line_number = 0
+        self.acked_line = 0
+        self.bytes_acked = 0
+        self.completed = False
+        self.file_stats = RecoveryStats()
+
+
+def send_line(ser, command, progress, metrics=None):
+    # Sends one line, resending it when GRBL rejects it in a way a garbled
+    # transfer would, and stops the job on errors that are unsafe to skip.
+    # Only lines without axis words are ever skipped.
+    for attempt in range(MAX_LINE_RETRIES + 1):
+        try:
+            response = send_command(ser, command, metrics)
+        except GrblAlarm as alarm:
+            progress.stats.alarms += 1
+            progress.file_stats.alarms += 1
+            raise GrblAlarm(alarm.code, line_number=progress.line_number) from None
+        if response == "ok":
+            return True
+        code = error_code(response)
+        action = classify_error(code, command)
+        progress.stats.record_error(code)
+        progress.file_stats.record_error(code)
+        if action == FATAL:
+            raise GrblError(code, line_number=progress.line_number)
+        if action != RETRY or attempt == MAX_LINE_RETRIES:
+            break
+        print(f"Retrying line {progress.line_number} ({attempt + 1}/{MAX_LINE_RETRIES})")
+        progress.stats.retries += 1
+        progress.file_stats.retries += 1
+        if metrics:
+            metrics.observe_recovery("retry")
+    if moves_axes(command):
+        raise GrblError(code, line_number=progress.line_number)
+    print(f"Skipping line {progress.line_number}: {command}")
+    progress.stats.skipped_lines += 1
+    progress.file_stats.skipped_lines += 1
+    if metrics:
+        metrics.observe_recovery("skip")
+    return False
+
+
+def stream_files(
+    ser,
+    paths,
+    profile=None,
+    metrics=None,
+    on_file_start=None,
+    on_file_done=None,
+    should_stop=None,
+    wake_up=True,
+    on_status=None,
+    progress=None,
+    resume_line=0,
+):
+    # Streams a sequence of files back to back. A reader thread cleans the
+    # lines ahead of the sender, and GRBL is woken at most once for the run.
+    # With resume_line the first file restarts after that line, behind a
+    # preamble that restores the modal state of the lines skipped. In laser
+    # mode the reader also merges collinear moves and drops repeated words
+    # (see utils.compress), so the planner holds longer moves. WORK_TRANSFORM
+    # moves, turns or mirrors every file on the way (see utils.transform).
+    # FlowControl paces the lines against the planner's free blocks.
+    from utils.compress import StreamCompressor, compress_from_env
+    from utils.transform import transform_from_env
+    from utils.pipeline import GCodePrefetcher, LINE, FILE_START, FILE_END, FILE_ERROR
 
-    with open(gcode_path, "r") as file:
-        send_wake_up(ser)
+    port = profile.port if profile else None
+    min_free_blocks = profile.min_free_blocks if profile else 3
+    compressor = StreamCompressor() if compress_from_env(profile) else None
+    prefetcher = GCodePrefetcher(
+        paths,
+        resume_line=resume_line,
+        compressor=compressor,
+        transform=transform_from_env(port),
+    )
+    prefetcher.start()
+    if progress is None:
+        progress = StreamProgress()
 
-        for line in file:
-            cleaned_line = remove_eol_chars(remove_comment(line))
-            if cleaned_line:
-                # print("sending:", cleaned_line)
-                send_command(ser, cleaned_line)
-                wait_for_buffer(ser)
+    def report_status(report):
+        on_status(report, progress)
 
-        print("End of gcode file reached: " + gcode_path)
+    flow = FlowControl(
+        min_free_blocks,
+        metrics,
+        report_status if on_status else None,
+        settings_for(port),
+        profile.planner_blocks if profile else None,
+    )
+    try:
+        if wake_up:
+            send_wake_up(ser)
+        for kind, value in prefetcher:
+            if kind == LINE:
+                line_number, offset, command = value
+                progress.line_number = line_number
+                send_line(ser, command, progress, metrics)
+                progress.acked_line = line_number
+                progress.bytes_acked = offset
+                flow.wait(ser, command)
+            elif kind == FILE_START:
+                file_stats = progress.file_stats
+                progress.start_file(value)
+                if resume_line:
+                    progress.acked_line = resume_line
+                    progress.file_stats = file_stats
+                    resume_line = 0
+                if on_file_start:
+                    on_file_start(value)
+            elif kind == FILE_END:
+                progress.completed = True
+                print("End of gcode file reached: " + value)
+                if progress.file_stats.failures:
+                    print(f"Faults in {value}: {progress.file_stats.summary()}")
+                if on_file_done:
+                    on_file_done(value)
+                if should_stop and should_stop():
+                    return
+            elif kind == FILE_ERROR:
+                raise value
+        if compressor is not None and compressor.lines_in:
+            print(
+                f"Compressed {compressor.lines_in} lines to {compressor.lines_out} "
+                f"({compressor.ratio:.0%} of the bytes)"
+            )
+    finally:
+        prefetcher.stop()
+        if flow.lines:
+            print(flow.summary())
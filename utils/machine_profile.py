@@ -0,0 +1,251 @@
+import os
+import json
+import time
+
+PROFILE_CACHE_FILE = "machine_profiles.json"
+
+# GRBL 1.1 defaults on an ATmega328p, used when $I does not report [OPT:...]
+DEFAULT_PLANNER_BLOCKS = 15
+DEFAULT_RX_BUFFER_SIZE = 128
+
+
+class MachineProfile:
+    def __init__(
+        self,
+        port,
+        serial_number=None,
+        version="",
+        build_info="",
+        options="",
+        planner_blocks=None,
+        rx_buffer_size=None,
+        settings=None,
+    ):
+        self.port = port
+        self.serial_number = serial_number
+        self.version = version
+        self.build_info = build_info
+        self.options = options
+        self.planner_blocks = planner_blocks or DEFAULT_PLANNER_BLOCKS
+        # Shown and recorded only: the streamer sends a line and waits for
+        # its ok, so there is never more than one line in the RX buffer
+        self.rx_buffer_size = rx_buffer_size or default_rx_buffer_size(port)
+        self.settings = settings or {}
+
+    @property
+    def key(self):
+        return profile_key(self.port, self.serial_number)
+
+    @property
+    def firmware(self):
+        # What $I says about the controller; a change means other settings
+        return (
+            self.version,
+            self.build_info,
+            self.options,
+            self.planner_blocks,
+            self.rx_buffer_size,
+        )
+
+    def setting(self, number, default=None):
+        return self.settings.get(number, default)
+
+    def axis_settings(self, base):
+        return tuple(self.settings.get(base + axis) for axis in range(3))
+
+    @property
+    def max_rates(self):
+        return self.axis_settings(110)  # mm/min
+
+    @property
+    def rapid_rates(self):
+        # $110-$112 for timing rapids, None while any of them is unknown
+        rates = self.max_rates
+        return rates if all(rates) else None
+
+    @property
+    def accelerations(self):
+        return self.axis_settings(120)  # mm/s^2
+
+    @property
+    def max_travel(self):
+        return self.axis_settings(130)  # mm
+
+    @property
+    def laser_mode(self):
+        return bool(self.settings.get(32, 0))
+
+    @property
+    def min_free_blocks(self):
+        # Keep roughly a fifth of the planner in reserve (3 of 15 on stock GRBL)
+        return max(1, self.planner_blocks // 5)
+
+    def to_dict(self):
+        return {
+            "port": self.port,
+            "serial_number": self.serial_number,
+            "version": self.version,
+            "build_info": self.build_info,
+            "options": self.options,
+            "planner_blocks": self.planner_blocks,
+            "rx_buffer_size": self.rx_buffer_size,
+            "settings": {str(k): v for k, v in self.settings.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            data["port"],
+            data.get("serial_number"),
+            data.get("version", ""),
+            data.get("build_info", ""),
+            data.get("options", ""),
+            data.get("planner_blocks"),
+            data.get("rx_buffer_size"),
+            {int(k): v for k, v in data.get("settings", {}).items()},
+        )
+
+
+def default_rx_buffer_size(port=None):
+    from utils.config import get_setting
+
+    return get_setting("max_buffer_size", port) or DEFAULT_RX_BUFFER_SIZE
+
+
+def profile_key(port, serial_number):
+    return f"{port}|{serial_number or ''}"
+
+
+def serial_number_for(port):
+    from utils.config import port_infos
+
+    info = port_infos().get(port)
+    return info.serial_number if info is not None else None
+
+
+def read_response(ser):
+    lines = []
+    while True:
+        raw = ser.readline()
+        if not raw:
+            raise TimeoutError("No response from GRBL")
+        line = raw.strip().decode("utf-8", errors="replace")
+        if line == "ok":
+            return lines
+        if line.startswith("error"):
+            raise ValueError(f"GRBL rejected query: {line}")
+        if line:
+            lines.append(line)
+
+
+def parse_build_info(lines, profile):
+    for line in lines:
+        body = line.strip("[]")
+        if body.startswith("VER:"):
+            # [VER:1.1h.20190825:build info]
+            version, _, build_info = body[4:].partition(":")
+            profile.version = version
+            profile.build_info = build_info
+        elif body.startswith("OPT:"):
+            # [OPT:V,15,128] -> option codes, planner blocks, RX buffer bytes
+            fields = body[4:].split(",")
+            profile.options = fields[0]
+            if len(fields) >= 3:
+                profile.planner_blocks = int(fields[1])
+                profile.rx_buffer_size = int(fields[2])
+        elif not profile.version:
+            # GRBL 0.9 answers with a bare [0.9j.20160303:]
+            profile.version, _, profile.build_info = body.partition(":")
+
+
+def parse_settings(lines):
+    settings = {}
+    for line in lines:
+        if line.startswith("$") and "=" in line:
+            number, _, value = line[1:].partition("=")
+            # 0.9 appends a description: $0=10 (step pulse, usec)
+            value = value.split(" ")[0]
+            try:
+                settings[int(number)] = float(value)
+            except ValueError:
+                continue
+    return settings
+
+
+def wake_up(ser):
+    ser.write(b"\r\n\r\n")
+    time.sleep(2)  # Wait for GRBL to initialize
+    ser.reset_input_buffer()
+
+
+def query_profile(ser, port, serial_number=None, awake=False, settings=True):
+    # $I, and $$ unless settings is False. A controller that already
+    # answered is not woken again.
+    profile = MachineProfile(port, serial_number)
+    old_timeout = ser.timeout
+    ser.timeout = 2
+    try:
+        if awake:
+            ser.reset_input_buffer()
+        else:
+            wake_up(ser)
+
+        ser.write(b"$I\n")
+        parse_build_info(read_response(ser), profile)
+
+        if settings:
+            ser.write(b"$$\n")
+            profile.settings = parse_settings(read_response(ser))
+    finally:
+        ser.timeout = old_timeout
+    return profile
+
+
+def load_cache():
+    if not os.path.exists(PROFILE_CACHE_FILE):
+        return {}
+    try:
+        with open(PROFILE_CACHE_FILE, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_cache(cache):
+    with open(PROFILE_CACHE_FILE, "w") as f:
+        json.dump(cache, f, indent=2)
+
+
+def load_profile(ser, port, serial_number=None, refresh=False, awake=False):
+    # The cached profile of the controller on port, once $I shows it is
+    # still the same one. Adapters without a serial number are cached by
+    # port alone, so another controller on the same node is caught by its
+    # firmware answer and its settings are read again.
+    if serial_number is None:
+        serial_number = serial_number_for(port)
+    key = profile_key(port, serial_number)
+    cache = load_cache()
+
+    try:
+        if not refresh and key in cache:
+            cached = MachineProfile.from_dict(cache[key])
+            current = query_profile(ser, port, serial_number, awake, settings=False)
+            if current.firmware == cached.firmware:
+                return cached
+            print(f"Controller on {port} changed, reading its settings again")
+            awake = True
+        profile = query_profile(ser, port, serial_number, awake)
+    except (TimeoutError, ValueError) as e:
+        print(f"Could not read machine profile: {e}")
+        if key in cache:
+            return MachineProfile.from_dict(cache[key])
+        return MachineProfile(port, serial_number)
+
+    cache[key] = profile.to_dict()
+    save_cache(cache)
+    print(
+        f"Machine profile: GRBL {profile.version or 'unknown'}, "
+        f"{profile.planner_blocks} planner blocks, "
+        f"{profile.rx_buffer_size} byte RX buffer"
+    )
+    return profile
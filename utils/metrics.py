@@ -0,0 +1,173 @@
+import os
+import time
+import threading
+from bisect import bisect_left
+
+# Upper bounds (seconds) of the send-to-ok latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+class StreamMetrics:
+    def __init__(self, port=""):
+        self.port = port
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.latency_counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+        self.lines_acked = 0
+        self.bytes_sent = 0
+        self.errors = {}
+        self.recoveries = {}  # retry / skip / reconnect
+        self.planner_free = None
+        self.rx_free = None
+        self.buffer_samples = 0
+        self.planner_free_sum = 0
+        self.rx_free_sum = 0
+        self.status_polls = 0
+
+    def observe_line(self, nbytes, latency):
+        with self.lock:
+            self.latency_counts[bisect_left(LATENCY_BUCKETS, latency)] += 1
+            self.latency_sum += latency
+            self.lines_acked += 1
+            self.bytes_sent += nbytes
+
+    def observe_error(self, code):
+        with self.lock:
+            self.errors[code] = self.errors.get(code, 0) + 1
+
+    def observe_recovery(self, kind):
+        with self.lock:
+            self.recoveries[kind] = self.recoveries.get(kind, 0) + 1
+
+    def observe_poll(self):
+        with self.lock:
+            self.status_polls += 1
+
+    def observe_buffer(self, planner_free, rx_free):
+        with self.lock:
+            self.planner_free = planner_free
+            self.rx_free = rx_free
+            self.buffer_samples += 1
+            self.planner_free_sum += planner_free
+            if rx_free is not None:
+                self.rx_free_sum += rx_free
+
+    def render_prometheus(self):
+        with self.lock:
+            elapsed = max(time.monotonic() - self.started, 1e-9)
+            label = f'port="{self.port}"'
+            out = [
+                "# HELP grbl_stream_ack_latency_seconds Time from sending a line to its ok.",
+                "# TYPE grbl_stream_ack_latency_seconds histogram",
+            ]
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, self.latency_counts):
+                cumulative += count
+                out.append(
+                    f'grbl_stream_ack_latency_seconds_bucket{{{label},le="{bound}"}} {cumulative}'
+                )
+            out.append(
+                f'grbl_stream_ack_latency_seconds_bucket{{{label},le="+Inf"}} {self.lines_acked}'
+            )
+            out.append(f"grbl_stream_ack_latency_seconds_sum{{{label}}} {self.latency_sum:.6f}")
+            out.append(f"grbl_stream_ack_latency_seconds_count{{{label}}} {self.lines_acked}")
+
+            out.append("# TYPE grbl_stream_bytes_sent_total counter")
+            out.append(f"grbl_stream_bytes_sent_total{{{label}}} {self.bytes_sent}")
+            out.append("# TYPE grbl_stream_bytes_per_second gauge")
+            out.append(
+                f"grbl_stream_bytes_per_second{{{label}}} {self.bytes_sent / elapsed:.1f}"
+            )
+            out.append("# TYPE grbl_stream_status_polls_total counter")
+            out.append(f"grbl_stream_status_polls_total{{{label}}} {self.status_polls}")
+
+            out.append("# TYPE grbl_stream_errors_total counter")
+            for code, count in sorted(self.errors.items()):
+                out.append(f'grbl_stream_errors_total{{{label},code="{code}"}} {count}')
+            out.append("# TYPE grbl_stream_recoveries_total counter")
+            for kind, count in sorted(self.recoveries.items()):
+                out.append(f'grbl_stream_recoveries_total{{{label},kind="{kind}"}} {count}')
+
+            if self.buffer_samples:
+                out.append("# TYPE grbl_planner_free_blocks gauge")
+                out.append(f"grbl_planner_free_blocks{{{label}}} {self.planner_free}")
+                out.append("# TYPE grbl_planner_free_blocks_avg gauge")
+                out.append(
+                    f"grbl_planner_free_blocks_avg{{{label}}} "
+                    f"{self.planner_free_sum / self.buffer_samples:.2f}"
+                )
+                if self.rx_free is not None:
+                    out.append("# TYPE grbl_rx_free_bytes gauge")
+                    out.append(f"grbl_rx_free_bytes{{{label}}} {self.rx_free}")
+                    out.append("# TYPE grbl_rx_free_bytes_avg gauge")
+                    out.append(
+                        f"grbl_rx_free_bytes_avg{{{label}}} "
+                        f"{self.rx_free_sum / self.buffer_samples:.2f}"
+                    )
+        return "\n".join(out) + "\n"
+
+    def write_prometheus(self, path):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.render_prometheus())
+        os.replace(tmp_path, path)  # Scrapers never see a half-written file
+
+
+def start_file_exporter(metrics, path, interval=5.0):
+    def export_loop():
+        while True:
+            time.sleep(interval)
+            try:
+                metrics.write_prometheus(path)
+            except OSError as e:
+                print(f"Could not write metrics file: {e}")
+
+    thread = threading.Thread(target=export_loop, daemon=True)
+    thread.start()
+    return thread
+
+
+def start_http_exporter(metrics, port, host="0.0.0.0"):
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = metrics.render_prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def metrics_from_env(port):
+    from utils.config import get_setting
+
+    metrics_file = get_setting("metrics_file", port)
+    metrics_port = get_setting("metrics_port", port)
+    if not metrics_file and not metrics_port:
+        return None
+
+    metrics = StreamMetrics(port)
+    if metrics_file:
+        interval = get_setting("metrics_interval", port)
+        start_file_exporter(metrics, metrics_file, interval)
+    if metrics_port:
+        try:
+            start_http_exporter(metrics, int(metrics_port))
+            print(f"Serving metrics on port {metrics_port}")
+        except OSError as e:
+            print(f"Could not start metrics endpoint: {e}")
+    return metrics
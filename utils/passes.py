@@ -0,0 +1,287 @@
+import os
+import math
+import functools
+import numpy as np
+from utils.gcode import COMMENT_RE, MM_PER_INCH, WORD_RE
+from utils.transform import HOMING_CODES, UNTOUCHED_CODES, format_number
+
+# "part.ngc#passes=3,0.5" streams part.ngc cut down to 3 mm in 0.5 mm steps,
+# and "part.ngc#tile=3,2,60,40" streams 3 x 2 copies of it 60 mm and 40 mm
+# apart (see utils.transform). Both can be given, passes first, so every copy
+# is cut in passes. The marks travel with the path through progress files,
+# job queues and the job store, so such a job is one queue entry.
+PASSES_MARK = "#passes="
+TILE_MARK = "#tile="
+SPEC_OPTIONS = ("passes", "tile")
+
+
+def passes_spec(path, depth, step):
+    return f"{path}{PASSES_MARK}{format_number(depth)},{format_number(step)}"
+
+
+def tile_spec(path, columns, rows, pitch_x, pitch_y, safe_z=None):
+    values = [columns, rows, pitch_x, pitch_y] + ([safe_z] if safe_z is not None else [])
+    return f"{path}{TILE_MARK}{','.join(format_number(value) for value in values)}"
+
+
+def split_spec(value):
+    # (path, {option: numbers}) with the options given, {} for a plain path
+    options = {}
+    if not isinstance(value, str):
+        return value, options
+    while "#" in value:
+        path, _, option = value.rpartition("#")
+        name, equals, numbers = option.partition("=")
+        if not equals or name not in SPEC_OPTIONS or name in options:
+            break
+        options[name] = tuple(float(number) for number in numbers.split(","))
+        value = path
+    if len(options.get("passes", (0, 0))) != 2:
+        raise ValueError(f"Expected {PASSES_MARK}DEPTH,STEP")
+    if len(options.get("tile", (0, 0, 0, 0))) not in (4, 5):
+        raise ValueError(f"Expected {TILE_MARK}COLUMNS,ROWS,PITCH_X,PITCH_Y[,SAFE_Z]")
+    return value, options
+
+
+def join_spec(path, options):
+    if "passes" in options:
+        path = passes_spec(path, *options["passes"])
+    if "tile" in options:
+        path = tile_spec(path, *options["tile"])
+    return path
+
+
+def describe_spec(options):
+    # " (3 mm in 0.5 mm passes, 3 x 2 copies)", or "" for a plain path
+    parts = []
+    if "passes" in options:
+        parts.append("{:g} mm in {:g} mm passes".format(*options["passes"]))
+    if "tile" in options:
+        parts.append("{:g} x {:g} copies".format(*options["tile"]))
+    return f" ({', '.join(parts)})" if parts else ""
+
+
+def is_spec(value):
+    return bool(split_spec(value)[1])
+
+
+# Program end words; in every pass but the last they are left out, so the
+# spindle keeps running into the next pass
+END_CODES = {2, 5, 30}
+
+
+def mask_comments(line):
+    # The line with its comments blanked out, so word positions still index
+    # the line as written
+    if ";" in line:
+        index = line.index(";")
+        line = line[:index] + " " * (len(line) - index)
+    if "(" in line:
+        line = COMMENT_RE.sub(lambda match: " " * len(match.group()), line)
+    return line
+
+
+def split_z(line, words):
+    # (text before, text after) the number of the line's first Z word
+    for match in words:
+        if match.group(1) == "Z":
+            return line[: match.start(2)], line[match.end(2) :]
+    return line, None
+
+
+class DepthPasses:
+    # One program parsed once, then streamed again at increasing depths. Z
+    # below the surface is scaled from the program's own deepest cut to each
+    # pass depth, so a file cutting at Z-1 cuts at -0.5, -1.0, ... -3.0; Z
+    # at or above 0 (travel) is left alone. Only the numbers of the Z words
+    # are replaced, so dwells, coolant, offsets and the program's modes pass
+    # through as written.
+    def __init__(self, path, depth, step):
+        if depth <= 0 or step <= 0:
+            raise ValueError("Depth and step-down must be positive")
+        self.path = path
+        self.depth = depth
+        self.step = step
+        self.parse()
+        self.size = self.measure()
+
+    def parse(self):
+        # Keeps the program's lines, split around the number of every Z word,
+        # with where Z was and where it goes (mm, absolute), so each pass only
+        # scales the arrays and joins the text back together
+        self.text = []
+        z_lines, before, after, relative, scale = [], [], [], [], []
+        self.prefixes, self.suffixes = [], []
+        end_lines = {}
+        absolute, unit = True, 1.0
+        z = None  # Unknown until the first absolute Z
+        last_cut = -1
+        with open(self.path, "r") as file:
+            for index, line in enumerate(file):
+                line = line.rstrip("\n")
+                self.text.append(line)
+                matches = list(WORD_RE.finditer(mask_comments(line).upper()))
+                if not matches:
+                    continue
+                words = [match.groups() for match in matches]
+                codes = {round(float(value), 1) for letter, value in words if letter == "G"}
+                if 20 in codes:
+                    unit = MM_PER_INCH
+                elif 21 in codes:
+                    unit = 1.0
+                if 90 in codes:
+                    absolute = True
+                elif 91 in codes:
+                    absolute = False
+                ends = [
+                    match
+                    for match in matches
+                    if match.group(1) == "M" and round(float(match.group(2))) in END_CODES
+                ]
+                if ends:
+                    # The line as every pass but the last sends it
+                    kept = line
+                    for match in reversed(ends):
+                        kept = kept[: match.start()] + kept[match.end() :]
+                    end_lines[index] = kept
+                values = [float(value) for letter, value in words if letter == "Z"]
+                if codes & HOMING_CODES or (53 in codes and values):
+                    z = None  # Moved in machine coordinates or reset
+                if not values or codes & (UNTOUCHED_CODES | HOMING_CODES):
+                    continue
+                if absolute:
+                    target = values[0] * unit
+                elif z is None:
+                    raise ValueError(f"{self.path}: relative Z move before any absolute Z")
+                else:
+                    target = z + values[0] * unit
+                prefix, suffix = split_z(line, matches)
+                self.prefixes.append(prefix)
+                self.suffixes.append(suffix)
+                z_lines.append(index)
+                before.append(math.nan if z is None else z)
+                after.append(target)
+                relative.append(not absolute)
+                scale.append(unit)
+                z = target
+                if z < 0:
+                    last_cut = index
+        self.z_lines = np.asarray(z_lines, dtype=np.int64)
+        self.z_before = np.asarray(before, dtype=np.float64)
+        self.z_after = np.asarray(after, dtype=np.float64)
+        self.relative = np.asarray(relative, dtype=bool)
+        self.scale = np.asarray(scale, dtype=np.float64)
+        # Stops after the last cut end the program; earlier ones are the
+        # program's own business
+        self.end_lines = {
+            index: self.split_end(index, kept)
+            for index, kept in end_lines.items()
+            if index > last_cut
+        }
+        self.end_absolute, self.end_unit = absolute, unit
+        self.program_depth = float(self.z_after.min()) if len(self.z_after) else 0.0
+        if self.program_depth >= 0:
+            raise ValueError(f"{self.path} never cuts below Z0")
+        self.safe_z = max(0.0, float(self.z_after.max()))
+
+    def split_end(self, index, kept):
+        # An end line without its end words, split around its Z number when
+        # it has a rewritten one
+        position = int(np.searchsorted(self.z_lines, index)) if len(self.z_lines) else 0
+        if position < len(self.z_lines) and self.z_lines[position] == index:
+            return split_z(kept, WORD_RE.finditer(mask_comments(kept).upper()))
+        return kept, None
+
+    @property
+    def depths(self):
+        count = math.ceil(self.depth / self.step - 1e-9)
+        return [-min(self.step * index, self.depth) for index in range(1, count + 1)]
+
+    def pass_values(self, depth):
+        # The Z word of every recorded line at this pass depth, in file units
+        ratio = depth / self.program_depth
+
+        def scaled(z):
+            return np.where(z < 0, z * ratio, z)
+
+        after = scaled(self.z_after)
+        values = np.where(self.relative, after - scaled(self.z_before), after)
+        return values / self.scale
+
+    def retract(self):
+        # Up to safe Z in the units and distance mode the program ended in
+        z = "Z" + format_number(self.safe_z / self.end_unit)
+        if self.end_absolute:
+            return [f"G0 {z}"]
+        return [f"G90 G0 {z}", "G91"]
+
+    def measure(self):
+        # Bytes of the expanded program, worked out from the line lengths and
+        # the width of each pass's Z numbers rather than by expanding it
+        parts = dict(zip(self.z_lines.tolist(), zip(self.prefixes, self.suffixes)))
+        z_bytes = sum(len(prefix) + len(suffix) + 1 for prefix, suffix in parts.values())
+        text_bytes = sum(len(line) + 1 for line in self.text) - sum(
+            len(self.text[index]) + 1 for index in parts
+        )
+        end_bytes = 0  # Change from leaving the end words out
+        for index, (prefix, suffix) in self.end_lines.items():
+            if suffix is None:
+                end_bytes += len(prefix) - len(self.text[index])
+            else:
+                end_bytes += len(prefix) + len(suffix) - sum(map(len, parts[index]))
+        retract_bytes = sum(len(line) + 1 for line in self.retract())
+        size = 0
+        for number, depth in enumerate(self.depths, 1):
+            values = self.pass_values(depth).tolist()
+            size += text_bytes + z_bytes + sum(len(format_number(value)) for value in values)
+            if number < len(self.depths):
+                size += end_bytes + retract_bytes
+        return size
+
+    def lines(self):
+        # The expanded program, pass by pass, from the lines kept in memory
+        depths = self.depths
+        text = self.text
+        for number, depth in enumerate(depths, 1):
+            last = number == len(depths)
+            rewritten = {
+                index: (prefix, format_number(value), suffix)
+                for index, prefix, value, suffix in zip(
+                    self.z_lines.tolist(),
+                    self.prefixes,
+                    self.pass_values(depth).tolist(),
+                    self.suffixes,
+                )
+            }
+            if not last:
+                for index, (prefix, suffix) in self.end_lines.items():
+                    z = rewritten[index][1] if suffix is not None else ""
+                    rewritten[index] = (prefix, z, suffix or "")
+            for index, line in enumerate(text):
+                parts = rewritten.get(index)
+                yield line if parts is None else "".join(parts)
+            if not last:
+                yield from self.retract()
+
+
+@functools.lru_cache(maxsize=8)
+def load_passes(path, depth, step, mtime_ns):
+    return DepthPasses(path, depth, step)
+
+
+@functools.lru_cache(maxsize=8)
+def load_tiles(base, tile, mtime_ns):
+    from utils.transform import TiledProgram
+
+    return TiledProgram(base, *tile)
+
+
+def open_spec(spec):
+    # The expanded program of a spec, with lines() and size. Parsed once per
+    # file version, and shared by every run and reader.
+    path, options = split_spec(spec)
+    mtime_ns = os.stat(path).st_mtime_ns
+    if "tile" in options:
+        base = join_spec(path, {"passes": options["passes"]} if "passes" in options else {})
+        return load_tiles(base, options["tile"], mtime_ns)
+    return load_passes(path, *options["passes"], mtime_ns)
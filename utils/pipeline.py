@@ -0,0 +1,107 @@
+import queue
+import threading
+from utils.gcode import open_program
+from utils.machine import clean_line
+from utils.recovery import ModalTracker
+from utils.transform import LineTransformer
+
+LINE = 0
+FILE_START = 1
+FILE_END = 2
+FILE_ERROR = 3
+DONE = 4
+
+# Roughly two typical job files worth of cleaned lines
+DEFAULT_QUEUE_SIZE = 4096
+
+
+class GCodePrefetcher(threading.Thread):
+    def __init__(
+        self, paths, maxsize=DEFAULT_QUEUE_SIZE, resume_line=0, compressor=None, transform=None
+    ):
+        super().__init__(daemon=True)
+        self.paths = paths
+        self.resume_line = resume_line  # Lines of the first file already acknowledged
+        self.compressor = compressor  # Optional StreamCompressor rewriting lines on the way
+        self.transform = transform  # Optional Transform moving each file on the bed
+        self.queue = queue.Queue(maxsize)
+        self.stopped = threading.Event()
+
+    def put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def put_line(self, line_number, offset, command):
+        if self.compressor is None:
+            return self.put((LINE, (line_number, offset, command)))
+        for item in self.compressor.process(line_number, offset, command):
+            if not self.put((LINE, item)):
+                return False
+        return True
+
+    def flush(self):
+        if self.compressor is None:
+            return True
+        for item in self.compressor.flush():
+            if not self.put((LINE, item)):
+                return False
+        return True
+
+    def run(self):
+        resume_line = self.resume_line
+        try:
+            for path in self.paths:
+                if not self.put((FILE_START, path)):
+                    return
+                if self.compressor is not None:
+                    self.compressor.reset()
+                try:
+                    with open_program(path) as file:
+                        offset = 0
+                        modal = ModalTracker() if resume_line else None
+                        transformer = LineTransformer(self.transform) if self.transform else None
+                        for line_number, line in enumerate(file, 1):
+                            offset += len(line)
+                            cleaned_line = clean_line(line)
+                            if not cleaned_line:
+                                continue
+                            if transformer is not None:
+                                cleaned_line = transformer.apply(cleaned_line)
+                            if modal is not None:
+                                if line_number <= resume_line:
+                                    modal.update(cleaned_line)
+                                    continue
+                                # Restore the modal state the skipped lines set up
+                                for command in modal.preamble():
+                                    if not self.put_line(resume_line, offset - len(line), command):
+                                        return
+                                cleaned_line = modal.resume_command(cleaned_line)
+                                modal = None
+                            if not self.put_line(line_number, offset, cleaned_line):
+                                return
+                    if not self.flush():
+                        return
+                    resume_line = 0
+                except (OSError, ValueError) as e:
+                    # ValueError: a line the transform cannot follow
+                    self.put((FILE_ERROR, e))
+                    return
+                if not self.put((FILE_END, path)):
+                    return
+        finally:
+            self.put((DONE, None))
+
+    def __iter__(self):
+        while True:
+            kind, value = self.queue.get()
+            if kind == DONE:
+                return
+            yield kind, value
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,228 @@
+import os
+import re
+import sys
+import glob
+import threading
+
+# The device nodes pyserial lists on Linux. Each poll lists these names and
+# stats each node; the sysfs identity is looked up again only when the node
+# was created anew (another inode or change time), as happens when any
+# adapter is plugged in, even into a node that was just freed. A dozen
+# machines cost a directory listing and a dozen stats per poll. Elsewhere,
+# or if pyserial stops providing its sysfs lookup, each poll is a full
+# comports() enumeration, done less often.
+DEVICE_PATTERNS = (
+    "/dev/ttyS*",
+    "/dev/ttyUSB*",
+    "/dev/ttyXRUSB*",
+    "/dev/ttyACM*",
+    "/dev/ttyAMA*",
+    "/dev/rfcomm*",
+    "/dev/ttyAP*",
+)
+POLL_INTERVAL = 0.5 if sys.platform.startswith("linux") else 2.0  # s
+
+
+def port_identity(info):
+    # What a USB machine is known by after a replug, when its device path
+    # may have changed: its serial number, or the USB socket it is plugged
+    # into for adapters without one. None for ports that are not USB.
+    if info is None or info.vid is None:
+        return None
+    return (info.vid, info.pid, info.serial_number or info.location)
+
+
+def same_device(a, b):
+    # Whether two scans of one device node found the same hardware behind it
+    return (a.vid, a.pid, a.serial_number, a.location) == (
+        b.vid,
+        b.pid,
+        b.serial_number,
+        b.location,
+    )
+
+
+def node_stamp(node):
+    # Changes whenever udev creates the node again
+    stat = os.stat(node)
+    return stat.st_ino, stat.st_ctime_ns, stat.st_rdev
+
+
+def sysfs_lookup():
+    # pyserial's per-node sysfs reader; it is not public API, so a release
+    # without it falls back to comports()
+    try:
+        from serial.tools.list_ports_linux import SysFS
+    except ImportError:
+        return None
+    return SysFS
+
+
+def natural_key(device):
+    return [int(part) if part.isdigit() else part for part in re.split(r"(\d+)", device)]
+
+
+class PortWatcher:
+    # Keeps {device: ListPortInfo} of the attached serial ports up to date,
+    # from a background thread once started. Subscribers are called on that
+    # thread with event dicts and must return quickly:
+    #
+    #   attached, detached   {"port", "info"}
+    def __init__(self, interval=POLL_INTERVAL):
+        self.interval = interval
+        self.infos = {}  # Replaced, never changed in place, so readers need no lock
+        # {node: (stamp, ListPortInfo)}, the info None for nodes with no
+        # hardware behind them, like most ttyS
+        self.nodes = {}
+        self.version = 0  # Goes up with every change, for readers that cache
+        self.subscribers = []
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.poll()
+
+    def subscribe(self, callback):
+        with self.lock:
+            self.subscribers.append(callback)
+        return callback
+
+    def unsubscribe(self, callback):
+        with self.lock:
+            if callback in self.subscribers:
+                self.subscribers.remove(callback)
+
+    def scan(self):
+        # The attached ports as {device: ListPortInfo}
+        SysFS = sysfs_lookup() if sys.platform.startswith("linux") else None
+        if SysFS is None:
+            import serial.tools.list_ports
+
+            return {info.device: info for info in serial.tools.list_ports.comports()}
+
+        names = set()
+        for pattern in DEVICE_PATTERNS:
+            names.update(glob.glob(pattern))
+        nodes = {}
+        for node in names:
+            try:
+                stamp = node_stamp(node)
+            except OSError:
+                continue  # Unplugged since the listing
+            known = self.nodes.get(node)
+            if known is not None and known[0] == stamp:
+                nodes[node] = known
+                continue
+            info = SysFS(node)
+            nodes[node] = (stamp, None if info.subsystem == "platform" else info)
+        self.nodes = nodes
+        return {node: info for node, (_, info) in nodes.items() if info is not None}
+
+    def poll(self):
+        # Rescans now; returns True when ports came or went. A node that now
+        # has different hardware behind it is reported as detached and then
+        # attached again, so replug handling sees the new identity.
+        with self.lock:
+            infos = self.scan()
+            old = self.infos
+            gone = {
+                device: info
+                for device, info in old.items()
+                if device not in infos or not same_device(info, infos[device])
+            }
+            new = {
+                device: info
+                for device, info in infos.items()
+                if device not in old or device in gone
+            }
+            if not gone and not new:
+                return False
+            # Unchanged ports keep their old info, so readers see the same objects
+            infos = {
+                device: new[device] if device in new else old[device]
+                for device in sorted(infos, key=natural_key)
+            }
+            self.infos = infos
+            self.version += 1
+            self.changed.notify_all()
+            subscribers = list(self.subscribers)
+        events = [
+            {"event": "detached", "port": device, "info": info}
+            for device, info in gone.items()
+        ] + [
+            {"event": "attached", "port": device, "info": info}
+            for device, info in new.items()
+        ]
+        for message in events:
+            for callback in subscribers:
+                callback(message)
+        return bool(events)
+
+    def ports(self):
+        return list(self.infos.values())
+
+    def find(self, identity):
+        # The device a USB machine is attached as, None while unplugged
+        for device, info in self.infos.items():
+            if port_identity(info) == identity:
+                return device
+        return None
+
+    def wait_for(self, identity, timeout):
+        # The device a replugged machine came back on, or None after timeout.
+        # Polls right away first, which drops the device it was unplugged from.
+        self.start()
+        self.poll()
+        with self.lock:
+            self.changed.wait_for(lambda: self.find(identity), timeout)
+        return self.find(identity)
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.stop_event.clear()
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.poll()
+            except OSError as e:
+                print(f"Port scan failed: {e}")
+
+
+_watcher = None
+_watcher_lock = threading.Lock()
+
+
+def port_watcher():
+    # Shared by everything in the process; scans once when first used and
+    # polls in the background only once something starts it
+    global _watcher
+    with _watcher_lock:
+        if _watcher is None:
+            _watcher = PortWatcher()
+        return _watcher
+
+
+def _forget_watcher():
+    # A forked child, like the GUI's worker, starts its own; the parent's
+    # thread does not come along, and its locks may have been held
+    global _watcher, _watcher_lock
+    _watcher = None
+    _watcher_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_forget_watcher)
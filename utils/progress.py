@@ -0,0 +1,19 @@
+import os
+import json
+
+PROGRESS_FILE = "gcode_progress.json"
+
+
+def load_progress(path=PROGRESS_FILE):
+    # (files, current_index), or None when there is no progress file yet
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        progress = json.load(f)
+    return progress.get("files", []), progress.get("current_index", 0)
+
+
+def save_progress(files, current_index, path=PROGRESS_FILE):
+    with open(path, "w") as f:
+        json.dump({"files": list(files), "current_index": current_index}, f)
+
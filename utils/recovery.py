@@ -0,0 +1,330 @@
+import time
+from utils.gcode import parse_words
+
+try:
+    import termios
+
+    # What pyserial lets through when the tty goes away mid-call, as it does
+    # when a USB adapter is unplugged
+    TTY_ERRORS = (termios.error,)
+except ImportError:
+    TTY_ERRORS = ()
+
+# GRBL 1.1 error codes
+ERROR_MESSAGES = {
+    1: "G-code words consist of a letter and a value. Letter was not found.",
+    2: "Numeric value format is not valid or missing an expected value.",
+    3: "Grbl '$' system command was not recognized or supported.",
+    4: "Negative value received for an expected positive value.",
+    5: "Homing cycle is not enabled via settings.",
+    6: "Minimum step pulse time must be greater than 3usec.",
+    7: "EEPROM read failed. Reset and restored to default values.",
+    8: "Grbl '$' command cannot be used unless Grbl is IDLE.",
+    9: "G-code locked out during alarm or jog state.",
+    10: "Soft limits cannot be enabled without homing also enabled.",
+    11: "Max characters per line exceeded. Line was not processed and executed.",
+    12: "Grbl '$' setting value exceeds the maximum step rate supported.",
+    13: "Safety door detected as opened and door state initiated.",
+    14: "Build info or startup line exceeded EEPROM line length limit.",
+    15: "Jog target exceeds machine travel. Command ignored.",
+    16: "Jog command with no '=' or contains prohibited g-code.",
+    17: "Laser mode requires PWM output.",
+    20: "Unsupported or invalid g-code command found in block.",
+    21: "More than one g-code command from same modal group found in block.",
+    22: "Feed rate has not yet been set or is undefined.",
+    23: "G-code command in block requires an integer value.",
+    24: "Two G-code commands that both require the use of the XYZ axis words were detected in the block.",
+    25: "A G-code word was repeated in the block.",
+    26: "A G-code command implicitly or explicitly requires XYZ axis words in the block, but none were detected.",
+    27: "N line number value is not within the valid range of 1 - 9,999,999.",
+    28: "A G-code command was sent, but is missing some required P or L value words in the line.",
+    29: "Grbl supports six work coordinate systems G54-G59. G59.1, G59.2, and G59.3 are not supported.",
+    30: "The G53 G-code command requires either a G0 seek or G1 feed motion mode to be active.",
+    31: "There are unused axis words in the block and G80 motion mode cancel is active.",
+    32: "A G2 or G3 arc was commanded but there are no XYZ axis words in the selected plane to trace the arc.",
+    33: "The motion command has an invalid target. G2, G3, and G38.2 generates this error, if the arc is impossible to generate or if the probe target is the current position.",
+    34: "A G2 or G3 arc, traced with the radius definition, had a mathematical error when computing the arc geometry.",
+    35: "A G2 or G3 arc, traced with the offset definition, is missing the IJK offset word in the selected plane to trace the arc.",
+    36: "There are unused, leftover G-code words that aren't used by any command in the block.",
+    37: "The G43.1 dynamic tool length offset command cannot apply an offset to an axis other than its configured axis.",
+    38: "Tool number greater than max supported value.",
+}
+
+ALARM_MESSAGES = {
+    1: "Hard limit triggered. Machine position is likely lost due to sudden and immediate halt. Re-homing is highly recommended.",
+    2: "G-code motion target exceeds machine travel. Machine position safely retained. Alarm may be unlocked.",
+    3: "Reset while in motion. Grbl cannot guarantee position. Lost steps are likely. Re-homing is highly recommended.",
+    4: "Probe fail. The probe is not in the expected initial state before starting probe cycle.",
+    5: "Probe fail. Probe did not contact the workpiece within the programmed travel.",
+    6: "Homing fail. Reset during active homing cycle.",
+    7: "Homing fail. Safety door was opened during active homing cycle.",
+    8: "Homing fail. Cycle failed to clear limit switch when pulling off.",
+    9: "Homing fail. Could not find limit switch within search distance.",
+}
+
+RETRY = "retry"  # Possibly garbled in transit: resend the same line
+SKIP = "skip"  # The line itself is rejected: report it and carry on
+FATAL = "fatal"  # Continuing would cut the wrong thing: stop the job
+
+# A rejected line with an axis word would leave the machine somewhere other
+# than the rest of the program expects (or in another coordinate system),
+# so such lines are never skipped
+AXIS_LETTERS = frozenset("XYZABC")
+
+# A corrupted byte on the wire turns a good line into one of these parse
+# errors, so they are retried before the line is given up on.
+RETRY_ERRORS = {1, 2, 3, 20, 21, 23, 24, 25, 26, 27, 28, 31, 32, 33, 34, 35, 36}
+FATAL_ERRORS = {9, 13, 15}
+
+MAX_LINE_RETRIES = 2
+RESYNC_TIMEOUT = 120  # Seconds to wait for the planner to drain before resuming
+
+
+class GrblError(Exception):
+    def __init__(self, code, message=None, line_number=None):
+        self.code = code
+        self.line_number = line_number
+        text = message or ERROR_MESSAGES.get(code, "Unknown error")
+        where = f" at line {line_number}" if line_number else ""
+        super().__init__(f"error:{code}{where}: {text}")
+
+
+class GrblAlarm(GrblError):
+    def __init__(self, code, message=None, line_number=None):
+        self.code = code
+        self.line_number = line_number
+        text = message or ALARM_MESSAGES.get(code, "Unknown alarm")
+        where = f" at line {line_number}" if line_number else ""
+        Exception.__init__(self, f"ALARM:{code}{where}: {text}")
+
+
+def error_code(response):
+    try:
+        return int(response.partition(":")[2])
+    except ValueError:
+        return 0
+
+
+def moves_axes(command):
+    return any(letter in AXIS_LETTERS for letter, _ in parse_words(command))
+
+
+def classify_error(code, command=None):
+    # What to do about an error on command; a line that moves, once its
+    # retries are used up, stops the job (see send_line)
+    if code in FATAL_ERRORS:
+        return FATAL
+    if code in RETRY_ERRORS:
+        return RETRY
+    if command is not None and moves_axes(command):
+        return FATAL
+    return SKIP
+
+
+class RecoveryStats:
+    def __init__(self):
+        self.retries = 0
+        self.skipped_lines = 0
+        self.reconnects = 0
+        self.resumes = 0
+        self.alarms = 0
+        self.errors = {}
+
+    @property
+    def failures(self):
+        return sum(self.errors.values()) + self.alarms + self.reconnects
+
+    def record_error(self, code):
+        self.errors[code] = self.errors.get(code, 0) + 1
+
+    def summary(self):
+        parts = []
+        if self.errors:
+            codes = ", ".join(
+                f"error:{code} x{count}" for code, count in sorted(self.errors.items())
+            )
+            parts.append(codes)
+        for label, value in (
+            ("retries", self.retries),
+            ("skipped lines", self.skipped_lines),
+            ("reconnects", self.reconnects),
+            ("resumes", self.resumes),
+            ("alarms", self.alarms),
+        ):
+            if value:
+                parts.append(f"{label}: {value}")
+        return "; ".join(parts) if parts else "no faults"
+
+
+class ModalTracker:
+    # Follows the modal groups GRBL keeps between lines, so a resumed job can
+    # put the controller back in the same state before its next line.
+    def __init__(self):
+        self.motion = "G0"
+        self.plane = "G17"
+        self.distance = "G90"
+        self.units = "G21"
+        self.wcs = "G54"
+        self.feed_mode = "G94"
+        self.spindle = "M5"
+        self.coolant = "M9"
+        self.feed = None
+        self.speed = None
+
+    def update(self, line):
+        for letter, value in parse_words(line):
+            if letter == "G":
+                code = round(value, 1)
+                name = f"G{code:g}"
+                if code in (0, 1, 2, 3, 80) or 38 <= code < 39:
+                    self.motion = name
+                elif code in (17, 18, 19):
+                    self.plane = name
+                elif code in (90, 91):
+                    self.distance = name
+                elif code in (20, 21):
+                    self.units = name
+                elif 54 <= code <= 59:
+                    self.wcs = name
+                elif code in (93, 94):
+                    self.feed_mode = name
+            elif letter == "M":
+                if value in (3, 4, 5):
+                    self.spindle = f"M{int(value)}"
+                elif value in (7, 8, 9):
+                    self.coolant = f"M{int(value)}"
+            elif letter == "F":
+                self.feed = value
+            elif letter == "S":
+                self.speed = value
+
+    def preamble(self):
+        commands = [f"{self.units} {self.distance} {self.plane} {self.feed_mode} {self.wcs}"]
+        if self.speed is not None:
+            commands.append(f"{self.spindle} S{self.speed:g}")
+        else:
+            commands.append(self.spindle)
+        commands.append(self.coolant)
+        if self.feed is not None:
+            commands.append(f"F{self.feed:g}")
+        return commands
+
+    def resume_command(self, command):
+        # A resumed line that relies on the modal motion mode gets it back
+        # explicitly, since G2/G3 cannot be restored without axis words.
+        words = parse_words(command)
+        has_motion = any(
+            letter == "G" and round(value, 1) in (0, 1, 2, 3, 80) for letter, value in words
+        )
+        has_axes = any(letter in "XYZ" for letter, _ in words)
+        if has_axes and not has_motion:
+            return f"{self.motion} {command}"
+        return command
+
+
+def resync(ser, timeout=RESYNC_TIMEOUT):
+    # Wait for the planner to drain so the machine sits at the end of the last
+    # acknowledged line, and make sure it is not in an alarm state.
+    from utils.machine import parse_status
+
+    deadline = time.monotonic() + timeout
+    old_timeout = ser.timeout
+    ser.timeout = 1
+    try:
+        while time.monotonic() < deadline:
+            ser.reset_input_buffer()
+            ser.write(b"?")
+            grbl_out = ser.readline().strip().decode("utf-8", errors="replace")
+            if grbl_out.startswith("<"):
+                status = parse_status(grbl_out)
+                state = status["state"].split(":")[0]
+                if state == "Alarm":
+                    raise GrblAlarm(0, "Controller is in alarm state; home and unlock before resuming")
+                if state == "Idle":
+                    return status
+            time.sleep(0.2)
+    finally:
+        ser.timeout = old_timeout
+    raise GrblError(0, "Controller did not become idle, cannot resume")
+
+
+def stream_resumable(
+    connections,
+    port,
+    make_paths,
+    on_file_start=None,
+    on_file_done=None,
+    should_stop=None,
+    on_status=None,
+    progress=None,
+    max_reconnects=5,
+    reattach=None,
+):
+    # Streams like stream_files, but when the link drops it reconnects,
+    # re-syncs and carries on after the last acknowledged line. make_paths()
+    # must restart at the first file that has not finished yet. reattach(port)
+    # waits for an unplugged machine and returns the port it came back on, or
+    # None to retry the same port after a pause.
+    import serial
+    from utils.machine import StreamProgress, stream_files
+
+    if progress is None:
+        progress = StreamProgress()
+    resume_line = 0
+    attempts = 0
+    while True:
+        connection = None
+        try:
+            connection = connections.acquire(port)
+            if resume_line:
+                if connection.was_reset:
+                    raise GrblError(
+                        0,
+                        f"Controller was reset, position lost. Re-home and resume"
+                        f" {progress.file} after line {resume_line}",
+                    )
+                status = resync(connection.ser)
+                if "MPos" in status:
+                    position = ", ".join(f"{value:.3f}" for value in status["MPos"])
+                    print(f"Re-synced at MPos {position}")
+                progress.stats.resumes += 1
+                progress.file_stats.resumes += 1
+            stream_files(
+                connection.ser,
+                make_paths(),
+                connection.profile,
+                connection.metrics,
+                on_file_start,
+                on_file_done,
+                should_stop,
+                connections.start_stream(connection),
+                on_status,
+                progress,
+                resume_line,
+            )
+            return progress
+        except (serial.SerialException, *TTY_ERRORS) as e:
+            if connection is not None:
+                connections.discard(connection)
+            attempts += 1
+            progress.stats.reconnects += 1
+            progress.file_stats.reconnects += 1
+            if connection is not None and connection.metrics:
+                connection.metrics.observe_recovery("reconnect")
+            if attempts > max_reconnects:
+                if isinstance(e, serial.SerialException):
+                    raise
+                raise serial.SerialException(f"Port went away: {e}") from e
+            resume_line = 0 if progress.completed else progress.acked_line
+            if progress.file is not None and resume_line:
+                print(
+                    f"Serial communication error: {e}. Resuming {progress.file}"
+                    f" after line {resume_line}"
+                )
+            else:
+                print(f"Serial communication error: {e}. Reconnecting...")
+            moved = reattach(port) if reattach is not None else None
+            if moved is None:
+                time.sleep(2)
+            else:
+                port = moved
@@ -0,0 +1,317 @@
+import os
+import json
+import time
+import threading
+from bisect import insort
+from collections import deque
+from utils.jobstore import resolve
+
+JOBS_FILE = "jobs.json"
+JOBS_FORMAT = 2
+
+# Hook names that can be used in place of a file path for pre/post jobs
+HOOKS = {
+    "home": "gcode/home.gcode",
+    "homing": "gcode/homing.gcode",
+}
+
+
+def resolve_hook(name):
+    return HOOKS.get(name, name)
+
+
+class Job:
+    __slots__ = (
+        "id",
+        "path",
+        "priority",
+        "repeat",
+        "completed",
+        "claimed",
+        "port",
+        "pre",
+        "post",
+        "after",
+        "failures",
+    )
+
+    def __init__(
+        self,
+        id,
+        path,
+        priority=0,
+        repeat=1,
+        completed=0,
+        port=None,
+        pre=(),
+        post=(),
+        after=(),
+        failures=0,
+    ):
+        self.id = id
+        self.path = path
+        self.priority = priority
+        self.repeat = repeat  # 0 repeats forever
+        self.completed = completed
+        self.claimed = 0  # Runs handed to a streamer but not finished yet
+        self.port = port
+        self.pre = list(pre)
+        self.post = list(post)
+        self.after = list(after)
+        self.failures = failures  # Stream faults recovered from over all runs
+
+    @property
+    def sort_key(self):
+        return (-self.priority, self.id)
+
+    @property
+    def done(self):
+        return self.repeat and self.completed >= self.repeat
+
+    @property
+    def runs_left(self):
+        if not self.repeat:
+            return True
+        return self.completed + self.claimed < self.repeat
+
+    def files(self):
+        # Paths may be job store refs, which resolve to the stored copy
+        return (
+            [resolve(resolve_hook(hook)) for hook in self.pre]
+            + [resolve(self.path)]
+            + [resolve(resolve_hook(hook)) for hook in self.post]
+        )
+
+
+class JobScheduler:
+    def __init__(self, path=JOBS_FILE):
+        self.path = path
+        self.lock = threading.RLock()
+        self.jobs = {}
+        self.order = []  # (sort_key, id), highest priority first, then FIFO
+        self.next_id = 1
+        self.file_stamp = None  # The version of the file last read or written
+
+    def add(self, path, priority=0, repeat=1, port=None, pre=(), post=(), after=()):
+        with self.lock:
+            self.refresh()
+            job = Job(self.next_id, path, priority, repeat, 0, port, pre, post, after)
+            self.next_id += 1
+            self.insert(job)
+            return job
+
+    def insert(self, job):
+        self.jobs[job.id] = job
+        insort(self.order, (job.sort_key, job.id))
+
+    def remove(self, job_id):
+        with self.lock:
+            self.refresh()
+            job = self.jobs.pop(job_id, None)
+            if job is not None:
+                self.order.remove((job.sort_key, job.id))
+            return job
+
+    def dependencies_met(self, job):
+        # Finished jobs are removed from the queue, so a missing id counts as done
+        for job_id in job.after:
+            dependency = self.jobs.get(job_id)
+            if dependency is not None and not dependency.done:
+                return False
+        return True
+
+    def runnable(self, job, port):
+        return (
+            job.runs_left
+            and (job.port is None or job.port == port)
+            and self.dependencies_met(job)
+        )
+
+    def stamp(self):
+        # Every save replaces the file, so the inode changes even when the
+        # mtime would not
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def refresh(self):
+        # Picks up jobs another process added or removed since the file was
+        # last read or written, e.g. with jobs.py during a run. Claims are
+        # not stored, so they carry over to the reloaded jobs.
+        with self.lock:
+            if self.stamp() == self.file_stamp:
+                return False
+            claimed = {job_id: job.claimed for job_id, job in self.jobs.items() if job.claimed}
+            if not self.load():
+                return False
+            for job_id, count in claimed.items():
+                if job_id in self.jobs:
+                    self.jobs[job_id].claimed = count
+            return True
+
+    def claim(self, port=None):
+        with self.lock:
+            self.refresh()
+            for _, job_id in self.order:
+                job = self.jobs[job_id]
+                if self.runnable(job, port):
+                    job.claimed += 1
+                    return job
+            return None
+
+    def release(self, job):
+        with self.lock:
+            job = self.jobs.get(job.id, job)
+            job.claimed = max(job.claimed - 1, 0)
+
+    def complete(self, job, failures=0):
+        # Re-reads the file first, so the save keeps edits made meanwhile.
+        # A job removed meanwhile stays removed.
+        with self.lock:
+            self.refresh()
+            job = self.jobs.get(job.id, job)
+            job.claimed = max(job.claimed - 1, 0)
+            job.completed += 1
+            job.failures += failures
+            if job.done and job.id in self.jobs:
+                self.remove(job.id)
+            self.save()
+            return job
+
+    def in_flight(self):
+        with self.lock:
+            return any(job.claimed for job in self.jobs.values())
+
+    def pending(self, port=None):
+        with self.lock:
+            self.refresh()
+            return [
+                self.jobs[job_id]
+                for _, job_id in self.order
+                if port is None or self.jobs[job_id].port in (None, port)
+            ]
+
+    def save(self):
+        with self.lock:
+            # Paths are interned and jobs stored as rows so thousands of jobs
+            # stay a small file that loads with a single json.load.
+            paths = []
+            path_index = {}
+
+            def intern(path):
+                if path not in path_index:
+                    path_index[path] = len(paths)
+                    paths.append(path)
+                return path_index[path]
+
+            rows = []
+            for _, job_id in self.order:
+                job = self.jobs[job_id]
+                rows.append(
+                    [
+                        job.id,
+                        intern(job.path),
+                        job.priority,
+                        job.repeat,
+                        job.completed,
+                        job.port,
+                        [intern(hook) for hook in job.pre],
+                        [intern(hook) for hook in job.post],
+                        job.after,
+                        job.failures,
+                    ]
+                )
+            data = {
+                "format": JOBS_FORMAT,
+                "next_id": self.next_id,
+                "paths": paths,
+                "jobs": rows,
+            }
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(data, f, separators=(",", ":"))
+            os.replace(tmp_path, self.path)
+            self.file_stamp = self.stamp()
+
+    def load(self):
+        with self.lock:
+            if not os.path.exists(self.path):
+                return False
+            self.file_stamp = self.stamp()
+            with open(self.path, "r") as f:
+                data = json.load(f)
+            paths = data["paths"]
+            self.jobs = {}
+            self.order = []
+            for row in data["jobs"]:
+                job_id, path, priority, repeat, completed, port, pre, post, after = row[:9]
+                failures = row[9] if len(row) > 9 else 0  # Not stored before format 2
+                job = Job(
+                    job_id,
+                    paths[path],
+                    priority,
+                    repeat,
+                    completed,
+                    port,
+                    [paths[hook] for hook in pre],
+                    [paths[hook] for hook in post],
+                    after,
+                    failures,
+                )
+                self.jobs[job_id] = job
+                self.order.append((job.sort_key, job_id))
+            self.order.sort()
+            self.next_id = data.get("next_id", max(self.jobs, default=0) + 1)
+            return True
+
+
+class ScheduledStream:
+    # Feeds stream_files from the scheduler. Runs are claimed as the reader
+    # thread prefetches them and completed, in order, as their last file ends.
+    def __init__(self, scheduler, port=None):
+        self.scheduler = scheduler
+        self.port = port
+        self.runs = deque()  # [job, files left to finish, faults so far]
+        self.lock = threading.Lock()
+
+    def files(self, should_stop=None):
+        # Runs already handed out are streamed again from the file that was
+        # interrupted, so a reconnect picks up where the stream left off.
+        with self.lock:
+            resumed = [job.files()[-left:] for job, left, _ in self.runs]
+        for files in resumed:
+            yield from files
+        while not (should_stop and should_stop()):
+            job = self.scheduler.claim(self.port)
+            if job is None:
+                if self.scheduler.in_flight():
+                    # A running job may unblock its dependants when it ends
+                    time.sleep(0.1)
+                    continue
+                return
+            files = job.files()
+            with self.lock:
+                self.runs.append([job, len(files), 0])
+            yield from files
+
+    def file_done(self, path, failures=0):
+        with self.lock:
+            if not self.runs:
+                return None
+            run = self.runs[0]
+            run[1] -= 1
+            run[2] += failures
+            if run[1]:
+                return None
+            self.runs.popleft()
+        return self.scheduler.complete(run[0], run[2])
+
+    def cancel(self):
+        # Give back runs that were prefetched but never finished
+        with self.lock:
+            runs = list(self.runs)
+            self.runs.clear()
+        for job, _, _ in runs:
+            self.scheduler.release(job)
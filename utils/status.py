@@ -0,0 +1,136 @@
+import time
+import struct
+import ctypes
+import multiprocessing
+from utils.machine import parse_status
+
+# seq, time, file start time, file index, line, bytes acked, file size,
+# MPos xyz, WPos xyz, feed, spindle, planner free, RX free, state
+RECORD = struct.Struct("<QddIIQQ3f3fffhhB")
+HEADER = struct.Struct("<Q")  # sequence number of the last record written
+DEFAULT_CAPACITY = 256
+
+STATES = ["Unknown", "Idle", "Run", "Hold", "Jog", "Alarm", "Door", "Check", "Home", "Sleep"]
+STATE_CODES = {name: code for code, name in enumerate(STATES)}
+
+
+class StatusRecord:
+    __slots__ = (
+        "seq",
+        "time",
+        "file_started",
+        "file_index",
+        "line",
+        "bytes_acked",
+        "file_size",
+        "mpos",
+        "wpos",
+        "feed",
+        "spindle",
+        "planner_free",
+        "rx_free",
+        "state",
+    )
+
+    def __init__(self, values):
+        (
+            self.seq,
+            self.time,
+            self.file_started,
+            self.file_index,
+            self.line,
+            self.bytes_acked,
+            self.file_size,
+        ) = values[:7]
+        self.mpos = values[7:10]
+        self.wpos = values[10:13]
+        self.feed, self.spindle, self.planner_free, self.rx_free = values[13:17]
+        self.state = STATES[values[17]] if values[17] < len(STATES) else "Unknown"
+
+    @property
+    def fraction(self):
+        if not self.file_size:
+            return 0.0
+        return min(self.bytes_acked / self.file_size, 1.0)
+
+    @property
+    def eta(self):
+        # Seconds left in the current file, extrapolated from progress so far
+        if not self.bytes_acked:
+            return None
+        elapsed = self.time - self.file_started
+        return elapsed * (self.file_size - self.bytes_acked) / self.bytes_acked
+
+
+class StatusChannel:
+    # Single-writer ring of fixed-size records in shared memory. The streaming
+    # process writes every status report; the GUI samples the newest one at
+    # its own frame rate without any pickling.
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self.buffer = multiprocessing.RawArray(
+            ctypes.c_ubyte, HEADER.size + capacity * RECORD.size
+        )
+        self.last_seen = 0
+
+    def write(self, values):
+        view = memoryview(self.buffer).cast("B")
+        seq = HEADER.unpack_from(view, 0)[0] + 1
+        offset = HEADER.size + (seq % self.capacity) * RECORD.size
+        RECORD.pack_into(view, offset, seq, *values)
+        HEADER.pack_into(view, 0, seq)
+
+    def latest(self):
+        view = memoryview(self.buffer).cast("B")
+        seq = HEADER.unpack_from(view, 0)[0]
+        if seq == 0 or seq == self.last_seen:
+            return None
+        offset = HEADER.size + (seq % self.capacity) * RECORD.size
+        values = RECORD.unpack_from(view, offset)
+        if values[0] != seq:
+            return None  # Overwritten while reading; take the next one
+        self.last_seen = seq
+        return StatusRecord(values)
+
+
+class StatusWriter:
+    def __init__(self, channel):
+        self.channel = channel
+        self.wco = (0.0, 0.0, 0.0)
+        self.mpos = (0.0, 0.0, 0.0)
+
+    def publish(self, report, progress):
+        status = parse_status(report)
+        if "WCO" in status:
+            self.wco = status["WCO"]
+        if "MPos" in status:
+            self.mpos = status["MPos"][:3]
+            wpos = tuple(m - o for m, o in zip(self.mpos, self.wco))
+        elif "WPos" in status:
+            wpos = status["WPos"][:3]
+            self.mpos = tuple(w + o for w, o in zip(wpos, self.wco))
+        else:
+            wpos = tuple(m - o for m, o in zip(self.mpos, self.wco))
+        feed, spindle = (tuple(status.get("FS", ())) + (0.0, 0.0))[:2]
+        if "F" in status:
+            feed = status["F"][0]
+        planner_free, rx_free = (tuple(status.get("Bf", ())) + (-1, -1))[:2]
+        state = STATE_CODES.get(status["state"].split(":")[0], 0)
+
+        self.channel.write(
+            (
+                time.time(),
+                progress.file_started,
+                progress.file_index,
+                progress.line_number,
+                progress.bytes_acked,
+                progress.file_size,
+                *self.mpos,
+                *wpos,
+                feed,
+                spindle,
+                int(planner_free),
+                int(rx_free),
+                state,
+            )
+        )
@@ -0,0 +1,114 @@
+import numpy as np
+from utils.gcode import iter_file_moves, arc_points
+
+# Points per bucket at the first decimated level; each further level is 4x coarser
+BASE_BUCKET = 8
+LEVEL_FACTOR = 4
+
+
+class Toolpath:
+    def __init__(self, points, lines):
+        self.points = points  # (N, 2) XY in mm
+        self.lines = lines  # source line number of each point
+        self.levels = build_levels(points)
+
+    @classmethod
+    def from_file(cls, path):
+        xs = []
+        ys = []
+        lines = []
+        first = True
+        for move in iter_file_moves(path):
+            if first:
+                xs.append(move.start[0])
+                ys.append(move.start[1])
+                lines.append(0)
+                first = False
+            if move.center is not None:
+                for x, y, _ in arc_points(move):
+                    xs.append(x)
+                    ys.append(y)
+                    lines.append(move.line)
+            else:
+                xs.append(move.end[0])
+                ys.append(move.end[1])
+                lines.append(move.line)
+        points = np.empty((len(xs), 2))
+        points[:, 0] = xs
+        points[:, 1] = ys
+        return cls(points, np.asarray(lines, dtype=np.int64))
+
+    def __len__(self):
+        return len(self.points)
+
+    @property
+    def bounds(self):
+        if not len(self.points):
+            return 0.0, 0.0, 0.0, 0.0
+        (x_min, y_min), (x_max, y_max) = self.points.min(0), self.points.max(0)
+        return x_min, y_min, x_max, y_max
+
+    def level_for(self, budget):
+        # Finest level that keeps the polyline under the point budget
+        for level in self.levels:
+            if len(level) <= budget:
+                return level
+        return self.levels[-1]
+
+    def index_for_line(self, line_number):
+        return int(np.searchsorted(self.lines, line_number, side="right")) - 1
+
+    def nearest_index(self, lo, hi, x, y):
+        lo = max(lo, 0)
+        hi = min(max(hi, lo), len(self.points) - 1)
+        window = self.points[lo : hi + 1]
+        if not len(window):
+            return lo
+        distances = (window[:, 0] - x) ** 2 + (window[:, 1] - y) ** 2
+        return lo + int(np.argmin(distances))
+
+
+def build_levels(points):
+    count = len(points)
+    levels = [np.arange(count)]
+    bucket = BASE_BUCKET
+    while count > 2 * bucket:
+        levels.append(decimate(points, bucket))
+        bucket *= LEVEL_FACTOR
+    return levels
+
+
+def decimate(points, bucket):
+    # Keep the first, last and extreme X/Y points of every bucket so the
+    # decimated polyline covers the same area as the full one.
+    count = len(points)
+    buckets = -(-count // bucket)
+    padded = np.empty((buckets * bucket, 2))
+    padded[:count] = points
+    padded[count:] = points[-1]
+    shaped = padded.reshape(buckets, bucket, 2)
+    offsets = np.arange(buckets)[:, None] * bucket
+    picks = np.concatenate(
+        (
+            offsets,
+            offsets + bucket - 1,
+            offsets + shaped[:, :, 0].argmin(1)[:, None],
+            offsets + shaped[:, :, 0].argmax(1)[:, None],
+            offsets + shaped[:, :, 1].argmin(1)[:, None],
+            offsets + shaped[:, :, 1].argmax(1)[:, None],
+        ),
+        axis=1,
+    ).ravel()
+    picks = np.unique(np.minimum(picks, count - 1))
+    return picks
+
+
+def project(points, width, height, bounds, margin=10):
+    x_min, y_min, x_max, y_max = bounds
+    span = max(x_max - x_min, y_max - y_min, 1e-9)
+    scale = min(width - 2 * margin, height - 2 * margin) / span
+    projected = np.empty_like(points)
+    projected[:, 0] = margin + (points[:, 0] - x_min) * scale
+    # Canvas Y grows downwards
+    projected[:, 1] = height - margin - (points[:, 1] - y_min) * scale
+    return projected
@@ -0,0 +1,249 @@
+import os
+import re
+import time
+import struct
+import threading
+from collections import deque
+
+TRACE_MAGIC = b"GTRC\x01"
+# kind, seconds since trace start, payload length
+RECORD = struct.Struct("<BdI")
+
+TX = 0
+RX = 1
+FLUSH = 2
+KIND_NAMES = {TX: "TX", RX: "RX", FLUSH: "FLUSH"}
+
+DEFAULT_CAPACITY = 65536
+PLANNER_FREE_RE = re.compile(rb"Bf:(\d+)")
+
+
+class TraceRecorder:
+    def __init__(self, path, capacity=DEFAULT_CAPACITY, flush_interval=0.25):
+        self.path = path
+        self.events = deque(maxlen=capacity)
+        self.appended = 0
+        self.written = 0
+        self.flush_interval = flush_interval
+        self.start = time.perf_counter()
+        self.stopped = threading.Event()
+        self.file = open(path, "wb")
+        self.file.write(TRACE_MAGIC)
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+
+    def record(self, kind, data=b""):
+        # deque.append is atomic and O(1); when the writer falls behind the
+        # oldest events are dropped instead of blocking the streaming loop.
+        self.events.append((kind, time.perf_counter() - self.start, data))
+        self.appended += 1
+
+    @property
+    def dropped(self):
+        return self.appended - self.written - len(self.events)
+
+    def drain(self):
+        chunks = []
+        events = self.events
+        while events:
+            try:
+                kind, t, data = events.popleft()
+            except IndexError:
+                break
+            chunks.append(RECORD.pack(kind, t, len(data)))
+            chunks.append(data)
+            self.written += 1
+        if chunks:
+            self.file.write(b"".join(chunks))
+
+    def write_loop(self):
+        while not self.stopped.wait(self.flush_interval):
+            self.drain()
+        self.drain()
+
+    def close(self):
+        if self.stopped.is_set():
+            return
+        self.stopped.set()
+        self.writer.join()
+        self.file.close()
+        if self.dropped:
+            print(f"Trace {self.path}: ring buffer overflowed, {self.dropped} events lost")
+
+
+class TracingSerial:
+    def __init__(self, ser, recorder):
+        object.__setattr__(self, "ser", ser)
+        object.__setattr__(self, "recorder", recorder)
+
+    def __getattr__(self, name):
+        return getattr(self.ser, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.ser, name, value)
+
+    def write(self, data):
+        self.recorder.record(TX, bytes(data))
+        return self.ser.write(data)
+
+    def read(self, size=1):
+        data = self.ser.read(size)
+        if data:
+            self.recorder.record(RX, data)
+        return data
+
+    def readline(self):
+        data = self.ser.readline()
+        if data:
+            self.recorder.record(RX, data)
+        return data
+
+    def reset_input_buffer(self):
+        self.recorder.record(FLUSH)
+        self.ser.reset_input_buffer()
+
+    def close(self):
+        try:
+            self.ser.close()
+        finally:
+            self.recorder.close()
+
+
+def read_trace(path):
+    with open(path, "rb") as f:
+        if f.read(len(TRACE_MAGIC)) != TRACE_MAGIC:
+            raise ValueError(f"{path} is not a serial trace")
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            kind, t, length = RECORD.unpack(header)
+            yield kind, t, f.read(length)
+
+
+def trace_path_for(directory, port):
+    name = os.path.basename(port) or "port"
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+    return os.path.join(directory, f"{name}-{stamp}.gtrace")
+
+
+def trace_from_env(ser, port):
+    from utils.config import get_setting
+
+    directory = get_setting("serial_trace_dir", port)
+    if not directory:
+        return ser
+    os.makedirs(directory, exist_ok=True)
+    path = trace_path_for(directory, port)
+    print(f"Recording serial trace to {path}")
+    return TracingSerial(ser, TraceRecorder(path))
+
+
+class TraceExhausted(Exception):
+    pass
+
+
+class ReplaySerial:
+    def __init__(self, path, realtime=False, speed=1.0):
+        self.realtime = realtime
+        self.speed = speed
+        self.timeout = None
+        self.status_responses = deque()
+        self.line_responses = deque()
+        self.recorded_commands = []
+        self.sent_commands = []
+        self.last_status = None
+        self.planner_blocks = 0  # Most free blocks any report showed
+        self.profile_responses = {}  # $I and $$ answers, to rebuild the profile
+        self.pending_status = 0
+        self.last_write = time.perf_counter()
+        self.bytes_written = 0
+
+        last_tx = 0.0
+        pending = deque()
+        for kind, t, data in read_trace(path):
+            if kind == TX:
+                last_tx = t
+                if data != b"?":
+                    for command in split_commands(data):
+                        pending.append((command, []))
+            elif kind == RX:
+                # Replay each response after the same delay it took the
+                # machine to answer the write that preceded it.
+                response = (t - last_tx, data)
+                if data.startswith(b"<"):
+                    self.status_responses.append(response)
+                    match = PLANNER_FREE_RE.search(data)
+                    if match:
+                        self.planner_blocks = max(self.planner_blocks, int(match.group(1)))
+                elif pending:
+                    command, responses = pending[0]
+                    responses.append(response)
+                    if data.startswith((b"ok", b"error")):
+                        pending.popleft()
+                        # Profile queries ($I, $$) are answered from the cache
+                        # on replay, so only streamed lines are kept.
+                        if not command.startswith(b"$"):
+                            self.line_responses.extend(responses)
+                            self.recorded_commands.append(command)
+                        elif command.strip() in (b"$I", b"$$"):
+                            self.profile_responses[command.strip()] = [
+                                data for _, data in responses
+                            ]
+
+    def write(self, data):
+        data = bytes(data)
+        self.last_write = time.perf_counter()
+        self.bytes_written += len(data)
+        if data == b"?":
+            self.pending_status += 1
+        else:
+            self.sent_commands.extend(split_commands(data))
+        return len(data)
+
+    def wait(self, delay):
+        if self.realtime:
+            remaining = self.last_write + delay / self.speed - time.perf_counter()
+            if remaining > 0:
+                time.sleep(remaining)
+
+    def readline(self):
+        if self.pending_status:
+            # GRBL answers '?' immediately, ahead of any queued 'ok'
+            self.pending_status -= 1
+            if self.status_responses:
+                delay, self.last_status = self.status_responses.popleft()
+                self.wait(delay)
+            elif self.last_status is not None and self.planner_blocks:
+                # Past the recorded reports the machine would have run its
+                # planner empty; repeating a full one would wait forever
+                self.last_status = PLANNER_FREE_RE.sub(
+                    b"Bf:%d" % self.planner_blocks, self.last_status
+                )
+            if self.last_status is None:
+                raise TraceExhausted("Trace has no status reports to replay")
+            return self.last_status
+        if not self.line_responses:
+            raise TraceExhausted("Trace has no more responses to replay")
+        delay, data = self.line_responses.popleft()
+        self.wait(delay)
+        return data
+
+    def read(self, size=1):
+        return self.readline()[:size]
+
+    def reset_input_buffer(self):
+        pass
+
+    def close(self):
+        pass
+
+    def mismatches(self):
+        recorded = self.recorded_commands
+        sent = self.sent_commands
+        count = sum(1 for a, b in zip(recorded, sent) if a != b)
+        return count + abs(len(recorded) - len(sent))
+
+
+def split_commands(data):
+    return [line for line in data.split(b"\n") if line.strip()]
@@ -0,0 +1,307 @@
+import math
+from utils.config import get_setting
+from utils.gcode import MM_PER_INCH, WORD_RE, file_summary, open_program, strip_comments
+
+# G-codes whose axis words are not work coordinates to be moved: dwell,
+# coordinate system setup, machine coordinates
+UNTOUCHED_CODES = {4, 10, 53, 92}
+# After these the position is not known from the file any more
+HOMING_CODES = {28, 30, 92}
+# Lowest retract between tiled copies (mm), for programs that travel lower
+DEFAULT_SAFE_Z = 5.0
+
+
+def format_number(value):
+    text = f"{value:.6f}".rstrip("0").rstrip(".")
+    return "0" if text in ("", "-0") else text
+
+
+class Transform:
+    # XY affine map x' = a*x + b*y + e, y' = c*x + d*y + f, in mm. Only
+    # rotations, mirrors and uniform scaling are built, so arcs stay arcs.
+    def __init__(self, a=1.0, b=0.0, c=0.0, d=1.0, e=0.0, f=0.0):
+        self.a, self.b, self.c, self.d, self.e, self.f = a, b, c, d, e, f
+
+    def then(self, other):
+        # This transform followed by other
+        return Transform(
+            other.a * self.a + other.b * self.c,
+            other.a * self.b + other.b * self.d,
+            other.c * self.a + other.d * self.c,
+            other.c * self.b + other.d * self.d,
+            other.a * self.e + other.b * self.f + other.e,
+            other.c * self.e + other.d * self.f + other.f,
+        )
+
+    def translate(self, dx, dy):
+        return self.then(Transform(e=dx, f=dy))
+
+    def rotate(self, degrees):
+        angle = math.radians(degrees)
+        cos, sin = math.cos(angle), math.sin(angle)
+        # Exact for quarter turns, the usual case
+        cos, sin = round(cos, 15), round(sin, 15)
+        return self.then(Transform(cos, -sin, sin, cos))
+
+    def scale(self, factor):
+        return self.then(Transform(factor, 0.0, 0.0, factor))
+
+    def mirror(self, axis):
+        # Mirror across the Y axis for "x", across the X axis for "y"
+        if axis.lower() == "x":
+            return self.then(Transform(a=-1.0))
+        if axis.lower() == "y":
+            return self.then(Transform(d=-1.0))
+        raise ValueError(f"Unknown mirror axis: {axis}")
+
+    @property
+    def flips(self):
+        # A mirrored path runs its arcs the other way round
+        return self.a * self.d - self.b * self.c < 0
+
+    @property
+    def factor(self):
+        return math.sqrt(abs(self.a * self.d - self.b * self.c))
+
+    @property
+    def is_identity(self):
+        return (self.a, self.b, self.c, self.d, self.e, self.f) == (1, 0, 0, 1, 0, 0)
+
+    @property
+    def rotates(self):
+        return self.b != 0 or self.c != 0
+
+    def point(self, x, y):
+        return self.a * x + self.b * y + self.e, self.c * x + self.d * y + self.f
+
+    def vector(self, x, y):
+        return self.a * x + self.b * y, self.c * x + self.d * y
+
+    def bounds(self, bounds):
+        # Box around the transformed corners, exact for quarter turns
+        (x0, y0, z0), (x1, y1, z1) = bounds
+        corners = [self.point(x, y) for x in (x0, x1) for y in (y0, y1)]
+        xs = [x for x, _ in corners]
+        ys = [y for _, y in corners]
+        return (min(xs), min(ys), z0), (max(xs), max(ys), z1)
+
+
+def build_transform(offset=(0.0, 0.0), rotate=0.0, scale=1.0, mirror=None):
+    # Applied in the order mirror, scale, rotate (about the work origin), offset
+    transform = Transform()
+    if mirror:
+        transform = transform.mirror(mirror)
+    if scale != 1.0:
+        transform = transform.scale(scale)
+    if rotate:
+        transform = transform.rotate(rotate)
+    if offset[0] or offset[1]:
+        transform = transform.translate(*offset)
+    return transform
+
+
+def parse_transform(spec):
+    # "offset=100,50 rotate=90 scale=0.5 mirror=x" -> Transform
+    options = {"offset": (0.0, 0.0), "rotate": 0.0, "scale": 1.0, "mirror": None}
+    for part in spec.split():
+        key, _, value = part.partition("=")
+        if key == "offset":
+            x, _, y = value.partition(",")
+            options["offset"] = (float(x), float(y or 0.0))
+        elif key in ("rotate", "scale"):
+            options[key] = float(value)
+        elif key == "mirror":
+            options["mirror"] = value
+        else:
+            raise ValueError(f"Unknown transform option: {part}")
+    return build_transform(**options)
+
+
+def transform_from_env(port=None):
+    # WORK_TRANSFORM moves every streamed file, e.g. "offset=120,0 rotate=90"
+    spec = get_setting("work_transform", port)
+    if not spec:
+        return None
+    transform = parse_transform(spec)
+    return None if transform.is_identity else transform
+
+
+class LineTransformer:
+    # Rewrites the XY/IJ/R words of one program, line by line. Follows the
+    # modal state it needs (distance mode, units, motion, plane) and the
+    # source position, so partial axis words stay correct under rotation.
+    def __init__(self, transform):
+        self.transform = transform
+        self.absolute = True
+        self.scale = 1.0  # mm per file unit
+        self.motion = 0
+        self.plane = 17
+        self.position = [None, None]  # Source XY in file units, None when unknown
+
+    def moved(self, transform):
+        # A transformer for the next copy, starting in the modal state this
+        # one ended in; where the tool is in the new copy's frame is unknown
+        other = LineTransformer(transform)
+        other.absolute = self.absolute
+        other.scale = self.scale
+        other.motion = self.motion
+        other.plane = self.plane
+        other.position = [None, None]
+        return other
+
+    def retract(self, safe_z):
+        # Lines taking the tool up to safe_z (mm) in the program's own units,
+        # leaving its distance mode as it was
+        z = "Z" + format_number(safe_z / self.scale)
+        self.motion = 0
+        if self.absolute:
+            return [f"G0 {z}"]
+        return [f"G90 G0 {z}", "G91"]
+
+    def apply(self, line):
+        body = strip_comments(line).upper()
+        words = WORD_RE.findall(body)
+        if not words:
+            return line
+        untouched = False
+        codes = []
+        for letter, value in words:
+            if letter == "G":
+                code = round(float(value), 1)
+                codes.append(code)
+                if code in (0, 1, 2, 3):
+                    self.motion = int(code)
+                elif code in (17, 18, 19):
+                    self.plane = int(code)
+                elif code == 20:
+                    self.scale = MM_PER_INCH
+                elif code == 21:
+                    self.scale = 1.0
+                elif code == 90:
+                    self.absolute = True
+                elif code == 91:
+                    self.absolute = False
+                elif code in UNTOUCHED_CODES or code in HOMING_CODES:
+                    untouched = True
+        letters = {letter for letter, _ in words}
+        if untouched:
+            if any(code in HOMING_CODES for code in codes):
+                self.position = [None, None]
+            return line
+        arcs = {2, 3} & set(codes)
+        if not letters & set("XYIJR") and not (self.transform.flips and arcs):
+            return line
+        if self.motion in (2, 3) and self.plane != 17 and self.transform.rotates:
+            raise ValueError(f"Cannot rotate arcs outside the XY plane: {line.strip()}")
+        return self.rewrite(words, letters, line)
+
+    def rewrite(self, words, letters, line):
+        values = {letter: float(value) for letter, value in words}
+        transform = self.transform
+        new = {}
+        if "X" in letters or "Y" in letters:
+            if self.absolute:
+                x = values.get("X", self.position[0])
+                y = values.get("Y", self.position[1])
+                if transform.rotates and (x is None or y is None):
+                    raise ValueError(f"Position unknown before rotated move: {line.strip()}")
+                self.position = [x, y]
+                # Without rotation an unknown axis is not needed; offsets are
+                # in mm and the file may be in inches
+                tx, ty = transform.vector(x or 0.0, y or 0.0)
+                tx += transform.e / self.scale
+                ty += transform.f / self.scale
+            else:
+                # Starts wherever the machine is, which the transform cannot move
+                if None in self.position:
+                    raise ValueError(f"Relative move before any absolute position: {line.strip()}")
+                dx, dy = values.get("X", 0.0), values.get("Y", 0.0)
+                self.position = [self.position[0] + dx, self.position[1] + dy]
+                tx, ty = transform.vector(dx, dy)
+            for letter, value in (("X", tx), ("Y", ty)):
+                if letter in letters or transform.rotates:
+                    new[letter] = value
+        if "I" in letters or "J" in letters:
+            new["I"], new["J"] = transform.vector(values.get("I", 0.0), values.get("J", 0.0))
+        if "R" in letters:
+            new["R"] = values["R"] * transform.factor
+
+        parts = []
+        for letter, value in words:
+            if letter == "G" and transform.flips and round(float(value), 1) in (2, 3):
+                parts.append("G3" if round(float(value), 1) == 2 else "G2")
+            elif letter in "XYIJ":
+                pair = "XY" if letter in "XY" else "IJ"
+                if pair in parts:
+                    continue  # Written with the first word of the pair
+                parts.append(pair)
+            elif letter == "R":
+                parts.append("R" + format_number(new["R"]))
+            else:
+                parts.append(letter + value)
+        # Pairs are written together where the first of their words was
+        return " ".join(
+            " ".join(axis + format_number(new[axis]) for axis in part if axis in new)
+            if part in ("XY", "IJ")
+            else part
+            for part in parts
+        )
+
+
+def tile_offsets(columns, rows, pitch_x, pitch_y):
+    # Serpentine order: every other row runs backwards, so each copy starts
+    # next to where the last one ended
+    for row in range(rows):
+        order = range(columns) if row % 2 == 0 else range(columns - 1, -1, -1)
+        for column in order:
+            yield column * pitch_x, row * pitch_y
+
+
+def tiled_lines(path, transform, columns, rows, pitch_x, pitch_y, safe_z):
+    # Yields the program once per copy, read again each time, so the
+    # expanded program never has to fit in memory. path may be a multi-pass
+    # spec. Between copies the tool goes up to safe_z (mm) before travelling
+    # to the next one.
+    transformer = None
+    for dx, dy in tile_offsets(columns, rows, pitch_x, pitch_y):
+        copy = transform.translate(dx, dy)
+        if transformer is None:
+            transformer = LineTransformer(copy)
+        else:
+            yield from transformer.retract(safe_z)
+            transformer = transformer.moved(copy)
+        with open_program(path) as file:
+            for line in file:
+                yield transformer.apply(line.rstrip("\n"))
+
+
+class TiledProgram:
+    # A "#tile=" spec (see utils.passes): the program, or its passes, cut
+    # on a grid of columns x rows copies pitch_x and pitch_y mm apart, as
+    # one stream. Without safe_z the tool retracts between copies to the
+    # program's highest Z, at least DEFAULT_SAFE_Z. Transforming is per copy,
+    # so the size is measured by expanding once when loaded.
+    def __init__(self, path, columns, rows, pitch_x, pitch_y, safe_z=None):
+        if columns < 1 or rows < 1 or columns != int(columns) or rows != int(rows):
+            raise ValueError("Tile columns and rows must be whole numbers of at least 1")
+        self.path = path
+        self.columns, self.rows = int(columns), int(rows)
+        self.pitch_x, self.pitch_y = pitch_x, pitch_y
+        if safe_z is None:
+            bounds = file_summary(path)["bounds"]
+            if bounds is None:
+                raise ValueError(f"{path} has no moves to tile")
+            safe_z = max(bounds[1][2], DEFAULT_SAFE_Z)
+        self.safe_z = safe_z
+        self.size = sum(len(line) + 1 for line in self.lines())
+
+    def lines(self):
+        return tiled_lines(
+            self.path,
+            Transform(),
+            self.columns,
+            self.rows,
+            self.pitch_x,
+            self.pitch_y,
+            self.safe_z,
+        )